@@ -12,7 +12,7 @@ import shutil
 import copy
 import time
 import numpy as np
-from util import replace_outfolder, run_process
+from util import replace_outfolder, run_process, stamp_extension
 
 # Global Variables
 config_path = "physics_settings/config.sh"
@@ -107,6 +107,8 @@ def d90_replace_outfolders_jedi():
        
        jedisim_out/rescaled_lsst90
        
+       simdatabase/bulge_disk_f8_90
+       
        jedisim_out/out90/convolved/
        
        jedisim_out/out90/distorted_0_to_12/
@@ -117,6 +119,7 @@ def d90_replace_outfolders_jedi():
     config = update_config()
     outfolders = [config["90_output_folder"],
                   config["rescaled_outfolder90"],
+                  config["color_outfolder90"],
                   config['90_output_folder']+ 'convolved/'
                   ]
     for outfolder in outfolders:
@@ -136,6 +139,10 @@ def d90_replace_outfolders_jedi():
 
 def main():
     """Run main function."""
+
+    # jedicatalog names the stamps after stamp_codec, check it before the
+    # output folders are replaced
+    stamp_extension(update_config())
     
     # Create output folders.
     replace_outfolders_jedi()
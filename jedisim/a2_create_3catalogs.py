@@ -18,6 +18,9 @@ import re
 import copy
 import numpy as np
 from util import replace_outfolder, run_process
+from util import set_stage_cache, print_cache_stats, color_files, set_stage_log
+from util import set_cache_scope
+from util import log_span
 
 # Global Variables
 config_path = "physics_settings/config.sh"
@@ -74,12 +77,15 @@ def get_bulge_disk_weights():
 def run_jedicolor_jedicatalog():
     config = update_config()
     b,d = get_bulge_disk_weights()
+    set_stage_cache(config.get('stage_cache_dir'), config.get('stage_cache_size_gb', 20))
+    set_stage_log(config.get('stage_log'))
+    color_inputs, color_outputs = color_files(config['color_infile'])
     
     # Create 302 bulge_disk_f8 sample galaxies from original galaxies.
     run_process("jedicolor", ['./executables/jedicolor',
         config['color_infile'],
         str(b[0]), str(d[0])  
-        ])
+        ], color_inputs, color_outputs)
     
     # Make the catalog of galaxies (three text files)
     run_process("jedicatalog", ["./executables/jedicatalog",
@@ -88,6 +94,9 @@ def run_jedicolor_jedicatalog():
 def update_outfolder_angle_catalog():
     """Update the output folder name and rotate angle by 90 degree for catalog.txt.
     
+    The rotated case reads its bulge-disk galaxies from color_outfolder90,
+    so that a3 and a4 can run jedicolor at the same time.
+    
     Changes ::
     
       jedisim_out/out0/trial1_catalog.txt
@@ -95,7 +104,7 @@ def update_outfolder_angle_catalog():
       
       name                                              x           y   angle               redshift    pixscale    old_mag     old_rad     new_mag     new_rad     stamp_name                                  dis_name
       simdatabase/bulge_disk_f8/bdf8_255.fits	3165.936523	4969.229004	332.907227	1.500000	0.060000	24.766600	0.232020	25.990000	0.176100	jedisim_out/out0/stamp_12/stamp_12419.fits.gz	jedisim_out/out0/distorted_12/distorted_12419.fits
-      simdatabase/bulge_disk_f8/bdf8_255.fits	3165.936523	4969.229004	62.90722699999998	1.500000	0.060000	24.766600	0.232020	25.990000	0.176100	jedisim_out/out90/stamp_12/stamp_12419.fits.gz	jedisim_out/out90/distorted_12/distorted_12419.fits
+      simdatabase/bulge_disk_f8_90/bdf8_255.fits	3165.936523	4969.229004	62.90722699999998	1.500000	0.060000	24.766600	0.232020	25.990000	0.176100	jedisim_out/out90/stamp_12/stamp_12419.fits.gz	jedisim_out/out90/distorted_12/distorted_12419.fits
       
     """
           
@@ -112,6 +121,7 @@ def update_outfolder_angle_catalog():
         if angle90 >= 360:
             angle90 -= 360
         l[3] = str(angle90)
+        l[0] = l[0].replace(config['color_outfolder'], config['color_outfolder90'])
         l[-1] = l[-1].replace(config['output_folder'], config['90_output_folder'])
         l[-2] = l[-2].replace(config['output_folder'], config['90_output_folder'])
         line = "\t".join(l)
@@ -172,6 +182,9 @@ def update_outfolder_distortedlist():
 
 def main():
     """Run main function."""
+    set_stage_log(config_dict(config_path).get('stage_log'))
+    set_cache_scope()
+    start = time.time()
     
     # Create 3 catalogs.
     run_jedicolor_jedicatalog()
@@ -181,6 +194,10 @@ def main():
     update_outfolder_convolvedlist()
     update_outfolder_distortedlist()
 
+    # Hits and misses of the stage cache
+    print_cache_stats()
+    log_span('a2', start)
+
 
 if __name__ == "__main__":
     # Run main
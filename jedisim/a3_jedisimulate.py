@@ -23,6 +23,10 @@
   - jedirescale scales down from HST_convolved image to rescaled_lsst image according to rescaled_lsst_outfile.txt.
   - jediaverage will average 21 rescaled_lsst0_to20 images and writes LSST_averaged.fits according to config.sh.
   - jedinoise will add noise to this image and creates LSST_averaged_noised.fits according to config.sh
+  - With bulge_disk_decomposition=1 in config.sh, jedicolor, jeditransform and jedidistort run only for the bulge+disk and bulge mixtures, and jedipaste combines them with the weights of each iteration.
+  - With resample_maps=1 in config.sh, the geometry of jeditransform and jedidistort is computed once before the loop (resample.py), and each iteration applies it to the jedicolor images instead of running them.
+  - With rotate_stamps=1 in config.sh, the stamps of jeditransform are shared with a4_jedisimulate90.py, which lenses them rotated by 90 degrees instead of running jedicolor and jeditransform.
+  - With effective_psf=1 in config.sh, only the monochromatic iteration is run, and LSST_averaged.fits is the sum of a few convolutions of weighted scenes with effective psfs (combinations of psf0 to psf20) instead of jediaverage of the 21 rescaled images.
   
 :Runtime:
 
@@ -41,6 +45,16 @@ import copy
 import time
 import numpy as np
 from util import replace_outfolder, run_process
+from util import make_workspace, iteration_memory, pool_size
+from util import set_stage_cache, print_cache_stats, color_files, set_stage_log
+from util import set_cache_scope, listed_files
+from util import checkpoint_path, checkpoint_record, todo_iterations, remove_files
+from util import log_span, render_basis, write_weighted_list, compare_images
+from util import effective_psfs, sum_images, warm_distort_cache, run_distort
+from util import share_stamps, shared_lock, hold_lock, is_locked
+from util import read_paste_index, write_paste_index, paste_args, transform_args
+from resample import build_maps, apply_maps
+from convolve import convolve_image
 
 # Global Variables
 config_path = "physics_settings/config.sh"
@@ -99,9 +113,11 @@ def update_config():
 
 
 def psf_rescaled_lsst_outfile_lst():
+    """Return the 21 psf files and the 21 rescaled files read by jediaverage."""
+    config = update_config()
     psf =  ['psf/psf%d.fits' % i for i in range(21)]
-    rescaled_lsst_outfile = ['jedisim_out/rescaled_lsst/rescaled_lsst_%d.fits'
-                              % i for i in range(21) ]
+    with open(config['rescaled_lsst_outfile']) as f:
+        rescaled_lsst_outfile = f.read().split()
     return psf, rescaled_lsst_outfile
 
 
@@ -114,67 +130,350 @@ def get_bulge_disk_weights():
     return b,d
 
 
-def run_7programs_loop():
-    """Run 7 programs in the loop."""
+def paste_galaxies(i, files, basis=None, center=None):
+    """Write the HST image of the i-th bulge-disk weights.
+
+    With basis from render_basis the lensed galaxies are not rendered again,
+    jedipaste adds the two basis scenes with the weights of each galaxy.
+    center is the embedding of jeditransform, see transform_args.
+    """
     config = update_config()
     b, d = get_bulge_disk_weights()
-    psf, rescaled_lsst_outfile = psf_rescaled_lsst_outfile_lst()
-    for i in range(0, 21):
-
-        # Create bulge-disk images with appropriate weights to bulge and disk.
-        run_process("jedicolor", ['./executables/jedicolor',
-                                  config['color_infile'],
-                                  str(b[i]), str(d[i])  
-                                  ])
 
+    if basis is not None:
+        distortedlist = os.path.join(os.path.dirname(files['HST_image']),
+                                     'weighted_distortedlist.txt')
+        write_weighted_list(distortedlist, basis, b[i], d[i])
+        run_process("jedipaste", paste_args(config, distortedlist, files['HST_image']))
+        return
+
+    color_inputs, color_outputs = color_files(files['color_infile'])
+
+    # Create bulge-disk images with appropriate weights to bulge and disk.
+    run_process("jedicolor", ['./executables/jedicolor',
+                              files['color_infile'],
+                              str(b[i]), str(d[i])  
+                              ], color_inputs, color_outputs)
+
+    # The maps of build_maps exist inside the loop with resample_maps=1
+    maps = config['iteration_scratch'] + 'maps0/'
+    if int(config.get('resample_maps', 0)) and os.path.isdir(maps):
+        # Transform and lens the galaxies with the maps, only the pixels
+        # of jedicolor change from one iteration to the next
+        start = time.time()
+        index = apply_maps(maps, files['catalog_file'], b[i], d[i])
+        log_span('resample', start)
+    else:
         # Transform bulge-disk images with our settings.
-        run_process("jeditransform", ['./executables/jeditransform',
-                                      config['catalog_file'],
-                                      config['dislist_file']
-                                      ])
+        run_process("jeditransform", transform_args(config, files['catalog_file'],
+                                                    files['dislist_file'], center))
+
+        # Share the stamps with a4 while the loop holds the lock
+        lock = shared_lock(config)
+        if int(config.get('rotate_stamps', 0)) and os.path.exists(lock) and is_locked(lock):
+            share_stamps(config, i, files['dislist_file'])
 
         # Lens 12420 galaxies and get unzipped distorted images.
-        run_process("jedidistort", ['./executables/jedidistort',
-                                    config['nx'],
-                                    config['ny'],
-                                    config['dislist_file'],
-                                    config['lenses_file'],
-                                    config['pix_scale'],
-                                    config['lens_z']
-                                    ])
+        run_distort(config, files['dislist_file'])
+        index = read_paste_index(files['dislist_file'])
 
-        # Combine the lensed galaxies onto one large image
-        run_process("jedipaste", ['./executables/jedipaste',
-                                  config['nx'],
-                                  config['ny'],
-                                  config['distortedlist_file'],
-                                  config['HST_image']
-                                  ])
+    # Combine the lensed galaxies onto one large image, the paste index
+    # lets jedipaste open only the galaxies overlapping each band
+    write_paste_index(files['distortedlist_file'], index)
+    run_process("jedipaste", paste_args(config, files['distortedlist_file'], files['HST_image']))
 
-        # Create 6 convolved bands by combinining input images with psf[i].
+
+def convolve_and_rescale(files, psf_file, rescaled_file):
+    """Convolve the HST image of files with psf_file and rescale it to LSST."""
+    config = update_config()
+
+    if int(config.get('fft_convolve', 0)):
+        # Convolve in-process, straight into the HST_convolved image
+        start = time.time()
+        convolve_image(files['HST_image'], psf_file, files['HST_convolved_image'],
+                       int(config.get('fft_workers', 0)),
+                       config.get('psf_spectrum_cache', ''),
+                       float(config.get('psf_spectrum_cache_gb', 20)) * 1e9)
+        log_span('convolve', start)
+    else:
+        # The bands of convolvedlist are the outputs of jediconvolve for the stage cache
+        bands = listed_files(files['convolvedlist_file'])
+
+        # Create 6 convolved bands by combinining input images with the psf.
         run_process("jediconvolve", ['./executables/jediconvolve',
-                                     config['HST_image'],
-                                     psf[i],
-                                     config['output_folder'] + 'convolved/'
-                                     ])
+                                     files['HST_image'],
+                                     psf_file,
+                                     files['convolved_folder']
+                                     ],
+                    inputs=[files['HST_image'], psf_file],
+                    outputs=bands)
 
         # Combine 6 convolved bands into HST_convolved image.
-        run_process("jedipaste", ['./executables/jedipaste',
-                                  config['nx'],
-                                  config['ny'],
-                                  config['convolvedlist_file'],
-                                  config['HST_convolved_image']
-                                  ])
-
-        # Scale the image down from HST to LSST scale and trim the edgescolor
-        run_process("jedirescale", ['./executables/jedirescale',
-                                    config['HST_convolved_image'],
-                                    config['pix_scale'],
-                                    config['final_pix_scale'],
-                                    config['x_trim'],
-                                    config['y_trim'],
-                                    rescaled_lsst_outfile[i]
-                                    ])
+        run_process("jedipaste", paste_args(config, files['convolvedlist_file'], files['HST_convolved_image']),
+                    inputs=[files['convolvedlist_file']] + bands,
+                    outputs=[files['HST_convolved_image']])
+
+    # Scale the image down from HST to LSST scale and trim the edgescolor
+    run_process("jedirescale", ['./executables/jedirescale',
+                                files['HST_convolved_image'],
+                                config['pix_scale'],
+                                config['final_pix_scale'],
+                                config['x_trim'],
+                                config['y_trim'],
+                                rescaled_file
+                                ],
+                inputs=[files['HST_convolved_image']],
+                outputs=[rescaled_file])
+
+
+def run_7programs(i, files, basis=None):
+    """Run the 7 programs for the i-th psf.
+
+    files has the paths of the files written inside the loop, i.e. the
+    config values or the ones of a private workspace from make_workspace.
+    """
+    config = update_config()
+    psf, rescaled_lsst_outfile = psf_rescaled_lsst_outfile_lst()
+    set_stage_cache(config.get('stage_cache_dir'), config.get('stage_cache_size_gb', 20))
+    set_stage_log(config.get('stage_log'))
+    start = time.time()
+
+    # Create, transform, lens and paste the galaxies into the HST image.
+    paste_galaxies(i, files, basis)
+
+    # Convolve with psf[i], paste the bands and rescale to LSST.
+    convolve_and_rescale(files, psf[i], rescaled_lsst_outfile[i])
+
+    # Record the finished iteration for --resume
+    checkpoint_record(checkpoint_path(config['rescaled_outfolder']), i,
+                      rescaled_lsst_outfile[i])
+    log_span('iteration %i' % i, start)
+
+
+def run_7programs_workspace(i, basis=None):
+    """Run the 7 programs for the i-th psf inside its own scratch folder.
+
+    Only rescaled_lsst_outfile[i] is kept, the scratch folder is removed.
+    """
+    config = update_config()
+    workdir = config['iteration_scratch'] + 'out0_%d/' % i
+    files = make_workspace(workdir, config['num_galaxies'],
+                           config['color_infile'],
+                           config['catalog_file'],
+                           config['convolvedlist_file'])
+    run_7programs(i, files, basis)
+    shutil.rmtree(workdir)
+
+
+def run_7programs_parallel(max_workers, todo, basis=None):
+    """Run the 21 iterations on a process pool.
+
+    The pool size is limited by max_workers, the number of cores and
+    the available memory divided by the memory of one iteration.
+    """
+    # Imports
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    config = update_config()
+    psf, rescaled_lsst_outfile = psf_rescaled_lsst_outfile_lst()
+    job_memory = iteration_memory(int(config['nx']), int(config['ny']), psf[0])
+    nworkers = pool_size(max_workers, job_memory)
+    print('Running {} iterations on {} workers ({:.1f} GB each).'.format(
+          len(todo), nworkers, job_memory / 1e9))
+
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        futures = {pool.submit(run_7programs_workspace, i, basis): i for i in todo}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                print("Error: iteration %i did not terminate correctly." % futures[future])
+                for f in futures:
+                    f.cancel()
+                sys.exit(1)
+
+
+def loop_files():
+    """Return the files written by the serial loop, i.e. the config values."""
+    config = update_config()
+    files = copy.deepcopy(config)
+    files['convolved_folder'] = config['output_folder'] + 'convolved/'
+    return files
+
+
+def run_7programs_loop(resume=False):
+    """Run 7 programs in the loop.
+
+    If parallel_iterations in config.sh is larger than 0, the iterations
+    run at the same time, each one in its own workspace.
+
+    If bulge_disk_decomposition in config.sh is 1, jedicolor, jeditransform
+    and jedidistort are run twice before the loop instead of 21 times.
+    Else if resample_maps is 1, the maps of resample.build_maps replace
+    jeditransform and jedidistort in the iterations.
+    Else if rotate_stamps is 1, the stamps of jeditransform are shared with
+    a4, which rotates them instead of running jeditransform.
+    """
+    config = update_config()
+    psf, rescaled_lsst_outfile = psf_rescaled_lsst_outfile_lst()
+    todo = todo_iterations(checkpoint_path(config['rescaled_outfolder']),
+                           rescaled_lsst_outfile, resume)
+    effective = int(config.get('effective_psf', 0))
+    if effective:
+        todo = [i for i in todo if rescaled_lsst_outfile[i] == config['monochromatic_infits']]
+
+    warm_distort_cache(config)
+
+    basis = None
+    if effective or (todo and int(config.get('bulge_disk_decomposition', 0))):
+        basis = render_basis(config['iteration_scratch'] + 'basis0/', config,
+                             config['color_infile'],
+                             config['catalog_file'],
+                             config['convolvedlist_file'])
+
+    maps = config['iteration_scratch'] + 'maps0/'
+    resample = basis is None and todo and int(config.get('resample_maps', 0))
+    if resample:
+        b, d = get_bulge_disk_weights()
+        build_maps(maps, config, config['color_infile'], config['catalog_file'], b, d)
+
+    # a4 waits for the shared stamps while the lock is held
+    lock = None
+    if basis is None and not resample and int(config.get('rotate_stamps', 0)):
+        lock = hold_lock(shared_lock(config))
+
+    max_workers = int(config.get('parallel_iterations', 0))
+    if max_workers > 0:
+        run_7programs_parallel(max_workers, todo, basis)
+    else:
+        files = loop_files()
+        for i in todo:
+            run_7programs(i, files, basis)
+
+    if effective:
+        average_effective_psf(basis)
+    if basis is not None:
+        shutil.rmtree(config['iteration_scratch'] + 'basis0/')
+    if resample:
+        shutil.rmtree(maps)
+    if lock is not None:
+        lock.close()
+
+
+def average_effective_psf(basis, iterations=None, outfile=None):
+    """Write LSST_averaged_image from the convolutions with the effective psfs.
+
+    This approximates the average of the 21 rescaled images without running
+    them, see util.effective_psfs and check_effective_psf. With iterations
+    and outfile, the average of these iterations is written to outfile.
+    """
+    config = update_config()
+    psf, rescaled_lsst_outfile = psf_rescaled_lsst_outfile_lst()
+    b, d = get_bulge_disk_weights()
+    iterations = list(range(len(psf))) if iterations is None else iterations
+    workdir = config['iteration_scratch'] + 'effective0/'
+    terms = effective_psfs(workdir, basis, b[iterations], d[iterations],
+                           [psf[i] for i in iterations],
+                           float(config.get('effective_psf_tolerance', 1e-5)))
+
+    rescaled = []
+    for k, (distortedlist, psf_file) in enumerate(terms):
+        files = make_workspace(workdir + 'term_%d/' % k, config['num_galaxies'],
+                               config['color_infile'],
+                               config['catalog_file'],
+                               config['convolvedlist_file'])
+        run_process("jedipaste", paste_args(config, distortedlist, files['HST_image']))
+        rescaled.append(workdir + 'rescaled_effective_%d.fits' % k)
+        convolve_and_rescale(files, psf_file, rescaled[-1])
+        shutil.rmtree(workdir + 'term_%d/' % k)
+
+    sum_images(rescaled, outfile or config['LSST_averaged_image'])
+    shutil.rmtree(workdir)
+
+
+def check_decomposition(iterations):
+    """Compare the HST images of the decomposition and of the 7 programs.
+
+    Returns the iterations whose relative L1 residual is larger than
+    decomposition_tolerance in config.sh.
+    """
+    config = update_config()
+    tolerance = float(config.get('decomposition_tolerance', 1e-3))
+    workdir = config['iteration_scratch'] + 'check0/'
+    replace_outfolder(workdir)
+    warm_distort_cache(config)
+    basis = render_basis(workdir + 'basis/', config,
+                         config['color_infile'],
+                         config['catalog_file'],
+                         config['convolvedlist_file'])
+
+    failed = []
+    print("{:>9}{:>14}{:>14}{:>14}".format('iteration', 'flux ratio',
+                                           'L1 residual', 'max residual'))
+    for i in iterations:
+        files = make_workspace(workdir + 'out0_%d/' % i, config['num_galaxies'],
+                               config['color_infile'],
+                               config['catalog_file'],
+                               config['convolvedlist_file'])
+        paste_galaxies(i, files, center=True)
+        decomposed = dict(files, HST_image=files['HST_image'].replace(
+                          '.fits', '_decomposed.fits'))
+        paste_galaxies(i, decomposed, basis)
+
+        ratio, l1, peak = compare_images(files['HST_image'], decomposed['HST_image'])
+        print("{:>9}{:>14.6f}{:>14.2e}{:>14.2e}".format(i, ratio, l1, peak))
+        if l1 > tolerance:
+            failed.append(i)
+        shutil.rmtree(workdir + 'out0_%d/' % i)
+
+    shutil.rmtree(workdir)
+    return failed
+
+
+def check_effective_psf(iterations):
+    """Compare the average of the effective psfs with the one of the 7 programs.
+
+    Both averages are over the given iterations. The 7 programs run with
+    the embedding of jeditransform of LSST_averaged.fits and with the
+    center embedding of the effective psfs, so the second residual is the
+    one of the effective psfs alone. Returns the relative L1 and max
+    residuals of the effective psf average to both.
+    """
+    config = update_config()
+    psf, rescaled_lsst_outfile = psf_rescaled_lsst_outfile_lst()
+    workdir = config['iteration_scratch'] + 'check_effective0/'
+    replace_outfolder(workdir)
+    warm_distort_cache(config)
+
+    averaged = []
+    for center in [False, True]:
+        rescaled = []
+        for i in iterations:
+            files = make_workspace(workdir + 'out0_%d/' % i, config['num_galaxies'],
+                                   config['color_infile'],
+                                   config['catalog_file'],
+                                   config['convolvedlist_file'])
+            paste_galaxies(i, files, center=center)
+            rescaled.append(workdir + 'rescaled_%d_%d.fits' % (i, center))
+            convolve_and_rescale(files, psf[i], rescaled[-1])
+            shutil.rmtree(workdir + 'out0_%d/' % i)
+        averaged.append(workdir + 'averaged_7programs_%d.fits' % center)
+        sum_images(rescaled, averaged[-1], 1.0 / len(iterations))
+
+    basis = render_basis(workdir + 'basis/', config,
+                         config['color_infile'],
+                         config['catalog_file'],
+                         config['convolvedlist_file'])
+    effective = workdir + 'averaged_effective.fits'
+    average_effective_psf(basis, iterations, effective)
+
+    residuals = []
+    print("{:>12}{:>14}{:>14}{:>14}".format('embedding', 'flux ratio',
+                                            'L1 residual', 'max residual'))
+    for name, path in zip(['default', 'center'], averaged):
+        ratio, l1, peak = compare_images(path, effective)
+        print("{:>12}{:>14.6f}{:>14.2e}{:>14.2e}".format(name, ratio, l1, peak))
+        residuals.append((l1, peak))
+    shutil.rmtree(workdir)
+    return residuals
 
 
 def average21_and_add_noise():
@@ -188,10 +487,18 @@ def average21_and_add_noise():
     # Average the 21 fits files from jedisim_out/rescaled_lsst/*.fits
     # And write to jedisim_out/out0/LSST_averaged.fits
     config = update_config()
-    run_process("jediaverage", ['./executables/jediaverage',
-                                config['rescaled_lsst_outfile'],
-                                config['LSST_averaged_image']
-                                ])
+
+    # These programs do not overwrite, e.g. after --resume
+    remove_files([config['LSST_averaged_noised_image'],
+                  config['monochromatic_outfits']])
+
+    # With effective_psf the average is written by the loop
+    if not int(config.get('effective_psf', 0)):
+        remove_files([config['LSST_averaged_image']])
+        run_process("jediaverage", ['./executables/jediaverage',
+                                    config['rescaled_lsst_outfile'],
+                                    config['LSST_averaged_image']
+                                    ])
 
     # Simulate exposure time and add Poisson noise
     # jedisim_out/out0/LSST_averaged.fits ==> jedisim_out/out1/LSST_averaged_noised.fits
@@ -213,14 +520,53 @@ def average21_and_add_noise():
 
 
 def main():
-    """Run main function."""
+    """Run main function.
+
+    With --resume the iterations of the checkpoint manifest whose outputs
+    are unchanged are not run again.
+
+    With --check-decomposition [i ...] only the HST images of the
+    decomposition and of the 7 programs are compared (default 0 10 20).
+
+    With --check-effective-psf [i ...] only the averages of these iterations
+    (default 0) by the effective psfs and by the 7 programs are compared,
+    the 7 programs with the center embedding within decomposition_tolerance.
+    """
+    resume = '--resume' in sys.argv[1:]
+    config = update_config()
+    set_stage_log(config.get('stage_log'))
+    set_stage_cache(config.get('stage_cache_dir'), config.get('stage_cache_size_gb', 20))
+    set_cache_scope()
+
+    # Only compare the decomposition with the 7 programs
+    if '--check-decomposition' in sys.argv[1:]:
+        iterations = [int(a) for a in sys.argv[1:] if a.isdigit()] or [0, 10, 20]
+        failed = check_decomposition(iterations)
+        print('%i iterations above decomposition_tolerance.' % len(failed))
+        sys.exit(1 if failed else 0)
+
+    # Only compare the effective psfs with the 7 programs
+    if '--check-effective-psf' in sys.argv[1:]:
+        iterations = [int(a) for a in sys.argv[1:] if a.isdigit()] or [0]
+        residuals = check_effective_psf(iterations)
+        l1 = residuals[1][0]
+        tolerance = float(update_config().get('decomposition_tolerance', 1e-3))
+        print('L1 residual with the center embedding %s decomposition_tolerance.'
+              % ('above' if l1 > tolerance else 'within'))
+        sys.exit(1 if l1 > tolerance else 0)
+
+    start = time.time()
     
     # Run 7 programs in the loop
-    run_7programs_loop()
+    run_7programs_loop(resume)
     
     # Average 21 outputs and add noise to it.
     average21_and_add_noise()
 
+    # Hits and misses of the stage cache
+    print_cache_stats()
+    log_span('a3', start)
+
     
 
 if __name__ == "__main__":
@@ -5,6 +5,14 @@
 :Runtime:
 
   2 hr 45 minutes for 21 for loop and one run (July 28, 2017)
+
+.. note::
+
+  With rotate_stamps=1 in config.sh, the catalogs of the two cases only
+  differ by 90 degrees in the angles, so the stamps of a3_jedisimulate.py
+  rotated by 90 degrees are used instead of running jedicolor and
+  jeditransform. python a4_jedisimulate90.py --check-rotation compares
+  them with the stamps of jeditransform.
   
 """
 
@@ -20,6 +28,16 @@ import copy
 import time
 import numpy as np
 from util import replace_outfolder, run_process
+from util import make_workspace, iteration_memory, pool_size
+from util import set_stage_cache, print_cache_stats, color_files, set_stage_log
+from util import set_cache_scope, listed_files
+from util import checkpoint_path, checkpoint_record, todo_iterations, remove_files
+from util import log_span, render_basis, write_weighted_list
+from util import effective_psfs, sum_images, warm_distort_cache, run_distort
+from util import wait_shared_stamps, rotated_dislist, rotated_geometry, catalog_positions
+from util import read_paste_index, write_paste_index, paste_args, transform_args
+from resample import build_maps, apply_maps
+from convolve import convolve_image
 
 # Global Variables
 config_path = "physics_settings/config.sh"
@@ -69,9 +87,10 @@ def update_config():
     
 
 def d90_psf_rescaled_lsst_outfile_lst():
+    config = update_config()
     psf90 =  ['psf/psf%d.fits' % i for i in range(21)]
-    rescaled_lsst_outfile90 = ['jedisim_out/rescaled_lsst90/rescaled_lsst90_%d.fits'
-                              % i for i in range(21) ]
+    with open(config['rescaled_lsst_outfile90']) as f:
+        rescaled_lsst_outfile90 = f.read().split()
                               
     return psf90, rescaled_lsst_outfile90
 
@@ -83,76 +102,314 @@ def get_bulge_disk_weights():
     
     return b,d
 
-def d90_run_7programs_loop():
+def d90_paste_galaxies(i, files, basis=None):
+    """Write the HST image of the i-th bulge-disk weights for the rotated case."""
     config = update_config()
     b, d = get_bulge_disk_weights()
-    psf90, rescaled_lsst_outfile90 = d90_psf_rescaled_lsst_outfile_lst()
-    for i in range(0, 21):
-    # for i in range(0, 1):
 
-        # The jedicolor creates 302 fitsfiles inside config['output_folder_bulge']
+    # The lensed galaxies are the two basis scenes of render_basis, weighted
+    if basis is not None:
+        distortedlist = os.path.join(os.path.dirname(files['HST_image']),
+                                     'weighted_distortedlist.txt')
+        write_weighted_list(distortedlist, basis, b[i], d[i])
+        run_process("jedipaste", paste_args(config, distortedlist, files['HST_image']))
+        return
+
+    # The maps of build_maps exist inside the loop with resample_maps=1
+    maps = config['iteration_scratch'] + 'maps90/'
+    resample = int(config.get('resample_maps', 0)) and os.path.isdir(maps)
+
+    # With rotate_stamps=1 the stamps of a3 rotated by 90 degrees are the
+    # stamps of this case, jedicolor and jeditransform are not run
+    shared = None
+    if int(config.get('rotate_stamps', 0)) and not resample:
+        shared = wait_shared_stamps(config, i, config['90_catalog_file'])
+
+    if shared:
+        rotated_dislist(shared + 'dislist.txt', files['catalog_file'], files['dislist_file'])
+        run_distort(config, files['dislist_file'], rotate=True)
+        index = read_paste_index(files['dislist_file'])
+        shutil.rmtree(shared)
+    else:
+        color_inputs, color_outputs = color_files(files['color_infile'])
+
+        # The jedicolor creates 201 fitsfiles inside config['color_outfolder90']
         run_process("jedicolor", ['./executables/jedicolor',
-                                  config['color_infile'],
+                                  files['color_infile'],
                                   str(b[i]), str(d[i])
-                                  ])
+                                  ], color_inputs, color_outputs)
 
+    if resample:
+        # Transform and lens the galaxies with the maps, only the pixels
+        # of jedicolor change from one iteration to the next
+        start = time.time()
+        index = apply_maps(maps, files['catalog_file'], b[i], d[i])
+        log_span('resample', start)
+    elif not shared:
         # Make postage stamp images that fit the catalog parameters
-        run_process("jeditransform", ['./executables/jeditransform',
-                                      config['90_catalog_file'],
-                                      config['90_dislist_file']
-                                      ])
+        run_process("jeditransform", transform_args(config, files['catalog_file'],
+                                                    files['dislist_file']))
 
         # Lens the galaxies one at a time
-        run_process("jedidistort", ['./executables/jedidistort',
-                                    config['nx'],
-                                    config['ny'],
-                                    config['90_dislist_file'],
-                                    config['lenses_file'],
-                                    config['pix_scale'],
-                                    config['lens_z']
-                                    ])
-
-        # Combine the lensed galaxies onto one large image
-        run_process("jedipaste", ['./executables/jedipaste',
-                                  config['nx'],
-                                  config['ny'],
-                                  config['90_distortedlist_file'],
-                                  config['90_HST_image']
-                                  ])
+        run_distort(config, files['dislist_file'])
+        index = read_paste_index(files['dislist_file'])
+
+    # Combine the lensed galaxies onto one large image, the paste index
+    # lets jedipaste open only the galaxies overlapping each band
+    write_paste_index(files['distortedlist_file'], index)
+    run_process("jedipaste", paste_args(config, files['distortedlist_file'], files['HST_image']))
+
+
+def d90_convolve_and_rescale(files, psf_file, rescaled_file):
+    config = update_config()
+
+    if int(config.get('fft_convolve', 0)):
+        # Convolve in-process, straight into the HST_convolved image
+        start = time.time()
+        convolve_image(files['HST_image'], psf_file, files['HST_convolved_image'],
+                       int(config.get('fft_workers', 0)),
+                       config.get('psf_spectrum_cache', ''),
+                       float(config.get('psf_spectrum_cache_gb', 20)) * 1e9)
+        log_span('convolve', start)
+    else:
+        # The bands of convolvedlist are the outputs of jediconvolve for the stage cache
+        bands = listed_files(files['convolvedlist_file'])
 
         # Convonlve the large image with the PSF.
         # This creates one image for each band of the image.
         run_process("jediconvolve", ['./executables/jediconvolve',
-                                     config['90_HST_image'],
-                                     psf90[i],
-                                     config['90_output_folder'] + 'convolved/'
-                                     ])
+                                     files['HST_image'],
+                                     psf_file,
+                                     files['convolved_folder']
+                                     ],
+                    inputs=[files['HST_image'], psf_file],
+                    outputs=bands)
 
         # Combine each band into a single image
-        run_process("jedipaste", ['./executables/jedipaste',
-                                  config['nx'],
-                                  config['ny'],
-                                  config['90_convolvedlist_file'],
-                                  config['90_HST_convolved_image']
-                                  ])
-
-        # Scale the image down from HST to LSST scale and trim the edges.
-        run_process("jedirescale", ['./executables/jedirescale',
-                                    config['90_HST_convolved_image'],
-                                    config['pix_scale'],
-                                    config['final_pix_scale'],
-                                    config['x_trim'],
-                                    config['y_trim'],
-                                    rescaled_lsst_outfile90[i]
-                                    ])
+        run_process("jedipaste", paste_args(config, files['convolvedlist_file'], files['HST_convolved_image']),
+                    inputs=[files['convolvedlist_file']] + bands,
+                    outputs=[files['HST_convolved_image']])
+
+    # Scale the image down from HST to LSST scale and trim the edges.
+    run_process("jedirescale", ['./executables/jedirescale',
+                                files['HST_convolved_image'],
+                                config['pix_scale'],
+                                config['final_pix_scale'],
+                                config['x_trim'],
+                                config['y_trim'],
+                                rescaled_file
+                                ],
+                inputs=[files['HST_convolved_image']],
+                outputs=[rescaled_file])
+
+
+def d90_run_7programs(i, files, basis=None):
+    """Run the 7 programs for the i-th psf for the rotated case.
+
+    files has the paths of the files written inside the loop, i.e. the
+    90_ config values or the ones of a private workspace from make_workspace.
+    """
+    config = update_config()
+    psf90, rescaled_lsst_outfile90 = d90_psf_rescaled_lsst_outfile_lst()
+    set_stage_cache(config.get('stage_cache_dir'), config.get('stage_cache_size_gb', 20))
+    set_stage_log(config.get('stage_log'))
+    start = time.time()
+
+    # Create, transform, lens and paste the galaxies into the HST image.
+    d90_paste_galaxies(i, files, basis)
+
+    # Convolve with psf90[i], paste the bands and rescale to LSST.
+    d90_convolve_and_rescale(files, psf90[i], rescaled_lsst_outfile90[i])
+
+    # Record the finished iteration for --resume
+    checkpoint_record(checkpoint_path(config['rescaled_outfolder90']), i,
+                      rescaled_lsst_outfile90[i])
+    log_span('iteration %i' % i, start)
+
+
+def d90_run_7programs_workspace(i, basis=None):
+    """Run the 7 programs for the i-th psf inside its own scratch folder."""
+    config = update_config()
+    workdir = config['iteration_scratch'] + 'out90_%d/' % i
+    files = make_workspace(workdir, config['num_galaxies'],
+                           config['color_infile90'],
+                           config['90_catalog_file'],
+                           config['90_convolvedlist_file'])
+    d90_run_7programs(i, files, basis)
+    shutil.rmtree(workdir)
+
+
+def d90_run_7programs_parallel(max_workers, todo, basis=None):
+    """Run the 21 iterations of the rotated case on a process pool."""
+    # Imports
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    config = update_config()
+    psf90, rescaled_lsst_outfile90 = d90_psf_rescaled_lsst_outfile_lst()
+    job_memory = iteration_memory(int(config['nx']), int(config['ny']), psf90[0])
+    nworkers = pool_size(max_workers, job_memory)
+    print('Running {} iterations on {} workers ({:.1f} GB each).'.format(
+          len(todo), nworkers, job_memory / 1e9))
+
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        futures = {pool.submit(d90_run_7programs_workspace, i, basis): i for i in todo}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                print("Error: iteration %i did not terminate correctly." % futures[future])
+                for f in futures:
+                    f.cancel()
+                sys.exit(1)
+
+
+def d90_run_7programs_loop(resume=False):
+    config = update_config()
+    psf90, rescaled_lsst_outfile90 = d90_psf_rescaled_lsst_outfile_lst()
+    todo = todo_iterations(checkpoint_path(config['rescaled_outfolder90']),
+                           rescaled_lsst_outfile90, resume)
+    effective = int(config.get('effective_psf', 0))
+    if effective:
+        todo = [i for i in todo if rescaled_lsst_outfile90[i] == config['monochromatic_infits90']]
+
+    warm_distort_cache(config)
+
+    basis = None
+    if effective or (todo and int(config.get('bulge_disk_decomposition', 0))):
+        basis = render_basis(config['iteration_scratch'] + 'basis90/', config,
+                             config['color_infile90'],
+                             config['90_catalog_file'],
+                             config['90_convolvedlist_file'])
+
+    maps = config['iteration_scratch'] + 'maps90/'
+    resample = basis is None and todo and int(config.get('resample_maps', 0))
+    if resample:
+        b, d = get_bulge_disk_weights()
+        build_maps(maps, config, config['color_infile90'], config['90_catalog_file'], b, d)
+
+    max_workers = int(config.get('parallel_iterations', 0))
+    if max_workers > 0:
+        d90_run_7programs_parallel(max_workers, todo, basis)
+    else:
+        files = {'color_infile':        config['color_infile90'],
+                 'catalog_file':        config['90_catalog_file'],
+                 'dislist_file':        config['90_dislist_file'],
+                 'distortedlist_file':  config['90_distortedlist_file'],
+                 'convolvedlist_file':  config['90_convolvedlist_file'],
+                 'HST_image':           config['90_HST_image'],
+                 'HST_convolved_image': config['90_HST_convolved_image'],
+                 'convolved_folder':    config['90_output_folder'] + 'convolved/'}
+        for i in todo:
+            d90_run_7programs(i, files, basis)
+
+    if effective:
+        d90_average_effective_psf(basis)
+    if basis is not None:
+        shutil.rmtree(config['iteration_scratch'] + 'basis90/')
+    if resample:
+        shutil.rmtree(maps)
+
+
+def d90_average_effective_psf(basis):
+    """Write 90_LSST_averaged_image from the convolutions with the effective psfs."""
+    config = update_config()
+    psf90, rescaled_lsst_outfile90 = d90_psf_rescaled_lsst_outfile_lst()
+    b, d = get_bulge_disk_weights()
+    workdir = config['iteration_scratch'] + 'effective90/'
+    terms = effective_psfs(workdir, basis, b, d, psf90,
+                           float(config.get('effective_psf_tolerance', 1e-5)))
+
+    rescaled = []
+    for k, (distortedlist, psf_file) in enumerate(terms):
+        files = make_workspace(workdir + 'term_%d/' % k, config['num_galaxies'],
+                               config['color_infile90'],
+                               config['90_catalog_file'],
+                               config['90_convolvedlist_file'])
+        run_process("jedipaste", paste_args(config, distortedlist, files['HST_image']))
+        rescaled.append(workdir + 'rescaled_effective_%d.fits' % k)
+        d90_convolve_and_rescale(files, psf_file, rescaled[-1])
+        shutil.rmtree(workdir + 'term_%d/' % k)
+
+    sum_images(rescaled, config['90_LSST_averaged_image'])
+    shutil.rmtree(workdir)
+
+
+def d90_check_rotation(iterations):
+    """Compare the stamps of the rotated case with the rotated normal stamps.
+
+    jedicolor and jeditransform are run for both cases. The stamp of each
+    galaxy must have the geometry of util.rotated_geometry and the pixels
+    of the normal stamp rotated by 90 degrees. Returns (iteration, galaxy)
+    of the galaxies whose geometry differs or whose max residual relative
+    to the peak is larger than rotation_tolerance in config.sh.
+    """
+    # Imports
+    from astropy.io import fits
+
+    config = update_config()
+    tolerance = float(config.get('rotation_tolerance', 1e-3))
+    b, d = get_bulge_disk_weights()
+    x, y = catalog_positions(config['90_catalog_file'])
+    workdir = config['iteration_scratch'] + 'check90/'
+    replace_outfolder(workdir)
+    cases = [('out0_%d/', config['color_infile'], config['catalog_file'],
+              config['convolvedlist_file']),
+             ('out90_%d/', config['color_infile90'], config['90_catalog_file'],
+              config['90_convolvedlist_file'])]
+
+    flagged = []
+    print("{:>9}{:>10}{:>10}{:>10}{:>14}".format('iteration', 'galaxies', 'geometry',
+                                                 'pixels', 'max residual'))
+    for i in iterations:
+        dislists = []
+        for folder, color_infile, catalog_file, convolvedlist_file in cases:
+            files = make_workspace(workdir + folder % i, config['num_galaxies'],
+                                   color_infile, catalog_file, convolvedlist_file)
+            color_inputs, color_outputs = color_files(files['color_infile'])
+            run_process("jedicolor", ['./executables/jedicolor',
+                                      files['color_infile'],
+                                      str(b[i]), str(d[i])
+                                      ], color_inputs, color_outputs)
+            run_process("jeditransform", transform_args(config, files['catalog_file'],
+                                                        files['dislist_file'], center=True))
+            with open(files['dislist_file']) as f:
+                dislists.append([line for line in f if line.strip()])
+
+        geometry, pixels, peak = [], [], 0
+        for k, (line, line90) in enumerate(zip(*dislists)):
+            if rotated_geometry(line, float(x[k]), float(y[k])) != \
+               tuple(int(v) for v in line90.split()[:4]):
+                geometry.append(k)
+                continue
+            stamp = np.rot90(fits.getdata(line.split()[5]).astype(float))
+            stamp90 = fits.getdata(line90.split()[5]).astype(float)
+            residual = np.abs(stamp - stamp90).max() / np.abs(stamp90).max()
+            peak = max(peak, residual)
+            if residual > tolerance:
+                pixels.append(k)
+
+        print("{:>9}{:>10}{:>10}{:>10}{:>14.2e}".format(i, len(dislists[1]), len(geometry),
+                                                        len(pixels), peak))
+        for k in sorted(geometry + pixels):
+            print("  galaxy %i: %s" % (k, 'geometry' if k in geometry else 'pixels'))
+            flagged.append((i, k))
+        for folder, _, _, _ in cases:
+            shutil.rmtree(workdir + folder % i)
+
+    shutil.rmtree(workdir)
+    return flagged
 
 
 def d90_average21_and_add_noise():
     config = update_config()
-    run_process("jediaverage", ['./executables/jediaverage',
-        config['rescaled_lsst_outfile90'],
-        config['90_LSST_averaged_image']
-        ])
+    remove_files([config['90_LSST_averaged_noised_image'],
+                  config['monochromatic_outfits90']])
+
+    # With effective_psf the average is written by the loop
+    if not int(config.get('effective_psf', 0)):
+        remove_files([config['90_LSST_averaged_image']])
+        run_process("jediaverage", ['./executables/jediaverage',
+            config['rescaled_lsst_outfile90'],
+            config['90_LSST_averaged_image']
+            ])
 
     # Add noise to averaged file.
     run_process("jedinoise", ['./executables/jedinoise',
@@ -172,14 +429,39 @@ def d90_average21_and_add_noise():
                               
 
 def main():
-    """Run main function."""
+    """Run main function.
+
+    With --resume the iterations of the checkpoint manifest whose outputs
+    are unchanged are not run again.
+
+    With --check-rotation [i ...] only the stamps of the rotated case and
+    the rotated stamps of the normal case are compared (default 0 10 20).
+    """
+    resume = '--resume' in sys.argv[1:]
+    config = update_config()
+    set_stage_log(config.get('stage_log'))
+    set_stage_cache(config.get('stage_cache_dir'), config.get('stage_cache_size_gb', 20))
+    set_cache_scope()
+
+    # Only compare the rotated stamps with the stamps of jeditransform
+    if '--check-rotation' in sys.argv[1:]:
+        iterations = [int(a) for a in sys.argv[1:] if a.isdigit()] or [0, 10, 20]
+        flagged = d90_check_rotation(iterations)
+        print('%i galaxies differ above rotation_tolerance.' % len(flagged))
+        sys.exit(1 if flagged else 0)
+
+    start = time.time()
     
     # Run 7 programs in the loop
-    d90_run_7programs_loop()
+    d90_run_7programs_loop(resume)
     
     # Average 21 outputs and add noise to it.
     d90_average21_and_add_noise()
 
+    # Hits and misses of the stage cache
+    print_cache_stats()
+    log_span('a4', start)
+
     
 
 if __name__ == "__main__":
@@ -0,0 +1,328 @@
+#!python
+# -*- coding: utf-8 -*-
+"""Benchmark every program of the pipeline on synthetic inputs.
+
+:Info:
+
+  1. For each size (nx = ny) and number of galaxies, a scratch tree like the
+     one of a realization is made (see run_jedimaster.make_realization), but
+     with synthetic inputs:
+
+     - Sersic bulge (n=4) and disk (n=1) stamps with MAG, MAG0, RADIUS
+       and PIXSCALE headers in simdatabase/bulge_f8 and disk_f8.
+     - A gaussian psf/psf0.fits (psf1 to psf20 are links to it).
+     - physics_settings/lens.txt with one SIS lens at the center.
+
+  2. a1 and a2, one iteration of the loop of a3 and the averaging and noise
+     are run, and the stage log gives the time, memory and io of each program.
+  3. The results are written as json. With --compare, the wall times are
+     compared to a saved baseline and the slower stages are flagged.
+  4. With --stamp-codecs, each case is run for each stamp_codec and the
+     time of jeditransform and jedidistort is printed against the size
+     of the stamps, i.e. the cpu time of the compression against the disk.
+
+:Usage:
+
+  python benchmark.py
+  python benchmark.py --sizes 4096 --galaxies 1000 --out new.json
+  python benchmark.py --compare baseline.json new.json
+  python benchmark.py --sizes 4096 --galaxies 1000 --stamp-codecs none gzip
+
+:Runtime:
+
+  A few minutes for nx=4096 and 1000 galaxies, hours for all the sizes.
+
+"""
+# Imports
+from __future__ import print_function, unicode_literals, division, absolute_import
+import os
+import sys
+import json
+import shutil
+import time
+import numpy as np
+from util import run_process, read_stage_log, STAMP_CODECS
+from run_jedimaster import config_dict, config_path, make_realization
+
+# Global Variables
+SIZES = [4096, 8192, 12288]
+GALAXIES = [1000, 12420, 138000]
+NUM_SOURCES = 201
+MAG0 = 26.78212
+PIXSCALE = 0.06
+
+
+def sersic_image(size, n, re, ar, pa):
+    """Return a size x size Sersic profile of index n and unit flux.
+
+    re is the effective radius in pixels, ar the axis ratio and pa the
+    position angle in degrees.
+    """
+    bn = 2 * n - 1.0 / 3 + 4.0 / (405 * n)
+    y, x = np.indices((size, size)) - (size - 1) / 2.0
+    t = np.radians(pa)
+    u = x * np.cos(t) + y * np.sin(t)
+    v = (-x * np.sin(t) + y * np.cos(t)) / ar
+    r = np.hypot(u, v)
+    image = np.exp(-bn * ((r / re) ** (1.0 / n) - 1))
+    return (image / image.sum()).astype(np.float32)
+
+
+def half_light_radius(image):
+    """Return the radius in pixels around the center with half of the flux."""
+    size = image.shape[0]
+    y, x = np.indices(image.shape) - (size - 1) / 2.0
+    r = np.hypot(x, y).ravel()
+    order = np.argsort(r)
+    cumulative = np.cumsum(image.ravel()[order])
+    return r[order][np.searchsorted(cumulative, 0.5 * cumulative[-1])]
+
+
+def make_sources(folder, num_sources, seed=0):
+    """Write synthetic bulge and disk stamps with the headers of jedicatalog.
+
+    The magnitudes and radii cover the ranges of the f814w database
+    (19.5 to 25.9 mag, 1.3 to 22 pixels).
+    """
+    # Imports
+    from astropy.io import fits
+
+    rng = np.random.RandomState(seed)
+    for sub in ['bulge_f8', 'disk_f8']:
+        os.makedirs(os.path.join(folder, sub))
+
+    for i in range(num_sources):
+        mag = rng.uniform(19.5, 25.9)
+        radius = rng.uniform(1.3, 22.0)
+        size = int(min(601, 2 * int(8 * radius) + 1))
+        bulge_fraction = rng.uniform(0, 1)
+        ar, pa = rng.uniform(0.3, 1), rng.uniform(-90, 90)
+        flux = 10 ** (-0.4 * (mag - MAG0))
+        bulge = bulge_fraction * flux * sersic_image(size, 4, radius / 2, ar, pa)
+        disk = (1 - bulge_fraction) * flux * sersic_image(size, 1, radius, ar, pa)
+
+        header = fits.Header()
+        header['MAG'] = mag
+        header['MAG0'] = MAG0
+        header['PIXSCALE'] = PIXSCALE
+        header['RADIUS'] = half_light_radius(bulge + disk)
+        header['FLUX'] = flux
+        fits.writeto(os.path.join(folder, 'bulge_f8', 'f814w_bulge%d.fits' % i),
+                     bulge, header)
+        fits.writeto(os.path.join(folder, 'disk_f8', 'f814w_disk%d.fits' % i),
+                     disk, header)
+
+
+def make_psf(folder, size, sigma=2.0):
+    """Write a gaussian psf0.fits of size x size and link psf1 to psf20 to it."""
+    # Imports
+    from astropy.io import fits
+
+    y, x = np.indices((size, size)) - size // 2
+    psf = np.exp(-(x ** 2 + y ** 2) / (2 * sigma ** 2))
+    os.makedirs(folder)
+    fits.writeto(os.path.join(folder, 'psf0.fits'), (psf / psf.sum()).astype(np.float32))
+    for i in range(1, 21):
+        os.symlink('psf0.fits', os.path.join(folder, 'psf%d.fits' % i))
+
+
+def make_benchmark(workdir, nx, num_galaxies, psf_size, num_sources=NUM_SOURCES,
+                   stamp_codec='gzip'):
+    """Make the scratch tree of one benchmark case inside workdir."""
+    config = config_dict(config_path)
+    values = {'nx': nx, 'ny': nx, 'num_galaxies': num_galaxies,
+              'num_source_images': num_sources, 'stamp_codec': stamp_codec,
+              'stage_cache_dir': '', 'trace_file': '',
+              'parallel_iterations': 0,
+              'stage_log': os.path.abspath(os.path.join(workdir, 'stage_log.jsonl'))}
+    make_realization(workdir, config, values)
+
+    # Synthetic inputs instead of the links
+    for path in ['psf', 'simdatabase/bulge_f8', 'simdatabase/disk_f8']:
+        os.remove(os.path.join(workdir, path))
+    make_sources(os.path.join(workdir, 'simdatabase'), num_sources)
+    make_psf(os.path.join(workdir, 'psf'), psf_size)
+
+    settings = os.path.join(workdir, 'physics_settings')
+    with open(os.path.join(settings, 'lens.txt'), 'w') as f:
+        f.write('%d %d 1 1000.000000 4.000000\n' % (nx // 2, nx // 2))
+    for name, outfolder in [('color.txt', config['color_outfolder']),
+                            ('color90.txt', config['color_outfolder90'])]:
+        with open(os.path.join(settings, name), 'w') as f:
+            for i in range(num_sources):
+                f.write('simdatabase/bulge_f8/f814w_bulge%d.fits  '
+                        'simdatabase/disk_f8/f814w_disk%d.fits  '
+                        '%s/bdf8_%d.fits\n' % (i, i, outfolder, i))
+
+    # jedicatalog reads the source images from the image lines
+    path = os.path.join(settings, 'config.sh')
+    with open(path) as f:
+        lines = [line for line in f if not line.startswith('image=')]
+    with open(path, 'w') as f:
+        f.writelines(lines)
+        for i in range(num_sources):
+            f.write('image="%s/bdf8_%d.fits"\n' % (config['color_outfolder'], i))
+
+
+def run_benchmark(workdir):
+    """Run the programs of one case and return the records of the stage log.
+
+    Only the first of the 21 iterations is run, the average reads its
+    output 21 times.
+    """
+    python = sys.executable
+    run_process("a1_create_odirs.py", [python, "a1_create_odirs.py"], cwd=workdir)
+    run_process("a2_create_3catalogs.py", [python, "a2_create_3catalogs.py"], cwd=workdir)
+    run_process("a3 iteration 0", [python, "-c",
+                "import a3_jedisimulate as a3; a3.warm_distort_cache(a3.update_config()); "
+                "a3.run_7programs(0, a3.loop_files())"],
+                cwd=workdir)
+
+    rescaled = os.path.join(workdir, 'jedisim_out/rescaled_lsst/rescaled_lsst_%d.fits')
+    for i in range(1, 21):
+        os.symlink(os.path.basename(rescaled % 0), rescaled % i)
+    run_process("a3 average", [python, "-c",
+                "import a3_jedisimulate as a3; "
+                "a3.set_stage_log(a3.update_config()['stage_log']); "
+                "a3.average21_and_add_noise()"],
+                cwd=workdir)
+    return read_stage_log(os.path.join(workdir, 'stage_log.jsonl'))
+
+
+def stage_results(records):
+    """Return the calls, wall and cpu time, max rss and io of each program."""
+    stages = {}
+    for r in records:
+        if 'stage' not in r:
+            continue
+        s = stages.setdefault(r['stage'], {'calls': 0, 'wall_s': 0, 'cpu_s': 0,
+                                           'max_rss_kb': 0, 'read_bytes': 0,
+                                           'write_bytes': 0})
+        s['calls'] += 1
+        s['wall_s'] += r['wall_s']
+        s['cpu_s'] += r['user_s'] + r['sys_s']
+        s['max_rss_kb'] = max(s['max_rss_kb'], r['max_rss_kb'] or 0)
+        s['read_bytes'] += r['read_bytes'] or 0
+        s['write_bytes'] += r['write_bytes'] or 0
+    return stages
+
+
+def stamp_bytes(workdir):
+    """Return the bytes of the postage stamps of jeditransform in workdir."""
+    # Imports
+    import glob
+
+    return sum(os.path.getsize(path) for path in
+               glob.glob(os.path.join(workdir, 'jedisim_out/out0/stamp_*/*')))
+
+
+def benchmark(sizes, galaxies, psf_size, scratch, keep=False, codecs=('gzip',)):
+    """Run all the cases and return the results.
+
+    The cases of a stamp_codec other than gzip have its name as suffix.
+    """
+    results = {'created': time.ctime(),
+               'host': os.uname()[1],
+               'psf_size': psf_size,
+               'cases': {}}
+    for nx in sizes:
+        for num_galaxies in galaxies:
+            for codec in codecs:
+                case = 'nx%d_gal%d' % (nx, num_galaxies)
+                case += '_' + codec if codec != 'gzip' else ''
+                workdir = os.path.join(scratch, case) + '/'
+                print('Benchmark case: %s' % case)
+                make_benchmark(workdir, nx, num_galaxies, psf_size, stamp_codec=codec)
+                start = time.time()
+                records = run_benchmark(workdir)
+                results['cases'][case] = {'nx': nx, 'ny': nx,
+                                          'num_galaxies': num_galaxies,
+                                          'stamp_codec': codec,
+                                          'stamp_bytes': stamp_bytes(workdir),
+                                          'wall_s': time.time() - start,
+                                          'stages': stage_results(records)}
+                if not keep:
+                    shutil.rmtree(workdir)
+    return results
+
+
+def print_codecs(results):
+    """Print the time of the programs writing and reading the stamps of each stamp_codec."""
+    print("{:<20}{:<8}{:>12}{:>22}{:>22}".format(
+          'case', 'codec', 'stamps [MB]', 'jeditransform [s]', 'jedidistort [s]'))
+    print("{:<40}{:>11}{:>11}{:>11}{:>11}".format('', 'wall', 'cpu', 'wall', 'cpu'))
+    for case in sorted(results['cases']):
+        c = results['cases'][case]
+        times = []
+        for stage in ['jeditransform', 'jedidistort']:
+            s = c['stages'].get(stage, {'wall_s': 0, 'cpu_s': 0})
+            times += [s['wall_s'], s['cpu_s']]
+        print("{:<20}{:<8}{:>12.1f}{:>11.2f}{:>11.2f}{:>11.2f}{:>11.2f}".format(
+              case, c.get('stamp_codec', 'gzip'), c.get('stamp_bytes', 0) / 1e6, *times))
+
+
+def compare(baseline, results, tolerance=0.1, min_seconds=1.0):
+    """Print the wall time of each stage against the baseline.
+
+    A stage is a regression if it is slower by more than tolerance and by
+    more than min_seconds. Returns the list of (case, stage) regressions.
+    """
+    regressions = []
+    print("{:<20}{:<16}{:>12}{:>12}{:>9}".format('case', 'stage', 'base [s]',
+                                                 'new [s]', 'ratio'))
+    for case in sorted(results['cases']):
+        if case not in baseline['cases']:
+            continue
+        old = baseline['cases'][case]['stages']
+        new = results['cases'][case]['stages']
+        for stage in sorted(set(old) & set(new)):
+            t0, t1 = old[stage]['wall_s'], new[stage]['wall_s']
+            ratio = t1 / t0 if t0 > 0 else float('inf')
+            slower = t1 > t0 * (1 + tolerance) and t1 - t0 > min_seconds
+            if slower:
+                regressions.append((case, stage))
+            print("{:<20}{:<16}{:>12.2f}{:>12.2f}{:>9.2f}{}".format(
+                  case, stage, t0, t1, ratio, '  <-- slower' if slower else ''))
+    return regressions
+
+
+def main():
+    """Run main function."""
+    # Imports
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--galaxies', type=int, nargs='+', default=GALAXIES)
+    parser.add_argument('--psf-size', type=int, default=4001)
+    parser.add_argument('--scratch', default='jedisim_out/benchmark/')
+    parser.add_argument('--out', default='jedisim_out/benchmark.json')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the scratch trees')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'))
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--stamp-codecs', nargs='+', default=['gzip'],
+                        choices=sorted(STAMP_CODECS),
+                        help='stamp_codec values to run each case with')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            results = json.load(f)
+        regressions = compare(baseline, results, args.tolerance)
+        print('%i regressions.' % len(regressions))
+        sys.exit(1 if regressions else 0)
+
+    results = benchmark(args.sizes, args.galaxies, args.psf_size,
+                        args.scratch, args.keep, args.stamp_codecs)
+    if len(args.stamp_codecs) > 1:
+        print_codecs(results)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results written to %s' % args.out)
+
+
+if __name__ == "__main__":
+    main()
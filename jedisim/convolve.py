@@ -0,0 +1,345 @@
+#!python
+# -*- coding: utf-8 -*-
+"""Convolution of the HST image with a psf, in-process with real FFTs.
+
+:Info:
+
+  1. jediconvolve transforms bands of BANDHEIGHT rows of HST.fits, padded
+     by the psf size, with single-threaded FFTW, transposing each band to
+     row-major order and back, and writes each convolved band to its own
+     file. jedipaste then adds the bands into HST_convolved.fits.
+  2. convolve_image reads HST.fits memory-mapped, where the rows of the
+     FITS image are already the rows of the NumPy array, and convolves it
+     by overlap-save in tiles with real-to-complex FFTs (scipy.fft if SciPy
+     is installed, else numpy.fft), on workers threads, one tile each.
+     Each tile of the output is the valid part of the circular convolution
+     of the input tile grown by the psf size less one pixel, and is written
+     once to the memory-mapped output image, with the same centre of the
+     psf as jediconvolve, (px/2, py/2), so there are no band files and no
+     transposes.
+  3. The FFT shape of the tiles is chosen among the 2, 3, 5 smooth lengths
+     whose valid part is at least TILE_PSF times the psf (or the whole
+     image): the one with the least FFT time on workers threads, with as
+     many tiles at once as fit in half of the available memory, each tile
+     transformed on workers / tiles at once threads. A lack of memory runs
+     fewer tiles at once, it never shrinks the tiles. The shape depends on
+     the psf size, not on BANDHEIGHT. The spectrum of the psf is computed
+     once.
+  4. With a cache folder (psf_spectrum_cache in config.sh), the spectrum of
+     each psf is stored there as a .npy file named by the hash of the psf
+     file, the padded shape and the dtype, and memory-mapped by the next
+     convolutions with the same psf and shape: iterations, both cases and
+     realizations. The least recently used spectra are removed when the
+     folder is larger than psf_spectrum_cache_gb.
+
+:Usage:
+
+  Set fft_convolve=1 in config.sh (on fft_workers threads, 0 for all the
+  cores), a3 and a4 use it instead of jediconvolve and jedipaste.
+
+  python convolve.py HST.fits psf/psf0.fits HST_convolved.fits --workers 4
+  python convolve.py HST.fits psf/psf0.fits HST_convolved.fits --cache jedisim_out/psf_spectra/
+
+  With --check, HST.fits is convolved with the psf and with the psf less
+  its last row and column, an even and an odd size, by convolve_image and
+  by jediconvolve and jedipaste, and the outputs are compared:
+
+  python convolve.py HST.fits psf/psf0.fits HST_convolved.fits --check
+
+"""
+# Imports
+from __future__ import print_function, unicode_literals, division, absolute_import
+import os
+import sys
+import math
+import numpy as np
+from util import file_hash, available_memory, resolve_fits
+from util import run_process, compare_images
+
+# Global Variables
+FITS_BLOCK = 2880
+f32 = np.float32
+c64 = np.complex64      # dtype of the spectra
+TILE_BYTES = 24         # bytes per pixel of the FFT shape of a tile being convolved
+TILE_PSF = 2            # least valid part of a tile, in psf sizes
+
+
+def fast_length(n):
+    """Return the smallest 2**a * 3**b * 5**c >= n, a fast FFT length."""
+    best = 2 * n
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p = p35
+            while p < n:
+                p *= 2
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def smooth_lengths(lo, hi):
+    """Return the 2**a * 3**b * 5**c from fast_length(lo) to fast_length(hi)."""
+    hi = fast_length(hi)
+    lengths = []
+    p5 = 1
+    while p5 <= hi:
+        p35 = p5
+        while p35 <= hi:
+            p = p35
+            while p <= hi:
+                if p >= lo:
+                    lengths.append(p)
+                p *= 2
+            p35 *= 3
+        p5 *= 5
+    return sorted(lengths)
+
+
+def tile_shape(ny, nx, py, px, workers, memory):
+    """Return the FFT shape of the tiles for a ny x nx image and a py x px psf.
+
+    A tile of shape (ly, lx) gives ly - py + 1 by lx - px + 1 output pixels,
+    at least TILE_PSF psf sizes or the whole image in each direction.
+    Returns the shape with the least FFT time on workers threads and the
+    number of tiles convolved at once, such that these tiles and the
+    spectrum of the psf fit in memory bytes (one tile if none fits).
+    """
+    best, plan = None, None
+    smallest = None
+    for ly in smooth_lengths(py + min(ny, TILE_PSF * py) - 1, ny + py - 1):
+        for lx in smooth_lengths(px + min(nx, TILE_PSF * px) - 1, nx + px - 1):
+            tiles = math.ceil(ny / (ly - py + 1)) * math.ceil(nx / (lx - px + 1))
+            by_memory = int((memory - 4 * ly * lx) // (TILE_BYTES * ly * lx))
+            if by_memory < 1:
+                if smallest is None or ly * lx < smallest[0][0] * smallest[0][1]:
+                    smallest = ((ly, lx), 1)
+                continue
+            # Rounds of tiles at once, each tile on workers / at once threads
+            at_once = min(workers, tiles, by_memory)
+            time = (math.ceil(tiles / at_once) * ly * lx * math.log(ly * lx)
+                    / max(1, workers // at_once))
+            if best is None or time < best:
+                best, plan = time, ((ly, lx), at_once)
+    return plan or smallest
+
+
+def fft_functions(workers):
+    """Return rfft2 and irfft2, on workers threads if SciPy is installed."""
+    try:
+        # Imports
+        import scipy.fft
+    except ImportError:
+        return np.fft.rfft2, np.fft.irfft2
+
+    def rfft2(a, s):
+        return scipy.fft.rfft2(a, s=s, workers=workers)
+
+    def irfft2(a, s):
+        return scipy.fft.irfft2(a, s=s, workers=workers)
+    return rfft2, irfft2
+
+
+def psf_spectrum(psf_file, shape, rfft2, cache='', max_bytes=0):
+    """Return the half-complex spectrum of psf_file zero-padded to shape.
+
+    With a cache folder the spectrum is memory-mapped from there, or
+    computed and stored there first, see evict_spectra.
+    """
+    # Imports
+    from astropy.io import fits
+
+    psf_file = resolve_fits(psf_file)
+    if not cache:
+        return rfft2(fits.getdata(psf_file).astype(f32), shape).astype(c64)
+
+    name = 'psf_%s_%ix%i_%s.npy' % (file_hash(psf_file)[:16], shape[0], shape[1],
+                                    np.dtype(c64).name)
+    path = os.path.join(cache, name)
+    try:
+        spectrum = np.load(path, mmap_mode='r')
+        # mark as recently used
+        os.utime(path, None)
+        return spectrum
+    except (IOError, OSError, ValueError):
+        pass
+
+    # Write to a temporary file and rename it, so other processes never
+    # memory-map half written spectra
+    spectrum = rfft2(fits.getdata(psf_file).astype(f32), shape).astype(c64)
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+    tmp = os.path.join(cache, 'tmp_%i_%s' % (os.getpid(), name))
+    np.save(tmp, spectrum)
+    os.rename(tmp, path)
+    evict_spectra(cache, max_bytes)
+    return spectrum
+
+
+def evict_spectra(cache, max_bytes):
+    """Remove the least recently used spectra until cache holds max_bytes."""
+    spectra = []
+    for name in os.listdir(cache):
+        path = os.path.join(cache, name)
+        if name.startswith('psf_') and name.endswith('.npy'):
+            try:
+                spectra.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                continue
+    total = sum(spectrum[1] for spectrum in spectra)
+    for mtime, size, path in sorted(spectra):
+        if total <= max_bytes:
+            break
+        print('PSF spectrum cache: removing %s (%.1f MB).' % (path, size / 1e6))
+        try:
+            os.remove(path)
+        except OSError:
+            # removed by another process
+            pass
+        total -= size
+
+
+def create_image(path, ny, nx):
+    """Create a float32 FITS image of zeros and return its data memory-mapped."""
+    # Imports
+    from astropy.io import fits
+
+    header = fits.PrimaryHDU(data=np.zeros((1, 1), dtype=f32)).header
+    header['NAXIS1'] = nx
+    header['NAXIS2'] = ny
+    header.tofile(path, overwrite=True)
+    offset = len(header.tostring())
+    with open(path, 'rb+') as f:
+        f.truncate(offset + FITS_BLOCK * ((4 * nx * ny + FITS_BLOCK - 1) // FITS_BLOCK))
+    return np.memmap(path, dtype='>f4', mode='r+', offset=offset, shape=(ny, nx))
+
+
+def convolve_image(image_file, psf_file, out_file, workers=0, cache='', cache_bytes=0):
+    """Convolve image_file with psf_file into out_file, like jediconvolve and jedipaste.
+
+    Pixel (x, y) of out_file is the sum of psf[j, i] * image[y + cy - j, x + cx - i],
+    cx, cy = px // 2, py // 2 being the centre of the psf of jediconvolve.
+    cache and cache_bytes are the folder and size of the psf spectrum cache.
+    """
+    # Imports
+    from astropy.io import fits
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = workers or os.cpu_count()
+    psf_file = resolve_fits(psf_file)
+    header = fits.getheader(psf_file)
+    py, px = header['NAXIS2'], header['NAXIS1']
+    cy, cx = py // 2, px // 2
+
+    with fits.open(image_file, memmap=True) as hdus:
+        image = hdus[0].data
+        ny, nx = image.shape
+        shape, at_once = tile_shape(ny, nx, py, px, workers, available_memory() / 2)
+        ty, tx = shape[0] - py + 1, shape[1] - px + 1
+        rfft2, irfft2 = fft_functions(max(1, workers // at_once))
+        psf_hat = psf_spectrum(psf_file, shape, rfft2, cache, cache_bytes)
+        out = create_image(out_file, ny, nx)
+
+        def convolve_tile(y0, x0):
+            # Output rows y0 to y0 + ty are rows py - 1 to shape[0] of the circular
+            # convolution of the input rows from y0 + cy - py + 1, same for columns
+            tile = np.zeros(shape, dtype=f32)
+            ya, xa = y0 + cy - py + 1, x0 + cx - px + 1
+            y1, x1 = max(ya, 0), max(xa, 0)
+            y2, x2 = min(ya + shape[0], ny), min(xa + shape[1], nx)
+            tile[y1 - ya:y2 - ya, x1 - xa:x2 - xa] = image[y1:y2, x1:x2]
+            conv = irfft2(rfft2(tile, shape) * psf_hat, shape)
+            rows, cols = min(ty, ny - y0), min(tx, nx - x0)
+            out[y0:y0 + rows, x0:x0 + cols] = conv[py - 1:py - 1 + rows, px - 1:px - 1 + cols]
+
+        with ThreadPoolExecutor(max_workers=at_once) as pool:
+            futures = [pool.submit(convolve_tile, y0, x0)
+                       for y0 in range(0, ny, ty) for x0 in range(0, nx, tx)]
+        for future in futures:
+            future.result()
+        out.flush()
+        del out
+
+
+def check_convolution(image_file, psf_file, workdir, workers=0, tolerance=1e-5):
+    """Compare convolve_image with jediconvolve and jedipaste for two psf sizes.
+
+    The psf and the psf less its last row and column are used, so that both
+    an even and an odd size are checked in each direction. Returns the psf
+    sizes whose max residual relative to the peak is larger than tolerance.
+    """
+    # Imports
+    import shutil
+    from astropy.io import fits
+
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    psf = fits.getdata(resolve_fits(psf_file))
+    ny, nx = fits.getheader(image_file)['NAXIS2'], fits.getheader(image_file)['NAXIS1']
+
+    failed = []
+    print("{:>12}{:>14}{:>14}{:>14}".format('psf', 'flux ratio',
+                                            'L1 residual', 'max residual'))
+    for k, data in enumerate([psf, psf[:-1, :-1]]):
+        path = os.path.join(workdir, 'psf_%d.fits' % k)
+        fits.writeto(path, data, overwrite=True)
+
+        # jediconvolve writes one band file per BANDHEIGHT rows, pasted by jedipaste
+        bands = os.path.join(workdir, 'bands_%d/' % k)
+        if not os.path.isdir(bands):
+            os.makedirs(bands)
+        run_process("jediconvolve", ['./executables/jediconvolve', image_file, path, bands])
+        band_list = os.path.join(workdir, 'bandlist_%d.txt' % k)
+        with open(band_list, 'w') as fo:
+            for name in sorted(os.listdir(bands)):
+                fo.write(os.path.join(bands, name) + '\n')
+        pasted = os.path.join(workdir, 'pasted_%d.fits' % k)
+        run_process("jedipaste", ['./executables/jedipaste', str(nx), str(ny),
+                                  band_list, pasted])
+
+        convolved = os.path.join(workdir, 'convolved_%d.fits' % k)
+        convolve_image(image_file, path, convolved, workers)
+        ratio, l1, peak = compare_images(pasted, convolved)
+        size = '%ix%i' % (data.shape[1], data.shape[0])
+        print("{:>12}{:>14.6f}{:>14.2e}{:>14.2e}".format(size, ratio, l1, peak))
+        if peak > tolerance:
+            failed.append(size)
+
+    shutil.rmtree(workdir)
+    return failed
+
+
+def main():
+    """Run main function."""
+    # Imports
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('image', help='FITS image to convolve, e.g. HST.fits')
+    parser.add_argument('psf', help='psf to convolve with')
+    parser.add_argument('output', help='convolved image, overwritten')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='threads of the FFTs, 0 for all the cores')
+    parser.add_argument('--cache', default='',
+                        help='folder of the psf spectrum cache')
+    parser.add_argument('--cache-gb', type=float, default=20,
+                        help='size of the psf spectrum cache')
+    parser.add_argument('--check', action='store_true',
+                        help='compare with jediconvolve and jedipaste for an even '
+                             'and an odd psf size, in the folder of output')
+    args = parser.parse_args()
+
+    if args.check:
+        workdir = os.path.join(os.path.dirname(os.path.abspath(args.output)), 'check_convolve/')
+        failed = check_convolution(args.image, args.psf, workdir, args.workers)
+        print('%i psf sizes above the tolerance.' % len(failed))
+        sys.exit(1 if failed else 0)
+
+    convolve_image(args.image, args.psf, args.output, args.workers,
+                   args.cache, args.cache_gb * 1e9)
+
+
+if __name__ == "__main__":
+    main()
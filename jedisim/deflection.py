@@ -0,0 +1,528 @@
+#!python
+# -*- coding: utf-8 -*-
+"""Deflection field of the lenses of lens.txt for jedidistort, with NumPy.
+
+:Info:
+
+  1. jedidistort sums the deflection of every lens of lens.txt at every
+     subpixel it samples, so its cost grows with pixels x lenses.
+  2. This module computes the deflection of the whole frame block by block
+     with NumPy and writes it to a field file, which jedidistort
+     memory-maps instead of summing the lenses (its 8th argument).
+     The field holds (alpha_x, alpha_y) at the subpixels (x + s/4, y + s/4),
+     s = 0..3, of every pixel, which are the points jedidistort samples.
+  3. With tolerance = 0 the lenses are summed one by one, in the order of
+     lens.txt and in float32 like get_alpha of jedidistort.
+  4. With tolerance > 0 the lenses are put in a quadtree. For each block of
+     the frame, a node of size s whose centroid is farther than s / tolerance
+     from the block is taken as one lens with the summed profile of its
+     lenses, tabulated on a log grid of radii. The other nodes are opened
+     down to the leaves, whose lenses are summed exactly. The cost per pixel
+     then grows with log(lenses) instead of lenses.
+  5. With a kappa map (kappa_map in config.sh) the field is computed from the
+     convergence instead of lens.txt, with one FFT Poisson solve on a grid
+     padded with zeros, in O(N log N) whatever the mass distribution.
+     The map is the convergence for D_ls/D_s = 1, jedidistort scales alpha
+     by D_ls/D_s of each galaxy as for the lenses.
+
+:Usage:
+
+  python deflection.py              # field of physics_settings/config.sh
+  python deflection.py --check 20   # error of deflection_tolerance on 20 blocks
+
+.. note::
+
+  The field takes 32 bytes per pixel (4.8 GB for 12288 x 12288), it is
+  written once per lens.txt, nx, ny, pix_scale, lens_z and tolerance (or
+  kappa map, nx and ny) in distort_cache (output_folder if distort_cache
+  is empty). The FFT of a kappa map needs about 100 bytes per pixel of the
+  map, a map coarser than the frame is interpolated.
+
+"""
+# Imports
+from __future__ import print_function, unicode_literals, division, absolute_import
+import os
+import sys
+import math
+import time
+import hashlib
+import numpy as np
+
+# Global Variables (the definitions of jedidistort.c)
+DR = 10             # lens table entries per pixel
+PI = 3.14159265
+C = 300000          # speed of light in km/s
+NSUBPX = 4          # subpixels sampled in each pixel
+OMEGA_M = 0.315
+OMEGA_D = 0.685
+OPZEQ = 3391
+C_H_0 = 4424.778
+G = 4.302
+MAGIC = b'JDFIELD1'     # first bytes of a field file, change it with the layout
+HEADER = 32             # magic, nx, ny, nsub as int64
+LEAF_SIZE = 8           # lenses in a leaf of the quadtree
+BLOCK = 64              # pixels on a side of the blocks of the tree walk
+NRADII = 2048           # radii of the tables of the nodes
+CHUNK = 64              # lenses or nodes summed at once
+f32 = np.float32
+
+
+def read_lenses(path):
+    """Return the columns x, y, type, p1, p2 of lens.txt."""
+    lenses = np.loadtxt(path, ndmin=2)
+    return (lenses[:, 0].astype(f32), lenses[:, 1].astype(f32),
+            lenses[:, 2].astype(int), lenses[:, 3].astype(f32),
+            lenses[:, 4].astype(f32))
+
+
+def angular_di_dist(z1, z2):
+    """Return the angular diameter distance in Mpc, as jedidistort does."""
+    dist, dz = f32(0), f32(0.001)
+    z = f32(1) + f32(z1)
+    while z < f32(1) + f32(z2):
+        dist = f32(float(dist) + float(dz) / math.sqrt(
+            OMEGA_M * (1.0 + float(z / f32(OPZEQ))) * float(z * z * z) + OMEGA_D))
+        z = f32(z + dz)
+    return f32(C_H_0 * float(dist) / float(z))
+
+
+def lens_constants(lenses, scale, zl):
+    """Return the constants of the tables of jedidistort for each lens.
+
+    Returns (sis, prefactor, x_per_rad, rad_per_px): the table of a SIS lens
+    is sis * DR / a and the one of a NFW lens follows from its prefactor
+    and x_per_rad. jedidistort fills the table of type 3 with the integer
+    division 1000/C, i.e. zeros, so does this function.
+    """
+    x, y, kind, p1, p2 = lenses
+    px_per_rad = f32(180.0 * 3600.0 / (PI * float(f32(scale))))
+    rad_per_px = f32(1) / px_per_rad
+    zl = f32(zl)
+
+    alpha = p1 / f32(C)
+    sis = (float(px_per_rad * f32(4)) * PI * alpha.astype(float) ** 2).astype(f32)
+    sis[kind != 1] = 0
+
+    prefactor = np.zeros(len(kind), f32)
+    x_per_rad = np.ones(len(kind), f32)
+    if np.any(kind == 2):
+        dl = angular_di_dist(0, zl)
+        opz = f32(1) + zl
+        inner = OMEGA_M * float(f32(1) + opz / f32(OPZEQ)) * float(opz) ** 3 + OMEGA_D
+        rs = (0.978146 * np.cbrt(p1).astype(float) * float(np.cbrt(f32(1 / inner)))
+              / p2.astype(float)).astype(f32)
+        rdelta_c = f32(1) / (np.log(f32(1) + p2) - p2 / (f32(1) + p2))
+        nfw = kind == 2
+        x_per_rad[nfw] = (dl / rs)[nfw]
+        prefactor[nfw] = (float(px_per_rad * f32(4)) * G * p1.astype(float)
+                          * rdelta_c.astype(float) / (float(f32(9) * dl) * 1E5))[nfw]
+    return sis, prefactor, x_per_rad, rad_per_px
+
+
+def profile(rad, sis, prefactor, x_per_rad, rad_per_px):
+    """Return alpha(r) / r of the lenses at rad = DR * r, as float32.
+
+    rad broadcasts against the constants of lens_constants, the entry
+    rad = 0 is 0 like in the tables of jedidistort.
+    """
+    rad = np.asarray(rad, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = (sis * f32(DR)) / rad.astype(f32)
+        nfw = prefactor != 0
+        if np.any(nfw):
+            theta = rad * float(rad_per_px) / DR
+            xvar = theta * x_per_rad.astype(float)
+            menc = np.log(xvar / 2) + np.where(
+                xvar < 1, 2 / np.sqrt(1 - xvar * xvar) * np.arctanh(np.sqrt((1 - xvar) / (1 + xvar))),
+                np.where(xvar > 1, 2 / np.sqrt(xvar * xvar - 1) * np.arctan(np.sqrt((xvar - 1) / (1 + xvar))), 1))
+            b = prefactor.astype(float) * menc * DR / (theta * rad)
+            out = np.where(nfw, b.astype(f32), out)
+    return np.where(rad > 0, out, f32(0)).astype(f32)
+
+
+def table_profile(rad, sis, prefactor, x_per_rad, rad_per_px):
+    """Return profile at the integer radii rad of shape (n, k), for k lenses.
+
+    Like in jedidistort, the profile of each lens is tabulated on the
+    radii it spans and looked up, instead of being evaluated at each subpixel.
+    """
+    lo = rad.min(axis=0)
+    span = int((rad.max(axis=0) - lo).max()) + 1
+    table = profile(lo[:, None] + np.arange(span), sis[:, None], prefactor[:, None],
+                    x_per_rad[:, None], rad_per_px)
+    return table[np.arange(rad.shape[1]), (rad - lo).astype(int)]
+
+
+def subpixels(x0, x1, y0, y1):
+    """Return the x and y of the subpixels of the pixels [x0, x1) x [y0, y1).
+
+    The arrays have the layout of the field, (y, x, s).
+    """
+    s = np.arange(NSUBPX)
+    x = (f32(4) * np.arange(x0, x1)[None, :, None] + s).astype(f32) / f32(NSUBPX)
+    y = (f32(4) * np.arange(y0, y1)[:, None, None] + s).astype(f32) / f32(NSUBPX)
+    return np.broadcast_to(x, (y1 - y0, x1 - x0, NSUBPX)), \
+        np.broadcast_to(y, (y1 - y0, x1 - x0, NSUBPX))
+
+
+def exact_alpha(x, y, lenses, constants):
+    """Return the deflection of all the lenses at x, y.
+
+    The lenses are added one at a time in float32 and the radius is rounded
+    to the table entry, so with all the lenses the result is the one of
+    get_alpha in jedidistort.
+    """
+    lx, ly = lenses[0], lenses[1]
+    sis, prefactor, x_per_rad, rad_per_px = constants
+    ax = np.zeros(x.shape, f32)
+    ay = np.zeros(x.shape, f32)
+    for k in range(len(lx)):
+        dx = x - lx[k]
+        dy = y - ly[k]
+        rad = np.floor(DR * np.sqrt((dx * dx + dy * dy).astype(float)) + 0.5)
+        one = slice(k, k + 1)
+        t = table_profile(rad.reshape(-1, 1), sis[one], prefactor[one],
+                          x_per_rad[one], rad_per_px).reshape(x.shape)
+        ax += t * dx
+        ay += t * dy
+    return ax, ay
+
+
+def build_tree(lenses, constants, tolerance, rmax):
+    """Return the nodes of the quadtree of the lenses.
+
+    Each node is a dictionary with its size, the lenses inside it, the
+    centroid of their deflection and their summed alpha(r)/r tabulated on
+    the log grid of radii of the tree.
+    """
+    lx, ly = lenses[0].astype(float), lenses[1].astype(float)
+    radii = np.geomspace(0.05, rmax, NRADII)
+    nodes = []
+
+    def add(index, x0, y0, size):
+        sis, prefactor, x_per_rad, rad_per_px = [c[index] if np.ndim(c) else c for c in constants]
+
+        # The centroid weighted by alpha(r)/r at the smallest distance the node
+        # is used from cancels the first order of the offsets of the lenses
+        r_open = min(size / tolerance, rmax)
+        w = profile(DR * r_open, sis, prefactor, x_per_rad, rad_per_px).astype(float)
+        if w.sum() <= 0:
+            w = np.ones(len(index))
+        node = {'size': size, 'index': index, 'children': [],
+                'cx': np.dot(w, lx[index]) / w.sum(),
+                'cy': np.dot(w, ly[index]) / w.sum()}
+        nodes.append(node)
+
+        # The table of a node is the sum of the tables of its children
+        if len(index) > LEAF_SIZE and size > 1:
+            half = size / 2
+            right = lx[index] >= x0 + half
+            top = ly[index] >= y0 + half
+            for mask, qx, qy in [(~right & ~top, x0, y0), (right & ~top, x0 + half, y0),
+                                 (~right & top, x0, y0 + half), (right & top, x0 + half, y0 + half)]:
+                if np.any(mask):
+                    node['children'].append(add(index[mask], qx, qy, half))
+            node['sum'] = sum(child.pop('sum') for child in node['children'])
+        else:
+            node['sum'] = profile(DR * radii[:, None], sis, prefactor, x_per_rad,
+                                  rad_per_px).sum(axis=1, dtype=float)
+        node['table'] = np.log(np.maximum(node['sum'], 1e-300))
+        return node
+
+    x0, y0 = lx.min(), ly.min()
+    add(np.arange(len(lx)), x0, y0, max(1.0, lx.max() - x0, ly.max() - y0) * (1 + 1e-6))
+    nodes[0].pop('sum')
+    return nodes, np.log(radii)
+
+
+def walk(node, box, tolerance, far, near):
+    """Sort the nodes into far nodes and near lenses for the block box.
+
+    box is (x0, x1, y0, y1) in pixels.
+    """
+    dx = max(box[0] - node['cx'], 0, node['cx'] - box[1])
+    dy = max(box[2] - node['cy'], 0, node['cy'] - box[3])
+    if node['size'] < tolerance * math.hypot(dx, dy):
+        far.append(node)
+    elif node['children']:
+        for child in node['children']:
+            walk(child, box, tolerance, far, near)
+    else:
+        near.extend(node['index'])
+
+
+def tree_alpha(x, y, box, lenses, constants, tree, tolerance):
+    """Return the deflection at the subpixels x, y of the block box.
+
+    The far nodes are interpolated in their tables (linear in log-log,
+    exact for SIS lenses), the near lenses are summed exactly.
+    """
+    nodes, log_radii = tree
+    far, near = [], []
+    walk(nodes[0], box, tolerance, far, near)
+
+    sis, prefactor, x_per_rad, rad_per_px = constants
+    lx, ly = lenses[0], lenses[1]
+    x = x.reshape(-1, 1).astype(float)
+    y = y.reshape(-1, 1).astype(float)
+    ax = np.zeros(len(x))
+    ay = np.zeros(len(x))
+    step = log_radii[1] - log_radii[0]
+    for k in range(0, len(far), CHUNK):
+        chunk = far[k:k + CHUNK]
+        tables = np.array([node['table'] for node in chunk])
+        dx = x - np.array([node['cx'] for node in chunk])
+        dy = y - np.array([node['cy'] for node in chunk])
+        u = np.clip((0.5 * np.log(dx * dx + dy * dy) - log_radii[0]) / step, 0, NRADII - 1.001)
+        i = u.astype(int)
+        rows = np.arange(len(chunk))
+        t = np.exp(tables[rows, i] * (i + 1 - u) + tables[rows, i + 1] * (u - i))
+        ax += (t * dx).sum(axis=1)
+        ay += (t * dy).sum(axis=1)
+    near = np.array(near, dtype=int)
+    for k in range(0, len(near), CHUNK):
+        index = near[k:k + CHUNK]
+        dx = x.astype(f32) - lx[index]
+        dy = y.astype(f32) - ly[index]
+        rad = np.floor(DR * np.sqrt((dx * dx + dy * dy).astype(float)) + 0.5)
+        t = table_profile(rad, sis[index], prefactor[index], x_per_rad[index], rad_per_px)
+        ax += (t * dx).sum(axis=1)
+        ay += (t * dy).sum(axis=1)
+    return ax, ay
+
+
+def frame_radius(lenses, nx, ny):
+    """Return the largest distance between a lens and a pixel of the frame."""
+    dx = np.maximum(np.abs(lenses[0]), np.abs(nx - lenses[0]))
+    dy = np.maximum(np.abs(lenses[1]), np.abs(ny - lenses[1]))
+    return float(np.hypot(dx, dy).max()) + 1
+
+
+def open_field(tmp, nx, ny):
+    """Create the field file tmp of an nx x ny frame and return it memory-mapped.
+
+    The file is a 32 byte header (magic, nx, ny, NSUBPX as int64) followed
+    by float32 (alpha_x, alpha_y) with the layout (ny, nx, NSUBPX, 2).
+    """
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + np.array([nx, ny, NSUBPX], dtype=np.int64).tobytes())
+        f.truncate(HEADER + ny * nx * NSUBPX * 2 * 4)
+    return np.memmap(tmp, dtype=f32, mode='r+', offset=HEADER, shape=(ny, nx, NSUBPX, 2))
+
+
+def load_field(path):
+    """Return the field file path memory-mapped read-only, with the layout (ny, nx, NSUBPX, 2)."""
+    header = np.fromfile(path, dtype=np.int64, count=HEADER // 8)
+    if header[:1].tobytes() != MAGIC or header[3] != NSUBPX:
+        print('Error: %s is not a deflection field.' % path)
+        sys.exit(1)
+    nx, ny = int(header[1]), int(header[2])
+    return np.memmap(path, dtype=f32, mode='r', offset=HEADER, shape=(ny, nx, NSUBPX, 2))
+
+
+def write_field(path, lenses, nx, ny, scale, zl, tolerance):
+    """Write the deflection field of the lenses for an nx x ny frame.
+
+    It is written through a temporary file.
+    """
+    constants = lens_constants(lenses, scale, zl)
+    tmp = '%s.tmp.%i' % (path, os.getpid())
+    field = open_field(tmp, nx, ny)
+
+    if tolerance > 0:
+        tree = build_tree(lenses, constants, tolerance, frame_radius(lenses, nx, ny))
+        for y0 in range(0, ny, BLOCK):
+            for x0 in range(0, nx, BLOCK):
+                y1, x1 = min(ny, y0 + BLOCK), min(nx, x0 + BLOCK)
+                x, y = subpixels(x0, x1, y0, y1)
+                ax, ay = tree_alpha(x, y, (x0, x1, y0, y1), lenses, constants, tree, tolerance)
+                field[y0:y1, x0:x1, :, 0] = ax.reshape(x.shape)
+                field[y0:y1, x0:x1, :, 1] = ay.reshape(x.shape)
+    else:
+        rows = max(1, (1 << 20) // (NSUBPX * nx))
+        for y0 in range(0, ny, rows):
+            y1 = min(ny, y0 + rows)
+            x, y = subpixels(0, nx, y0, y1)
+            field[y0:y1, :, :, 0], field[y0:y1, :, :, 1] = exact_alpha(x, y, lenses, constants)
+    field.flush()
+    del field
+    os.rename(tmp, path)
+
+
+def kappa_deflection(kappa):
+    """Return the deflection (alpha_x, alpha_y) of a convergence map.
+
+    alpha is the convolution of kappa with x / (pi |x|^2), in pixels of
+    the map. It is computed by FFT on a grid padded with zeros to twice
+    the map, so that the mass on one side does not wrap to the other.
+    """
+    ky, kx = kappa.shape
+    py, px = 2 * ky, 2 * kx
+    x = np.fft.fftfreq(px, 1.0 / px)[None, :]
+    y = np.fft.fftfreq(py, 1.0 / py)[:, None]
+    r2 = x * x + y * y
+    r2[0, 0] = np.inf
+    kappa_hat = np.fft.rfft2(kappa, s=(py, px))
+    alpha = []
+    for d in [x, y]:
+        kernel_hat = np.fft.rfft2(d / (np.pi * r2))
+        kernel_hat *= kappa_hat
+        alpha.append(np.fft.irfft2(kernel_hat, s=(py, px))[:ky, :kx].astype(f32))
+        del kernel_hat
+    return alpha
+
+
+def bilinear(image, u, v):
+    """Return image at the fractional indices u (x) and v (y), clamped at the edges."""
+    ny, nx = image.shape
+    u = np.clip(u, 0, nx - 1)
+    v = np.clip(v, 0, ny - 1)
+    i = np.minimum(u.astype(int), max(nx - 2, 0))
+    j = np.minimum(v.astype(int), max(ny - 2, 0))
+    fu, fv = u - i, v - j
+    i1, j1 = np.minimum(i + 1, nx - 1), np.minimum(j + 1, ny - 1)
+    return ((image[j, i] * (1 - fu) + image[j, i1] * fu) * (1 - fv)
+            + (image[j1, i] * (1 - fu) + image[j1, i1] * fu) * fv)
+
+
+def write_kappa_field(path, kappa_file, nx, ny):
+    """Write the deflection field of the convergence map kappa_file.
+
+    The map covers the nx x ny frame with square pixels of nx / NAXIS1
+    frame pixels, its deflection is interpolated bilinearly at the subpixels.
+    """
+    # Imports
+    from astropy.io import fits
+
+    kappa = fits.getdata(kappa_file).astype(float)
+    scale = nx / kappa.shape[1]
+    if kappa.ndim != 2 or abs(ny / kappa.shape[0] - scale) > 1e-6:
+        print('Error: the kappa map %s of shape %s does not cover the (%i, %i) frame '
+              'with square pixels.' % (kappa_file, kappa.shape, nx, ny))
+        sys.exit(1)
+    alpha = kappa_deflection(kappa)
+    del kappa
+
+    tmp = '%s.tmp.%i' % (path, os.getpid())
+    field = open_field(tmp, nx, ny)
+    rows = max(1, (1 << 20) // (NSUBPX * nx))
+    for y0 in range(0, ny, rows):
+        y1 = min(ny, y0 + rows)
+        x, y = subpixels(0, nx, y0, y1)
+        u, v = x / scale - 0.5, y / scale - 0.5
+        for k in range(2):
+            field[y0:y1, :, :, k] = scale * bilinear(alpha[k], u, v)
+    field.flush()
+    del field
+    os.rename(tmp, path)
+
+
+def field_path(config):
+    """Return the path of the field file of config.
+
+    The name is a hash of lens.txt (or the kappa map) and the parameters
+    the field depends on.
+    """
+    h = hashlib.sha256()
+    kappa_map = config.get('kappa_map', '')
+    with open(kappa_map or config['lenses_file'], 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    if kappa_map:
+        h.update(' '.join([MAGIC.decode(), 'kappa', config['nx'], config['ny']]).encode())
+    else:
+        h.update(' '.join([MAGIC.decode(), config['nx'], config['ny'], config['pix_scale'],
+                           config['lens_z'], config.get('deflection_tolerance', '0')]).encode())
+    folder = config.get('distort_cache', '') or config['output_folder']
+    return os.path.join(folder, 'deflection_%s.f32' % h.hexdigest()[:16])
+
+
+def field_file(config):
+    """Return the field file of config, computing it if it is not there yet.
+
+    A lock file makes a3 and a4 wait for each other instead of both
+    computing the same field.
+    """
+    # Imports
+    import fcntl
+    from util import log_span
+
+    path = field_path(config)
+    if os.path.exists(path):
+        return path
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            start = time.time()
+            if config.get('kappa_map', ''):
+                write_kappa_field(path, config['kappa_map'],
+                                  int(config['nx']), int(config['ny']))
+            else:
+                write_field(path, read_lenses(config['lenses_file']),
+                            int(config['nx']), int(config['ny']),
+                            float(config['pix_scale']), float(config['lens_z']),
+                            float(config.get('deflection_tolerance', 0)))
+            log_span('deflection', start)
+    return path
+
+
+def check_tolerance(config, nblocks, seed=0):
+    """Print the error of deflection_tolerance against the exact sum.
+
+    Both are computed on nblocks random blocks of the frame, the error is
+    given in pixels of deflection.
+    """
+    lenses = read_lenses(config['lenses_file'])
+    nx, ny = int(config['nx']), int(config['ny'])
+    tolerance = float(config.get('deflection_tolerance', 0))
+    constants = lens_constants(lenses, float(config['pix_scale']), float(config['lens_z']))
+    if tolerance <= 0:
+        print('deflection_tolerance is 0, the field is exact.')
+        return
+    tree = build_tree(lenses, constants, tolerance, frame_radius(lenses, nx, ny))
+
+    rng = np.random.RandomState(seed)
+    errors, norms = [], []
+    t_exact = t_tree = 0
+    for _ in range(nblocks):
+        x0 = rng.randint(0, max(1, nx - BLOCK))
+        y0 = rng.randint(0, max(1, ny - BLOCK))
+        box = (x0, min(nx, x0 + BLOCK), y0, min(ny, y0 + BLOCK))
+        x, y = subpixels(*box)
+        start = time.time()
+        ex, ey = exact_alpha(x, y, lenses, constants)
+        t_exact += time.time() - start
+        start = time.time()
+        ax, ay = tree_alpha(x, y, box, lenses, constants, tree, tolerance)
+        t_tree += time.time() - start
+        errors.append(np.hypot(ax - ex.ravel(), ay - ey.ravel()))
+        norms.append(np.hypot(ex.ravel(), ey.ravel()))
+    errors, norms = np.concatenate(errors), np.concatenate(norms)
+    print('%i lenses, %i nodes, tolerance %g' % (len(lenses[0]), len(tree[0]), tolerance))
+    print('max error %.3g px, rms error %.3g px, rms deflection %.3g px'
+          % (errors.max(), np.sqrt(np.mean(errors ** 2)), np.sqrt(np.mean(norms ** 2))))
+    print('time per block: exact %.3f s, tree %.3f s' % (t_exact / nblocks, t_tree / nblocks))
+
+
+def main():
+    """Run main function."""
+    # Imports
+    import argparse
+    from run_jedimaster import config_dict, config_path
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--check', type=int, metavar='NBLOCKS',
+                        help='compare the tolerance to the exact sum on random blocks')
+    args = parser.parse_args()
+
+    config = config_dict(config_path)
+    if args.check:
+        check_tolerance(config, args.check)
+    else:
+        print('Deflection field: %s' % field_file(config))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,8 @@
 # Author      : Bhishan Poudel, Physics PhD Student, Ohio University
 # Last update : Jun 10, 2017 Sat
 #
-# Info: This program will create four output text files, viz.
-#       config.sh, color.txt, rescaled_lsst_outfile.txt,
+# Info: This program will create five output text files, viz.
+#       config.sh, color.txt, color90.txt, rescaled_lsst_outfile.txt,
 #       and rescaled_lsst_outfile90.txt inside ../physics_settings directory.
 #
 # Imports
@@ -46,8 +46,11 @@ def gen_color_txt():
     """
     sim          = 'simdatabase/'
     outfile      = "../physics_settings/color.txt"
+    outfile90    = "../physics_settings/color90.txt"
     print('Creating : %s'%(outfile))  
-    with open(outfile, 'w') as fout:
+    print('Creating : %s'%(outfile90))  
+    with open(outfile, 'w') as fout, \
+         open(outfile90, 'w') as fout90:
         for i in range(NUM_GALS):
             in1  = sim + 'bulge_f8/f814w_bulge'         + str(i) + '.fits'
             in2  = sim + 'disk_f8/f814w_disk'           + str(i) + '.fits'
@@ -56,6 +59,11 @@ def gen_color_txt():
             line = '  '.join([in1, in2, out])
             print(line, file=fout)
 
+            # rotated case writes to its own folder (a3 and a4 run together)
+            out90 = sim + 'bulge_disk_f8_90/bdf8_' + str(i) + '.fits'
+            line  = '  '.join([in1, in2, out90])
+            print(line, file=fout90)
+
 
 
 def gen_rescaled_lsst_ofile():
@@ -39,6 +39,7 @@ num_galaxies=12420  # number of galaxies to simulate 138,000 default
 min_mag=22          # minimum magnitude galaxy to simulate (inclusive)
 max_mag=28          # maximum magnitude galaxy to simulate (inclusive)
 power=0.33          # power for the power law galaxy distribution
+seed=0              # jedicatalog random seed, 0 = seed from the clock
 # For the f814 filter for our 201 galaxy images
 #minmag   =  19.4715 # f814w_gal_19.fits
 #maxmag   =  25.9455 # f814w_gal_214.fits
@@ -83,6 +84,14 @@ rescaled_outfolder="jedisim_out/rescaled_lsst"
 rescaled_lsst_outfile="physics_settings/rescaled_lsst_outfile.txt" # jediavg
 monochromatic_infits="jedisim_out/rescaled_lsst/rescaled_lsst_10.fits"
 monochromatic_outfits="jedisim_out/rescaled_lsst/rescaled_noised_lsst_10.fits"
+# stamp_codec is the compression of the postage stamps of jeditransform, which
+# are written and read once in each iteration: "gzip" (stamp_*.fits.gz) or
+# "none" (stamp_*.fits, no cpu time spent on compression, more disk io).
+# "gzip" is also the zlib level 1 option: cfitsio writes every .gz file with
+# deflate at Z_BEST_SPEED, i.e. zlib level 1 (zcompress.c), and has no setting
+# for a higher level, so there is no separate zlib option.
+# python benchmark.py --stamp-codecs none gzip compares both on the local disk.
+stamp_codec="gzip"
 #----------------------- 90 degree rotated case---------------------------------
 90_output_folder="jedisim_out/out90/"  # jedicatalog etc.
 prefix="trial1_" # used by jedicatalog etc.
@@ -90,6 +99,146 @@ rescaled_outfolder90="jedisim_out/rescaled_lsst90"
 rescaled_lsst_outfile90="physics_settings/rescaled_lsst_outfile90.txt" # jediavg
 monochromatic_infits90="jedisim_out/rescaled_lsst90/rescaled_lsst90_10.fits"
 monochromatic_outfits90="jedisim_out/rescaled_lsst90/rescaled_noised_lsst90_10.fits"
+# a3 and a4 may run at the same time, so the rotated case gets its own
+# bulge-disk galaxies from jedicolor (color90.txt writes to color_outfolder90).
+color_infile90="physics_settings/color90.txt"
+color_outfolder90="simdatabase/bulge_disk_f8_90"
+#----------------------- jedimaster scheduler ----------------------------------
+# jedimaster.py runs a1 -> a2 -> {a3, a4} as a dependency graph.
+# max_parallel_jobs is the number of programs allowed to run at the same time.
+# a3 and a4 each hold one nx*ny HST image and one padded convolution band,
+# use 1 on small memory nodes to run them one after another.
+max_parallel_jobs=2
+#----------------------- parallel loop iterations ------------------------------
+# parallel_iterations=0 runs the 21 iterations of a3 and a4 one after another.
+# parallel_iterations=N runs up to N iterations at the same time, each one
+# inside its own folder iteration_scratch/out0_i/ (out90_i/ for rotated case).
+# The number of workers is also limited by the cores and the available memory
+# (about 5 GB per iteration for 12288x12288 images and 4000x4072 psfs).
+# Only rescaled_lsst_i.fits is kept, the scratch folders are removed.
+parallel_iterations=0
+iteration_scratch="jedisim_out/scratch/"
+#----------------------- bulge/disk decomposition ------------------------------
+# bulge_disk_decomposition=1 runs jedicolor, jeditransform and jedidistort only
+# twice before the 21 loop, with the weights (1,1) and (1,0), inside
+# iteration_scratch/basis0/ (basis90/). Each iteration pastes the two lensed
+# scenes with the weights of each galaxy instead.
+# python a3_jedisimulate.py --check-decomposition compares the HST images of
+# both methods, the relative L1 residual must be below decomposition_tolerance.
+bulge_disk_decomposition=0
+decomposition_tolerance=0.001
+# effective_psf=1 also renders the two scenes once, but runs only the
+# monochromatic iteration. LSST_averaged.fits is the sum of a few convolutions
+# (about 4) with effective psfs, i.e. combinations of psf0 to psf20 with the
+# jedicolor_args weights, instead of the average of the 21 rescaled images.
+# The number of psfs is the smallest one for which the disk fraction of every
+# galaxy in every iteration is within effective_psf_tolerance. The result is an
+# approximation of the 21 iterations, not equal to it: the disk fractions are
+# truncated and the stamps are embedded on their center pixels (see
+# transform_args), which moves galaxies by up to one pixel.
+# python a3_jedisimulate.py --check-effective-psf [i ...] compares it with the
+# 7 programs for these iterations, with both embeddings.
+effective_psf=0
+effective_psf_tolerance=1e-5
+# resample_maps=1 computes the geometry of jeditransform and jedidistort for
+# each galaxy once before the loop (resample.py, in iteration_scratch/maps0/
+# and maps90/), and each iteration applies it to the pixels of jedicolor
+# instead of running them. Not used with bulge_disk_decomposition.
+resample_maps=0
+# rotate_stamps=1 lenses the stamps of a3 of each iteration rotated by 90
+# degrees in a4 (jedidistort rotate argument), instead of running jedicolor
+# and jeditransform for the rotated case. a3 shares them in
+# iteration_scratch/stamps0/, a4 waits for them while a3 runs, or for
+# rotate_stamps_wait seconds after a2 for a3 to start, else it runs
+# jeditransform. Not used with bulge_disk_decomposition or resample_maps.
+# python a4_jedisimulate90.py --check-rotation compares the rotated stamps with
+# the ones of jeditransform, the max residual must be below rotation_tolerance.
+# The rotated stamps are not always the ones of jeditransform: it rotates around
+# pixel 1 + (n >> 1), so a galaxy that fills its n x n source image overhangs it
+# by up to two pixels in the rotated case and its stamp of jeditransform is
+# shifted, while the rotated stamp is not (11 of 500 galaxies of the 4096x4096
+# test case, the HST image differed by a relative L1 of 2e-6). --check-rotation
+# lists these galaxies, rotate_stamps=1 keeps the rotated stamps for them.
+rotate_stamps=0
+rotate_stamps_wait=600
+rotation_tolerance=0.001
+#----------------------- stage cache -------------------------------------------
+# If stage_cache_dir is not empty, programs that declare their input and output
+# files to run_process (jedicolor, jediconvolve, the jedipaste of the bands and
+# jedirescale) are looked up in this cache by a hash of
+# the executable, the arguments and the input files. On a hit the outputs are
+# copied from the cache instead of running the program. The least recently used
+# entries are removed when the cache is larger than stage_cache_size_gb.
+# The hits and misses of a2, a3 and a4 are counted from the stage_log if it is set.
+stage_cache_dir=""
+stage_cache_size_gb=20
+# If distort_cache is not empty, jedidistort saves its lens tables and grids
+# there (one file per lens.txt, nx, ny, pix_scale and lens_z) and memory-maps
+# them on the next calls. a3 and a4 build the file once before the loop.
+distort_cache="jedisim_out/distort_cache/"
+# distort_workers=N splits the galaxies of each jedidistort call into N chunks
+# of about the same stamp area and distorts them at the same time.
+distort_workers=1
+# paste_window_mb=N > 0 makes jedipaste memory-map its output image and add each
+# distorted image once, writing back and releasing the pages of the output image
+# every N MB of them, instead of reading all the images once per band (0).
+paste_window_mb=0
+# paste_threads=N > 1 splits the output image of jedipaste (each band without a
+# window) into N strips of rows, each pasted by its own thread from the rows of
+# the images overlapping it. This needs cfitsio built with --enable-reentrant,
+# else jedipaste warns and uses one thread.
+paste_threads=1
+# fft_convolve=1 convolves HST.fits with the psf in-process (convolve.py) on
+# fft_workers threads (0 for all the cores, SciPy is needed for more than one),
+# writing HST_convolved.fits directly, instead of jediconvolve and jedipaste.
+fft_convolve=0
+fft_workers=0
+# If psf_spectrum_cache is not empty, the spectra of the psfs of fft_convolve are
+# stored there (one .npy file per psf file, padded shape and dtype) and
+# memory-mapped by the next convolutions, in both cases and all realizations.
+# The least recently used ones are removed above psf_spectrum_cache_gb.
+psf_spectrum_cache="jedisim_out/psf_spectra/"
+psf_spectrum_cache_gb=20
+# deflection_field=1 computes the deflection of all the lenses of lens.txt once
+# with deflection.py (in distort_cache, 32 bytes per pixel) and jedidistort reads
+# it instead of summing the lenses at each subpixel. With deflection_tolerance
+# > 0 far groups of lenses are taken as one lens (quadtree), which makes lens
+# lists of thousands of halos practical. python deflection.py --check 20 prints
+# the error of the tolerance in pixels, 0 gives the exact sum of jedidistort.
+deflection_field=0
+deflection_tolerance=0.2
+# If kappa_map is not empty (a FITS convergence map for D_ls/D_s = 1 covering
+# the frame, with the same or fewer square pixels), the deflection field is
+# computed from it with one FFT Poisson solve padded with zeros instead of the
+# lenses of lens.txt, and kept in distort_cache like deflection_field.
+kappa_map=""
+#----------------------- stage log ---------------------------------------------
+# If stage_log is not empty, run_process appends one json line per program with
+# the wall time, user and sys cpu time, max rss and the bytes read and written.
+# jedimaster.py prints a summary table of its run at the end.
+stage_log="jedisim_out/stage_log.jsonl"
+# If trace_file is not empty, jedimaster.py and run_jedimaster.py also write
+# the timeline of their run (realization, a3/a4, iteration, programs) as a
+# chrome trace-event file, to open in chrome://tracing or ui.perfetto.dev.
+trace_file="jedisim_out/trace.json"
+#----------------------- parallel realizations ---------------------------------
+# run_jedimaster.py runs up to parallel_realizations realizations of
+# jedimaster.py at the same time, each one inside its own working directory
+# realization_scratch/r_i/ with a copy of physics_settings and its own
+# jedisim_out and bulge_disk_f8 folders. The final images are copied to
+# jedisim_output/jout_z*/ and the working directory is removed.
+# Each realization needs max_parallel_jobs times the memory of the 21 loop
+# (times parallel_iterations if larger than 0).
+# parallel_realizations=1 runs them one after another in this folder.
+parallel_realizations=1
+realization_scratch="jedisim_realizations/"
+#----------------------- work queue --------------------------------------------
+# run_jedimaster.py --queue jobs.db puts the realizations in a SQLite queue on
+# a shared file system, run_jedimaster.py --worker jobs.db runs them on any node.
+# A worker renews the lease of its job, if it crashes the job is queued again
+# after queue_lease_seconds, and failed after queue_max_attempts claims.
+queue_lease_seconds=900
+queue_max_attempts=3
 #----------------------- database folders --------------------------------------
 # There are 10 radius database files 20.dat to 29.dat.
 # which contains min and max radius to be used by jedicatalog.
@@ -380,18 +380,158 @@ import shutil
 import copy
 import time
 import numpy as np
-from util import run_process
-
-def jedimaster():
-    # Using run_process
-    run_process("Replace output dirs.", ['python', "a1_create_odirs.py"])
-    run_process("Create 3 catalogs.", ['python', "a2_create_3catalogs.py"])
-    run_process("Run the simulation for normal case.", ['python', "a3_jedisimulate.py"])
-    run_process("Run the simulation for rotated case.", ['python', "a4_jedisimulate90.py"])
+from util import run_process, read_stage_log, print_stage_summary
+from util import set_stage_log, log_span, write_trace
+
+# Global Variables
+config_path = "physics_settings/config.sh"
+
+
+def config_dict(config_path):
+    """Create a dictionary of variables from input file."""
+
+    # Parse config file and make a dictionary
+    with open(config_path, 'r') as f:
+        config = {}
+        string_regex = re.compile('"(.*?)"')
+        value_regex = re.compile('[^ |\t]*')
+
+        for line in f:
+            if not line.startswith("#"):
+                temp = []
+                temp = line.split("=")
+                if temp[1].startswith("\""):
+                    config[temp[0]] = string_regex.findall(temp[1])[0]
+                else:
+                    config[temp[0]] = value_regex.findall(temp[1])[0]
+    return config
+
+
+def jedimaster_graph(resume=False):
+    """Return the jedimaster programs as a dependency graph.
+
+    Each entry is (name, description, args, dependencies).
+    The normal and rotated simulations only depend on the catalogs,
+    so they can run at the same time.
+    With resume, a1 and a2 are dropped since they would remove the outputs
+    and catalogs, and a3 and a4 skip their checkpointed iterations.
+
+    ::
+
+      a1 --> a2 --> a3
+                `-> a4
+
+    """
+    graph = [("a1", "Replace output dirs.",
+              ['python', "a1_create_odirs.py"], []),
+             ("a2", "Create 3 catalogs.",
+              ['python', "a2_create_3catalogs.py"], ["a1"]),
+             ("a3", "Run the simulation for normal case.",
+              ['python', "a3_jedisimulate.py"], ["a2"]),
+             ("a4", "Run the simulation for rotated case.",
+              ['python', "a4_jedisimulate90.py"], ["a2"])
+             ]
+    if resume:
+        graph = [(name, desc, args + ['--resume'], [])
+                 for name, desc, args, deps in graph
+                 if name in ("a3", "a4")]
+    return graph
+
+
+def run_graph(graph, max_jobs):
+    """Run the programs of a dependency graph.
+
+    A program is started as soon as all of its dependencies have finished,
+    and at most max_jobs programs run at the same time.
+    If one program fails, the running ones are killed and we exit.
+
+    :Usage:
+
+    run_graph(jedimaster_graph(), 2)
+
+    """
+    max_jobs = max(1, int(max_jobs))
+    pending = list(graph)
+    running = {}
+    done = []
+    while pending or running:
+        # start every program whose dependencies are done
+        for node in list(pending):
+            name, desc, args, deps = node
+            if len(running) >= max_jobs:
+                break
+            if all(dep in done for dep in deps):
+                print("\n\n\n", "#" * 130)
+                print("# Program  : %s\n# Commands :" % desc, end=' ')
+                for arg in args:
+                    print(arg, end=' ')
+                print("\n# Running  : %d of max %d" % (len(running) + 1, max_jobs))
+                print("\n", "#" * 130, end='\n\n')
+                running[name] = (desc, subprocess.Popen(args))
+                pending.remove(node)
+
+        # collect the programs that have finished
+        for name in list(running):
+            desc, process = running[name]
+            if process.poll() is None:
+                continue
+            del running[name]
+            if process.returncode != 0:
+                print("Error: %s did not terminate correctly. \
+                      Return code: %i." % (desc, process.returncode))
+                for other_desc, other in running.values():
+                    other.kill()
+                sys.exit(1)
+            done.append(name)
+            print("\n\n", "#" * 129, end='\n')
+            print("# Success! : %s " % desc)
+            print("\b", "#" * 129, "\n\n\n")
+
+        if running:
+            time.sleep(1)
+
+
+def jedimaster(resume=False):
+    """Run a1, a2 and then a3 and a4 in parallel.
+
+    The number of programs running at the same time is max_parallel_jobs
+    from config.sh, use 1 to run them one after another.
+    With resume, only the unfinished iterations of a3 and a4 are run.
+    """
+    config = config_dict(config_path)
+    max_jobs = config.get('max_parallel_jobs', 1)
+
+    # The programs of this run are marked in the stage log,
+    # run_jedimaster.py marks the whole sweep and the realization
+    if 'JEDISIM_RUN' not in os.environ:
+        os.environ['JEDISIM_RUN'] = '%s:%i:%i' % (os.uname()[1], os.getpid(), int(time.time()))
+    run = os.environ['JEDISIM_RUN']
+    realization = os.environ.get('JEDISIM_REALIZATION', '')
+    set_stage_log(config.get('stage_log'))
+    start = time.time()
+    run_graph(jedimaster_graph(resume), max_jobs)
+    log_span('jedimaster', start)
+
+    # Time, memory and io of each program
+    records = [r for r in read_stage_log(config.get('stage_log'), run)
+               if r.get('realization', '') == realization]
+    if records:
+        print_stage_summary(records)
+
+        # Timeline of a single run, run_jedimaster.py writes the one of the sweep
+        if config.get('trace_file') and not realization:
+            write_trace(records, config['trace_file'])
     
 def main():
-    """Run main function."""
-    jedimaster()
+    """Run main function.
+
+    :Usage:
+
+      python jedimaster.py
+      python jedimaster.py --resume
+
+    """
+    jedimaster('--resume' in sys.argv[1:])
 
 if __name__ == "__main__":
     main()
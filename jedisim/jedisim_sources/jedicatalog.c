@@ -84,6 +84,7 @@
 #include <string.h>
 #include <math.h>
 #include <time.h>
+#include <unistd.h>
 #include "fitsio.h"
 
 /*jedicatalog
@@ -146,10 +147,12 @@ int main(int argc, char *argv[]){
     int         min_mag, max_mag;   //the minimum and maximum magnitude
     char        radius_db_folder[1024], red_db_folder[1024];    //the folders for the redshift and radius databases
     float       mag_power;      //the power for the power law distribution of galactic magnitudes
+    unsigned int seed = 0;      //random seed, 0 -> seed from the clock for each galaxy
 
     //output settings
     char        output_folder[1024];    //the output folder for postage stamps
     char        prefix[1024];           //the prefix for all filenames associated with this trial
+    char        stamp_codec[1024] = "gzip";     //compression of the postage stamps: none or gzip
 
     //catalog file settings
     char        temp_catalog_file[1024], catalog_file[1024];//catalog of galaxy parameters
@@ -205,10 +208,12 @@ int main(int argc, char *argv[]){
             else if(strcmp(buffer3,"power")==0) sscanf(buffer2,"power=%f", &mag_power);
             else if(strcmp(buffer3,"single_redshift")==0) sscanf(buffer2,"single_redshift=%i", &single_redshift);
             else if(strcmp(buffer3,"fixed_redshift")==0) sscanf(buffer2,"fixed_redshift=%f", &fixed_redshift);
+            else if(strcmp(buffer3,"seed")==0) sscanf(buffer2,"seed=%u", &seed);
 
             //output settings
             else if(strcmp(buffer3,"output_folder")==0) sscanf(buffer2, "output_folder=\"%[^\"]", output_folder);
             else if(strcmp(buffer3,"prefix")==0) sscanf(buffer2, "prefix=\"%[^\"]", prefix);
+            else if(strcmp(buffer3,"stamp_codec")==0) sscanf(buffer2, "stamp_codec=\"%[^\"]", stamp_codec);
 
             //catalog file settings
             else if(strcmp(buffer3,"catalog_file")==0) sscanf(buffer2, "catalog_file=\"%[^\"]", temp_catalog_file);
@@ -249,6 +254,17 @@ int main(int argc, char *argv[]){
     }
 
     sprintf(catalog_file, "%s%s%s", output_folder, prefix, temp_catalog_file);
+
+    //the postage stamps are written and read once, gzip (zlib level 1 in cfitsio) or uncompressed
+    char        *stamp_ext;
+    if(strcmp(stamp_codec, "gzip") == 0)
+        stamp_ext = ".fits.gz";
+    else if(strcmp(stamp_codec, "none") == 0)
+        stamp_ext = ".fits";
+    else{
+        fprintf(stderr,"Error: stamp_codec must be none or gzip, not \"%s\".\n", stamp_codec);
+        exit(1);
+    }
     sprintf(convlist_file, "%s%s%s", output_folder, prefix, temp_convlist_file);
     sprintf(distortedlist_file, "%s%s%s", output_folder, prefix, temp_distortedlist_file);
     sprintf(convolvedlist_file, "%s%s%s", output_folder, prefix, temp_convolvedlist_file);
@@ -428,8 +444,9 @@ int main(int argc, char *argv[]){
     }
     distortedlist_fp = fopen(distortedlist_file, "w");
 
+    if(seed) srand(seed);   //reproducible catalog
     for(g = 0; g < ngalaxies; g++){
-        srand(time(NULL)+rand());   //the code runs too fast to use the time in miliseconds as the seed
+        if(!seed) srand(time(NULL)+getpid()+rand());   //the code runs too fast to use the time in miliseconds as the seed, pid for parallel runs
         Galaxy gal;
 
         //set galaxy magnitude
@@ -516,7 +533,7 @@ int main(int argc, char *argv[]){
         gal.angle = rand_float()*360;
 
         //set galaxy filepaths
-        sprintf(gal.stamp_name, "%sstamp_%li/stamp_%li.fits.gz", output_folder, g/1000, g);
+        sprintf(gal.stamp_name, "%sstamp_%li/stamp_%li%s", output_folder, g/1000, g, stamp_ext);
 
                 //can't write to .gz files with FITSIO, so this is disabled so jedigrid can work
         //sprintf(gal.dis_name, "%sdistorted_%i/distorted_%i.fits.gz", output_folder, g/1000, g);
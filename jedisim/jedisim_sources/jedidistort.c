@@ -62,12 +62,29 @@
  *
  * Estimated time : 4 minutes for 12420 stamps.
  *
+ * Cache       : With a 7th argument (a folder), the lens tables and the grids are
+ *               saved to folder/jedidistort_<key>.bin, key being a hash of
+ *               nx, ny, scale, zl and the lens file, and memory-mapped by the
+ *               next calls with the same inputs instead of being computed again.
+ *               An empty dislist only builds the cache.
+ *
+ * Field       : With an 8th argument (a field file of deflection.py), alpha is read
+ *               from the memory-mapped field instead of being summed over the
+ *               lenses, which are then not tabulated. The field holds alpha at
+ *               the subpixels (x + s/4, y + s/4) sampled by get_alpha.
+ *
  */
 #include <stdio.h>
 #include <string.h>
 #include <math.h>
 #include "fitsio.h"
 #include <stdbool.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 // definitions
 #define DR      10          //lens table entries per pixel
@@ -82,16 +99,23 @@
 #define G       4.302       //Gravitational constant [10^{-3} (pc/Solar mass) (km/s)^2]
 #define H0      67.80       //Planck value for Hubble constant for present day [km/(Mps*s)]
 #define EP      0           //epsilon
+#define CACHE_MAGIC "JDCACHE1"  //first bytes of a cache file, change it with the layout
+#define FIELD_MAGIC "JDFIELD1"  //first bytes of a field file of deflection.py
+#define INDEX_MAGIC "JDPIDX01"  //first bytes of the paste index of the distorted galaxies
 
 char *help[] = {
         "Simulates gravitational lensing as realistically as possible. The gravitational lens is specified by a list of lenses and their parameters. The program takes in a list of galaxies and their parameters, to be distorted, and returned distorted versions of those images. The distortion was engineered to be as efficient as possible.",
-        "Usage jedidistort x y gallist lenses scale zl",
+        "Usage jedidistort x y gallist lenses scale zl [cache] [field] [rotate]",
         "Arguments: x - width of the image MUST BE AN INTEGER MULTIPLE OF 4096",
         "           y - height of the image MUST BE AN INTEGER MULTIPLE OF 4096",
         "           gallist - input galaxy parameter file",
         "           lenses - file containing lens parameters",
         "           scale - pixel scale in arcseconds per pixel",
         "           zl - lens redshift",
+        "           cache - optional folder for the lens tables and grids, empty to disable",
+        "           field - optional deflection field of deflection.py used instead of the lenses, empty for none",
+        "           rotate - optional, 1 to rotate each galaxy by 90 degrees counterclockwise when it is read in,",
+        "                    nx and ny of the galaxy list are the ones of the rotated galaxy",
         "Input galaxy parameter file: x y nx ny zs file",
         "           x - x coord. of lower left pixel where galaxy should be embedded",
         "           y - y coord. of lower left pixel where galaxy should be embedded",
@@ -100,6 +124,7 @@ char *help[] = {
         "           zs - redshift of this galaxy",
         "           infile - filepath to the FITS file for this galaxy, 1024 chars max",
         "           outfile - filepath for the output FITS file for this galaxy, 1024 chars max",
+        "Output paste index: gallist.idx, XEMBED YEMBED NAXIS1 NAXIS2 of each output FITS file (see jedipaste)",
         "Lens parameter file: x y rho0 Rs zl",
         "           x - x center of lens (in pixels)",
         "           y - y center of lens (in pixels)",
@@ -147,7 +172,20 @@ typedef struct {
 } rect;
 
 
-void get_alpha(long int x, long int y, int nlenses, lens* lenses, float* alphax, float* alphay);
+typedef struct {
+        char        magic[8];   // CACHE_MAGIC
+        uint64_t    key;        // hash of the inputs, see cache_key
+        int64_t     nlenses;    // number of lens tables
+        int64_t     ncells[4];  // number of rects in each grid
+} cache_header;                 // followed by nr of each lens, the lens tables and the grids
+
+
+void get_alpha(long int x, long int y, int nlenses, lens* lenses, float *field, long int nx, float* alphax, float* alphay);
+float *load_field(char *path, long int nx, long int ny);
+uint64_t cache_key(char *lensfile, char *fieldfile, long int nx, long int ny, float scale, float zl);
+int load_cache(char *path, uint64_t key, long int nlenses, lens *lenses, int ngr, int *ngx, int *ngy, rect **grids);
+void save_cache(char *path, uint64_t key, long int nlenses, lens *lenses, int ngr, int *ngx, int *ngy, rect **grids);
+void save_index(char *gallist, long int ngalaxies, int64_t *index);
 float angular_di_dist(float z1, float z2);
 void print_rect(rect *r);
 
@@ -181,7 +219,7 @@ int main(int argc, char *argv[]){
         float       *galimage, *outimage;       //input and output images as arrays
 
         /* Print help */
-        if ((argc != 7) || (argv[1][0] == '^')) {
+        if (argc < 7 || argc > 10 || (argv[1][0] == '^')) {
                 int i;
                 for (i = 0; help[i] != 0; i++)
                         fprintf (stderr, "%s\n", help[i]);
@@ -218,7 +256,7 @@ int main(int argc, char *argv[]){
 
         //initialize memory for all the galaxies
         galaxies = (galaxy *) calloc(ngalaxies, sizeof(galaxy));
-        if(galaxies == NULL){
+        if(galaxies == NULL && ngalaxies > 0){
                 fprintf(stderr,"Error allocating memory for galaxy list.");
                 exit(1);
         }
@@ -271,6 +309,15 @@ int main(int argc, char *argv[]){
         }
         //fprintf(stdout, "%li lenses in \"%s\".\n", nlenses, argv[4]);
 
+        //with a deflection field the lenses are not needed
+        float       *field = NULL;
+        char        *fieldfile = (argc >= 9 && argv[8][0] != 0) ? argv[8] : "";
+        int         rotate = (argc == 10) ? atoi(argv[9]) : 0;
+        if(fieldfile[0] != 0){
+                field = load_field(fieldfile, nx, ny);
+                nlenses = 0;
+        }
+
         //initialize memory for all the galaxies
         lenses = (lens *) calloc(nlenses, sizeof(lens));
         if(lenses == NULL){
@@ -278,6 +325,23 @@ int main(int argc, char *argv[]){
                 exit(1);
         }
 
+        //sizes of the grids
+        int         gr;         //the current grid
+        for(gr = 0; gr < ngr; gr++){
+                ngx[gr] = nx >> b[gr];
+                ngy[gr] = ny >> b[gr];
+        }
+
+        //look for the lens tables and grids of these inputs in the cache
+        char        cache_path[2048] = "";
+        uint64_t    key = 0;
+        int         cached = 0;
+        if(argc >= 8 && argv[7][0] != 0){
+                key = cache_key(argv[4], fieldfile, nx, ny, scale, zl);
+                sprintf(cache_path, "%s/jedidistort_%016llx.bin", argv[7], (unsigned long long) key);
+                cached = load_cache(cache_path, key, nlenses, lenses, ngr, ngx, ngy, grids);
+        }
+
         //cluster mass profile variables
         float       px_per_rad = 180.0*3600.0/(PI*scale); //conversion factor from radians to pixels
         float       rad_per_px = 1/px_per_rad;          //conversion factor from pixels to radians
@@ -289,6 +353,10 @@ int main(int argc, char *argv[]){
                 fscanf(lensfile, "%f %f %i %f %f", &lenses[nlens].x, &lenses[nlens].y, &lenses[nlens].type, &lenses[nlens].p1, &lenses[nlens].p2);
                 //fprintf(stdout,"Lens %i:\nx: %f\ny: %f\ntype: %i\np1: %f\np2: %f\n\n",nlens,lenses[nlens].x, lenses[nlens].y, lenses[nlens].type, lenses[nlens].p1, lenses[nlens].p2);
 
+                //the table comes from the cache
+                if(cached)
+                        continue;
+
                 //find the maximum radius we need to put in the table
                 //we need the further corner from the lens
 
@@ -443,10 +511,9 @@ int main(int argc, char *argv[]){
         fclose(lensfile);
 
         //make the grids
-        int         gr;         //the current grid
         long int    row, col;   //row and column in the current grid
         long int    srow, scol; //row and column in the sub grid
-        for(gr = 0; gr < ngr; gr++){
+        for(gr = 0; gr < ngr && !cached; gr++){
                 //allocate memory for the ith grid
                 ngx[gr] = nx >> b[gr];
                 ngy[gr] = ny >> b[gr];
@@ -467,7 +534,7 @@ int main(int argc, char *argv[]){
                                                 if(gr==0){
                                                         //get deflection angle
                                                         float alphax = 0, alphay = 0;
-                                                        get_alpha((row*g+srow) << BNSUBPX, (col*g+scol) << BNSUBPX, nlenses, lenses, &alphax, &alphay);
+                                                        get_alpha((row*g+srow) << BNSUBPX, (col*g+scol) << BNSUBPX, nlenses, lenses, field, nx, &alphax, &alphay);
                                                         //find maxima and minima
                                                         if(srow==0 && scol==0){
                                                                 bounding_box.xmax = alphax;
@@ -526,8 +593,19 @@ int main(int argc, char *argv[]){
                 }
         }
 
+        //save the lens tables and grids for the next calls
+        if(cache_path[0] != 0 && !cached)
+                save_cache(cache_path, key, nlenses, lenses, ngr, ngx, ngy, grids);
+
 
 
+        //XEMBED, YEMBED, NAXIS1 and NAXIS2 of each output image, for jedipaste
+        int64_t     *index = (int64_t *) calloc(4*ngalaxies, sizeof(int64_t));
+        if(index == NULL){
+                fprintf(stderr,"Error allocating memory for the paste index.\n");
+                exit(1);
+        }
+
         //distort the galaxies one at a time
         long int gal;
         for(gal = 0; gal < ngalaxies; gal++){
@@ -557,8 +635,10 @@ int main(int argc, char *argv[]){
 		//fprintf(" The galaxy list is %s  \n", galaxies[gal].file);
 
 		// Check shape of galaxy list and fitsfile image
-                if(naxes[0] != galaxies[gal].nx || naxes[1] != galaxies[gal].ny){
-                        fprintf(stderr,"Error: galaxy %li is the wrong size. The galaxy list has shape (%li, %li) but the fits image has shape (%li, %li).\n", gal, galaxies[gal].nx, galaxies[gal].ny, naxes[0], naxes[1]);
+                // a rotated galaxy has the width and height of the fits image swapped
+                long int    rnaxes[2] = {rotate ? naxes[1] : naxes[0], rotate ? naxes[0] : naxes[1]};
+                if(rnaxes[0] != galaxies[gal].nx || rnaxes[1] != galaxies[gal].ny){
+                        fprintf(stderr,"Error: galaxy %li is the wrong size. The galaxy list has shape (%li, %li) but the fits image has shape (%li, %li).\n", gal, galaxies[gal].nx, galaxies[gal].ny, rnaxes[0], rnaxes[1]);
                         exit(1);
                 }
                 //printf("Passed the if(naxes[0] != galaxies[gal].nx statement");
@@ -581,6 +661,25 @@ int main(int argc, char *argv[]){
                         exit(1);
                 }
                 fits_close_file(galfptr, &status);
+
+                //rotate the galaxy by 90 degrees counterclockwise, exactly as jeditransform
+                //would transform it with its angle + 90 degrees: pixel (x, y) of the rotated
+                //galaxy is pixel (naxes[0]-1-y, x) of the galaxy read in
+                if(rotate){
+                        float       *rotimage = (float *) calloc(naxes[0]*naxes[1], sizeof(float));
+                        long int    rx, ry;
+                        if (rotimage == NULL){
+                                fprintf(stderr, "Error allocating memory for rotated galaxy image %li.\n", gal);
+                                exit(1);
+                        }
+                        for(ry = 0; ry < rnaxes[1]; ry++)
+                                for(rx = 0; rx < rnaxes[0]; rx++)
+                                        rotimage[ry*rnaxes[0] + rx] = galimage[rx*naxes[0] + naxes[0] - 1 - ry];
+                        free(galimage);
+                        galimage = rotimage;
+                        naxes[0] = rnaxes[0];
+                        naxes[1] = rnaxes[1];
+                }
                 //printf("galfptr passed\n");
                 //allocate memory for the grid_t truth tables
                 int gr;
@@ -696,6 +795,10 @@ int main(int argc, char *argv[]){
                 long int        onaxes[2] = {(ixmax - ixmin) << b[0],(iymax - iymin) << b[0]};      //(width,height) of output image in pixels.
                 long int        ofx  = ixmin << b[0];                //x pixel of lower left corner of output image
                 long int        ofy  = iymin << b[0];                //y pixel of lower left corner of output image
+                index[4*gal] = ofx;
+                index[4*gal+1] = ofy;
+                index[4*gal+2] = onaxes[0];
+                index[4*gal+3] = onaxes[1];
 
 
                 //allocate memory for the output image
@@ -742,7 +845,7 @@ int main(int argc, char *argv[]){
                                                                 for(sy = 0; sy < NSUBPX; sy++){
                                                                         //get alpha vector
                                                                         float alpha_x = 0, alpha_y = 0;
-                                                                        get_alpha((ox << BNSUBPX) + sy, (oy << BNSUBPX) +sy, nlenses, lenses, &alpha_x, &alpha_y);
+                                                                        get_alpha((ox << BNSUBPX) + sy, (oy << BNSUBPX) +sy, nlenses, lenses, field, nx, &alpha_x, &alpha_y);
                                                                         //calculate
                                                                         x = (long int) (ox + (((float) sx)/NSUBPX) - prefactor*alpha_x);
                                                                         y = (long int) (oy + (((float) sy)/NSUBPX) - prefactor*alpha_y);
@@ -788,13 +891,24 @@ int main(int argc, char *argv[]){
                         free(grids_t[gr]);
 
         }
+        //no index for an empty list, e.g. the one that only fills the cache
+        if(ngalaxies > 0)
+                save_index(argv[3], ngalaxies, index);
+        free(index);
         return 0;
 }
 
 //given a  pixel (x,y), and the list of lenses,
 //returns the vector (alpha_x,alpha_y) at that pixel
-void get_alpha(long int x, long int y, int nlenses, lens* lenses, float* alphax, float* alphay){
+//with a field, x and y share their subpixel like in all the calls
+void get_alpha(long int x, long int y, int nlenses, lens* lenses, float *field, long int nx, float* alphax, float* alphay){
         long int         nlens;      //counter
+        if(field != NULL){
+                float *alpha = field + 2*((((y >> BNSUBPX)*nx) + (x >> BNSUBPX))*NSUBPX + (x & (NSUBPX-1)));
+                *alphax += alpha[0];
+                *alphay += alpha[1];
+                return;
+        }
         for(nlens = 0; nlens < nlenses; nlens++){
                 float dx = ((float) x)/NSUBPX - lenses[nlens].x;
                 float dy = ((float) y)/NSUBPX - lenses[nlens].y;
@@ -811,6 +925,180 @@ void get_alpha(long int x, long int y, int nlenses, lens* lenses, float* alphax,
 }
 
 
+//returns the FNV-1a hash of n bytes, starting from hash h
+uint64_t fnv1a(uint64_t h, const unsigned char *data, size_t n){
+        size_t i;
+        for(i = 0; i < n; i++){
+                h ^= data[i];
+                h *= 1099511628211ULL;
+        }
+        return h;
+}
+
+
+//returns the cache key of the lens file and the parameters the tables and grids depend on,
+//a field file is identified by its path, size and modification time
+uint64_t cache_key(char *lensfile, char *fieldfile, long int nx, long int ny, float scale, float zl){
+        uint64_t        h = 14695981039346656037ULL;
+        char            params[2400];
+        unsigned char   buffer[4096];
+        size_t          n;
+        FILE            *f;
+        struct stat     st;
+
+        sprintf(params, "%s %li %li %.9g %.9g %i %i", CACHE_MAGIC, nx, ny, scale, zl, DR, NSUBPX);
+        if(fieldfile[0] != 0 && stat(fieldfile, &st) == 0)
+                sprintf(params + strlen(params), " %s %lli %lli", fieldfile, (long long) st.st_size, (long long) st.st_mtime);
+        h = fnv1a(h, (unsigned char *) params, strlen(params));
+        if((f = fopen(lensfile, "rb")) == NULL){
+                fprintf(stderr, "Error opening lens list file \"%s\".\n", lensfile);
+                exit(1);
+        }
+        while((n = fread(buffer, 1, sizeof(buffer), f)) > 0)
+                h = fnv1a(h, buffer, n);
+        fclose(f);
+        return h;
+}
+
+
+//memory-maps the field file of deflection.py and returns its alpha values,
+//the header is the magic and nx, ny, NSUBPX as int64
+float *load_field(char *path, long int nx, long int ny){
+        int             fd;
+        struct stat     st;
+        char            *data;
+        int64_t         *dims;
+
+        if((fd = open(path, O_RDONLY)) < 0 || fstat(fd, &st) != 0){
+                fprintf(stderr, "Error opening deflection field \"%s\".\n", path);
+                exit(1);
+        }
+        if(st.st_size != 32 + (off_t) nx*ny*NSUBPX*2*sizeof(float)){
+                fprintf(stderr, "Error: deflection field \"%s\" does not have the size of a (%li, %li) image.\n", path, nx, ny);
+                exit(1);
+        }
+        data = (char *) mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+        close(fd);
+        dims = (int64_t *) (data + 8);
+        if(data == MAP_FAILED || memcmp(data, FIELD_MAGIC, 8) != 0 || dims[0] != nx || dims[1] != ny || dims[2] != NSUBPX){
+                fprintf(stderr, "Error: \"%s\" is not a deflection field of a (%li, %li) image.\n", path, nx, ny);
+                exit(1);
+        }
+        return (float *) (data + 32);
+}
+
+
+//memory-maps the cache file and points the lens tables and the grids into it,
+//returns 1 on success and 0 if the file is missing or does not match
+int load_cache(char *path, uint64_t key, long int nlenses, lens *lenses, int ngr, int *ngx, int *ngy, rect **grids){
+        int             fd, gr;
+        long int        nlens;
+        struct stat     st;
+        cache_header    *header;
+        char            *data;
+
+        if((fd = open(path, O_RDONLY)) < 0)
+                return 0;
+        if(fstat(fd, &st) != 0 || st.st_size < (off_t) sizeof(cache_header)){
+                close(fd);
+                return 0;
+        }
+        data = (char *) mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+        close(fd);
+        if(data == MAP_FAILED)
+                return 0;
+
+        //check the header and the size of the file
+        header = (cache_header *) data;
+        int64_t     *nr = (int64_t *) (data + sizeof(cache_header));
+        off_t       size = sizeof(cache_header) + nlenses*sizeof(int64_t);
+        int         ok = memcmp(header->magic, CACHE_MAGIC, 8) == 0 && header->key == key && header->nlenses == nlenses;
+        for(gr = 0; ok && gr < ngr; gr++){
+                ok = header->ncells[gr] == (int64_t) ngx[gr]*ngy[gr];
+                size += ngx[gr]*ngy[gr]*sizeof(rect);
+        }
+        for(nlens = 0; ok && size <= st.st_size && nlens < nlenses; nlens++)
+                size += nr[nlens]*sizeof(float);
+        if(!ok || size != st.st_size){
+                munmap(data, st.st_size);
+                return 0;
+        }
+
+        //the tables and the grids are read only from now on
+        char    *p = data + sizeof(cache_header) + nlenses*sizeof(int64_t);
+        for(nlens = 0; nlens < nlenses; nlens++){
+                lenses[nlens].nr = nr[nlens];
+                lenses[nlens].table = (float *) p;
+                p += nr[nlens]*sizeof(float);
+        }
+        for(gr = 0; gr < ngr; gr++){
+                grids[gr] = (rect *) p;
+                p += ngx[gr]*ngy[gr]*sizeof(rect);
+        }
+        return 1;
+}
+
+
+//writes the lens tables and the grids to the cache file,
+//through a temporary file so that other processes never see a partial file
+void save_cache(char *path, uint64_t key, long int nlenses, lens *lenses, int ngr, int *ngx, int *ngy, rect **grids){
+        char            tmp[2100];
+        cache_header    header;
+        FILE            *f;
+        int             gr, ok;
+        long int        nlens;
+
+        memset(&header, 0, sizeof(header));
+        memcpy(header.magic, CACHE_MAGIC, 8);
+        header.key = key;
+        header.nlenses = nlenses;
+        for(gr = 0; gr < ngr; gr++)
+                header.ncells[gr] = (int64_t) ngx[gr]*ngy[gr];
+
+        sprintf(tmp, "%s.tmp.%li", path, (long int) getpid());
+        if((f = fopen(tmp, "wb")) == NULL){
+                fprintf(stderr, "Warning: cannot write the cache file \"%s\".\n", tmp);
+                return;
+        }
+        ok = fwrite(&header, sizeof(header), 1, f) == 1;
+        for(nlens = 0; nlens < nlenses; nlens++){
+                int64_t nr = lenses[nlens].nr;
+                ok = ok && fwrite(&nr, sizeof(nr), 1, f) == 1;
+        }
+        for(nlens = 0; nlens < nlenses; nlens++)
+                ok = ok && fwrite(lenses[nlens].table, sizeof(float), lenses[nlens].nr, f) == (size_t) lenses[nlens].nr;
+        for(gr = 0; gr < ngr; gr++)
+                ok = ok && fwrite(grids[gr], sizeof(rect), ngx[gr]*ngy[gr], f) == (size_t) ngx[gr]*ngy[gr];
+        if(fclose(f) != 0 || !ok || rename(tmp, path) != 0){
+                fprintf(stderr, "Warning: cannot write the cache file \"%s\".\n", path);
+                remove(tmp);
+        }
+}
+
+
+//writes the paste index of the output images next to the galaxy list, gallist.idx:
+//INDEX_MAGIC, the number of images and XEMBED YEMBED NAXIS1 NAXIS2 of each one as int64
+void save_index(char *gallist, long int ngalaxies, int64_t *index){
+        char            path[2100];
+        int64_t         n = ngalaxies;
+        FILE            *f;
+        int             ok;
+
+        sprintf(path, "%s.idx", gallist);
+        if((f = fopen(path, "wb")) == NULL){
+                fprintf(stderr, "Warning: cannot write the paste index \"%s\".\n", path);
+                return;
+        }
+        ok = fwrite(INDEX_MAGIC, 1, 8, f) == 8;
+        ok = ok && fwrite(&n, sizeof(n), 1, f) == 1;
+        ok = ok && fwrite(index, sizeof(int64_t), 4*n, f) == (size_t) 4*n;
+        if(fclose(f) != 0 || !ok){
+                fprintf(stderr, "Warning: cannot write the paste index \"%s\".\n", path);
+                remove(path);
+        }
+}
+
+
 //given two redshifts,
 //returns the angular diameter distance between them in Mpc for a set cosmology
 float angular_di_dist(float z1, float z2){
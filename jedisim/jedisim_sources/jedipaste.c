@@ -5,7 +5,7 @@
  * Last update : May 09, 2017
  *
  *
- * Compile     : gcc -Wall -O3 -o jedipaste jedipaste.c -lm -lcfitsio
+ * Compile     : gcc -Wall -O3 -o jedipaste jedipaste.c -lm -lcfitsio -lpthread
  * Run         : ./jedipaste 12288 12288 out1/trial0_distortedlist.txt out1/trial0_HST.fits
  *               executable  nx    ny    input_distortedlist           output_embedded_large_fitsfile
  *
@@ -46,30 +46,68 @@
  *       It reads the left corners of images (nx,ny) from the config file: config.conf
  */
 #include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
 #include <math.h>
 #include <string.h>
 #include "fitsio.h"
 #include <time.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/stat.h>
+#include <sys/mman.h>
+#include <pthread.h>
 
 #define NUMBANDS 2
+#define INDEX_MAGIC "JDPIDX01"  //first bytes of the paste index of jedidistort
 
 char *help[] = {
     "Takes a list of 2D floating point FITS images and combines them into a single large image.",
-    "usage: jedipaste x y imlist output_image",
+    "usage: jedipaste x y imlist output_image [window] [threads]",
     "Arguments: x - width of the final image",
     "           y - height of the final image",
     "           imlist - list of paths of images to insert in to the final image",
     "           output_image - path for the output image. Will overwrite other files.",
+    "           window - optional, in MB. If larger than 0, the output image is memory-mapped",
+    "                    and each image is read once and added in place, instead of once for",
+    "                    each band. The pages of the output image are released",
+    "                    each time about window MB of them have been modified.",
+    "           threads - optional, number of threads (default 1). Each thread owns a strip",
+    "                     of rows of the output image (of each band without window) and adds",
+    "                     the rows of the images overlapping it, so no locks are needed.",
     "imlist description: text file of filepaths to valid FITS images to be inserted",
     "into the final image. There must be one filepath per line. The header of each",
     "FITS file must have the entries XEMBED and YEMBED, with integer values giving the",
     "x and y pixel where the lower left corner of the embedded image should be placed.",
+    "A filepath may be followed by a weight, the image is multiplied by it (default 1).",
+    "If imlist.idx exists and is newer than imlist, it gives XEMBED, YEMBED, NAXIS1 and",
+    "NAXIS2 of each image (int64 after the magic and the number of images), so that only",
+    "the images overlapping a band are opened.",
     0};
 
+int64_t *load_index(char *imlist_path, long int nimages);
+
+//the rows ymin to ymax of the output image, pasted by one thread
+typedef struct {
+    long int    ymin, ymax;         //rows of the output image owned by this strip
+    long        *fnaxes;            //size of the output image
+    long int    nimages;            //number of images, their paths, weights and paste index
+    char        **imlist;
+    float       *weights;
+    int64_t     *index;
+    float       *fimage;            //rows ymin to ymax of the output image, or NULL to add to data
+    uint32_t    *data;              //the whole memory-mapped output image, big-endian
+    long int    window;             //bytes of modified pages of data before they are released
+} Strip;
+
+void *paste_strip(void *arg);
+void paste_strips(Strip *base, long int ymin, long int ymax, float *fimage, int nthreads);
+void stream_paste(char *outfile, Strip *base, int nthreads);
+
 int main(int argc, char *argv[]){
 
     //check command line input
-    if(argc != 5){
+    if(argc < 5 || argc > 7){
         int line;
         for(line = 0; help[line] != 0; line++)
             fprintf(stderr, "%s\n", help[line]);
@@ -78,12 +116,13 @@ int main(int argc, char *argv[]){
 
     FILE        *imlist_file;       //file object for the image list
     char        **imlist;           //array for the images to embed
+    float       *weights;           //array for the weights of the images
     long int    nimages;            //number of images int embed
     char        buffer[1024];       //string buffer for reading imlist
-    float       *fimage, *image;    //arrays for the final image and the current embedded image
-    fitsfile    *ffptr, *efptr;     //final and embed CFITSIO file pointers
+    float       *fimage;            //array for the final image
+    fitsfile    *ffptr;             //final CFITSIO file pointer
     int         status = 0,naxis=2; //CFITSIO status and number of axes parameters
-    long        naxes[2], fnaxes[2], onaxes[2], fpixel[2] = {1,1}, opixel[2] = {1,1};    //CFITSIO axes lengths and first pixel to read in
+    long        fnaxes[2], onaxes[2], opixel[2] = {1,1};    //CFITSIO axes lengths and first pixel to write
     char buf[100];
     char x[100];
 
@@ -109,29 +148,60 @@ int main(int argc, char *argv[]){
     }
 
     //count the number of files in imlist
+    char        line[2048];         //one line of imlist: filepath [weight]
     nimages = 0;
-    while(fscanf(imlist_file, "%s\n", &buffer) >0)
-        nimages++;
+    while(fgets(line, sizeof(line), imlist_file) != NULL)
+        if(sscanf(line, "%s", buffer) == 1)
+            nimages++;
     fprintf(stdout,"%li images in \"%s\".\n", nimages, argv[3]);
 
-    //initialize memory for the image names array
+    //initialize memory for the image names and weights arrays
     imlist = (char **) calloc(nimages, sizeof(char*));
-    if(imlist == NULL){
+    weights = (float *) calloc(nimages, sizeof(float));
+    if(imlist == NULL || weights == NULL){
         fprintf(stdout, "Error: could not allocate memory for the list of image names.");
         exit(1);
     }
 
-    //read in image names
+    //read in image names and weights
     rewind(imlist_file);
-    long int    im;     //image counter
-    for(im = 0; im < nimages; im++){
-        fscanf(imlist_file, "%s\n", &buffer);
+    long int    im = 0;     //image counter
+    while(im < nimages && fgets(line, sizeof(line), imlist_file) != NULL){
+        weights[im] = 1.0;
+        if(sscanf(line, "%s %f", buffer, &weights[im]) < 1)
+            continue;
         imlist[im] = (char *) calloc(strlen(buffer)+1, sizeof(char));
         if(imlist[im] == NULL){
             fprintf(stderr,"Error: could not allocate memory for image %li name.", im);
             exit(1);
         }
         strcpy(imlist[im], buffer);
+        im++;
+    }
+
+    //the position and size of each image, NULL if there is no valid paste index
+    int64_t     *index = load_index(argv[3], nimages);
+
+    //the strips of the output image pasted by each thread
+    long int    window = 0;
+    int         nthreads = 1;
+    if(argc >= 6)
+        sscanf(argv[5], "%li", &window);
+    if(argc == 7)
+        sscanf(argv[6], "%i", &nthreads);
+    if(nthreads > 1 && !fits_is_reentrant()){
+        fprintf(stderr, "Warning: cfitsio is not reentrant, pasting with one thread.\n");
+        nthreads = 1;
+    }
+    if(nthreads < 1)
+        nthreads = 1;
+    Strip       base = {0, 0, fnaxes, nimages, imlist, weights, index, NULL, NULL, (window << 20)/nthreads};
+
+    //with a window, stream each image once into the memory-mapped output image
+    if(window > 0){
+        stream_paste(x, &base, nthreads);
+        free(index);
+        return 0;
     }
 
     fits_create_file(&ffptr, buf, &status);
@@ -145,8 +215,6 @@ int main(int argc, char *argv[]){
         //so we need the borders of this band
         long int    ymin = band*onaxes[1];
         long int    ymax = (band+1)*onaxes[1];
-        long int    xmin = 0;
-        long int    xmax = onaxes[0];
 
 
         //fprintf(stdout,"(%li, %li)\n", opixel[0], opixel[1]);
@@ -159,91 +227,243 @@ int main(int argc, char *argv[]){
             exit(1);
         }
 
-        //loop over each image and embed them one at a time
-        for(im = 0; im < nimages; im++){
+        //paste the images, each thread adds them to its own strip of this band
+        paste_strips(&base, ymin, ymax, fimage, nthreads);
 
-            //read in galaxy image
-            fits_open_file(&efptr, imlist[im], READONLY, &status);
-            fits_get_img_dim(efptr, &naxis, &status);
-            fits_get_img_size(efptr, 2, naxes, &status);
-            if(status){
-                fits_report_error(stderr, status);
-                exit(1);
-            }
 
-                        //fprintf(stdout,"naxes[0]: %li\nnaxes[1]: %li\n",naxes[0],naxes[1]);
 
-            //read in where the embed this image
-            char        xembedstr[32], yembedstr[32];   //strings of the embed coordinates
-            long int    xembed, yembed;                 //integer embed coordinates
-            fits_read_key_str(efptr, "XEMBED", xembedstr, NULL, &status);
-            fits_read_key_str(efptr, "YEMBED", yembedstr, NULL, &status);
-            sscanf(xembedstr, "%li", &xembed);
-            sscanf(yembedstr, "%li", &yembed);
 
+        //write the band to disk
+        //fprintf(stdout,"Writing band %i in image %s. This may take several minutes.\n", band, argv[4]);
+        fits_write_pix(ffptr, TFLOAT, opixel, onaxes[0]*onaxes[1], fimage, &status);
 
+        //get ready for the next band
+        opixel[1] += fnaxes[1]/NUMBANDS;
+        free(fimage);
+    }
 
-            //check if the image intersects this band
-            if(yembed < ymax && yembed+naxes[1] >= ymin){
-                //allocate enough memory for the image
-                image = (float *) calloc (naxes[0]*naxes[1], sizeof(float));
-                if (image == NULL){
-                    fprintf(stderr, "Error allocating memory for galaxy image %li.\n", im);
-                    exit(1);
-                }
+    //close the output file
+    fits_close_file(ffptr, &status);
+    fits_report_error(stderr, status);
 
-                //read in the image
-                //fprintf(stdout, "Reading in image.\n");
-                if(fits_read_pix(efptr, TFLOAT, fpixel, naxes[0]*naxes[1], NULL, image, NULL, &status)){
-                    fprintf(stderr, "Can't read in embed image %li.\n", im);
-                    fits_report_error(stderr, status);
-                    exit(1);
-                }
-                fits_close_file(efptr, &status);
+    free(index);
+    return 0;
+}
 
-                //find the intersection
-                //rowmin lowest row in im that's inside this band
-                long int    rowmin = (yembed >= ymin ? 0 : ymin-yembed);
-                //rowmax: highest row from im that's inside this band
-                long int    rowmax = (yembed+naxes[1] < ymax ? naxes[1] : ymax-yembed);
 
-                //same for columns
-                long int    colmin = (xembed >= xmin ? 0 : xmin-xembed);
-                long int    colmax = (xembed+naxes[0] < xmax ? naxes[0] : xmax-xembed);
+//reads the paste index imlist.idx written by jedidistort or util.write_paste_index,
+//returns NULL if there is none, if it is older than imlist or if it has another number of images
+int64_t *load_index(char *imlist_path, long int nimages){
+    char        path[2100], magic[8];
+    struct stat list_stat, index_stat;
+    int64_t     n, *index;
+    FILE        *f;
+
+    sprintf(path, "%s.idx", imlist_path);
+    if(stat(imlist_path, &list_stat) != 0 || stat(path, &index_stat) != 0 || index_stat.st_mtime < list_stat.st_mtime)
+        return NULL;
+    if((f = fopen(path, "rb")) == NULL)
+        return NULL;
+    if(fread(magic, 1, 8, f) != 8 || memcmp(magic, INDEX_MAGIC, 8) != 0 || fread(&n, sizeof(n), 1, f) != 1 || n != nimages){
+        fclose(f);
+        return NULL;
+    }
+    index = (int64_t *) calloc(4*n, sizeof(int64_t));
+    if(index == NULL || fread(index, sizeof(int64_t), 4*n, f) != (size_t) 4*n){
+        free(index);
+        fclose(f);
+        return NULL;
+    }
+    fclose(f);
+    return index;
+}
 
-                //fprintf(stdout,"Embedding image %li in band %i at (%li, %li).\n", im, band, xembed, yembed);
-                long int    row, col;   //counter to embed the image
-                for(col = colmin; col < colmax; col++){
-                    for(row = rowmin; row < rowmax; row++){
-                        //fprintf(stderr, "index: %li\nmaxindex: %li\nrowmin: %li\nrowmax: %i\nymin: %li\nymax: %li\nxembed: %li\nymembed: %li\n(rowmax+yembed): %li\n", (row+yembed)*onaxes[0] + (col+xembed), onaxes[0]*onaxes[1], rowmin, rowmax, ymin, ymax, xembed, yembed, rowmax+yembed);
-                        fimage[(col+xembed) + onaxes[0]*(row+yembed-ymin)] += image[col+naxes[0]*row];
 
-                    }
+//converts a 32 bit word between the big-endian order of FITS and the order of this machine
+uint32_t swap_fits(uint32_t v){
+    const uint16_t one = 1;
+    if(*(const uint8_t *) &one == 0)
+        return v;
+    return (v >> 24) | ((v >> 8) & 0xff00) | ((v << 8) & 0xff0000) | (v << 24);
+}
 
-                }
-                //release memory
-                free(image);
+
+//writes one header card of a FITS header with a fixed format value
+void put_card(char *header, int card, char *key, char *value){
+    char        text[81];
+    snprintf(text, sizeof(text), "%-8s= %20s", key, value);
+    memcpy(header + 80*card, text, strlen(text));
+}
+
+
+//adds the rows of the images inside the strip to the strip, reading only these rows
+void *paste_strip(void *arg){
+    Strip       *strip = (Strip *) arg;
+    long        *fnaxes = strip->fnaxes;
+    long        naxes[2], fpixel[2];
+    fitsfile    *efptr;
+    int         status = 0, naxis;
+    long int    im, row, col, page = sysconf(_SC_PAGESIZE), dirty = 0;
+    float       *image;
+
+    for(im = 0; im < strip->nimages; im++){
+        float       weight = strip->weights[im];
+        int64_t     *index = (strip->index == NULL ? NULL : strip->index + 4*im);
+
+        //with the paste index, the images outside this strip are not opened
+        if(weight == 0 || (index != NULL && (index[0] >= fnaxes[0] || index[0]+index[2] <= 0 ||
+                                             index[1] >= strip->ymax || index[1]+index[3] <= strip->ymin)))
+            continue;
+
+        //read in where to embed the image
+        char        xembedstr[32], yembedstr[32];   //strings of the embed coordinates
+        long int    xembed, yembed;                 //integer embed coordinates
+        fits_open_file(&efptr, strip->imlist[im], READONLY, &status);
+        fits_get_img_dim(efptr, &naxis, &status);
+        fits_get_img_size(efptr, 2, naxes, &status);
+        fits_read_key_str(efptr, "XEMBED", xembedstr, NULL, &status);
+        fits_read_key_str(efptr, "YEMBED", yembedstr, NULL, &status);
+        if(status){
+            fits_report_error(stderr, status);
+            exit(1);
+        }
+        sscanf(xembedstr, "%li", &xembed);
+        sscanf(yembedstr, "%li", &yembed);
+        if(index != NULL && (index[0] != xembed || index[1] != yembed || index[2] != naxes[0] || index[3] != naxes[1])){
+            fprintf(stderr,"Error: image %li \"%s\" does not match the paste index.\n", im, strip->imlist[im]);
+            exit(1);
+        }
+
+        //rows and columns of the image inside this strip
+        long int    rowmin = (yembed >= strip->ymin ? 0 : strip->ymin-yembed);
+        long int    rowmax = (yembed+naxes[1] < strip->ymax ? naxes[1] : strip->ymax-yembed);
+        long int    colmin = (xembed >= 0 ? 0 : -xembed);
+        long int    colmax = (xembed+naxes[0] < fnaxes[0] ? naxes[0] : fnaxes[0]-xembed);
+        if(rowmax <= rowmin || colmax <= colmin){
+            fits_close_file(efptr, &status);
+            continue;
+        }
+
+        //read in these rows of the image
+        image = (float *) calloc(naxes[0]*(rowmax-rowmin), sizeof(float));
+        if(image == NULL){
+            fprintf(stderr, "Error allocating memory for galaxy image %li.\n", im);
+            exit(1);
+        }
+        fpixel[0] = 1;
+        fpixel[1] = rowmin+1;
+        if(fits_read_pix(efptr, TFLOAT, fpixel, naxes[0]*(rowmax-rowmin), NULL, image, NULL, &status)){
+            fprintf(stderr, "Can't read in embed image %li.\n", im);
+            fits_report_error(stderr, status);
+            exit(1);
+        }
+        fits_close_file(efptr, &status);
+
+        //add them to the strip
+        for(row = rowmin; row < rowmax; row++){
+            float       *in = image + naxes[0]*(row-rowmin);
+            if(strip->data == NULL){
+                float       *out = strip->fimage + fnaxes[0]*(row+yembed-strip->ymin) + xembed;
+                for(col = colmin; col < colmax; col++)
+                    out[col] += weight*in[col];
             } else {
-                //if it doesn't, move onto the next image
-                fits_close_file(efptr, &status);
+                uint32_t    *out = strip->data + fnaxes[0]*(row+yembed) + xembed;
+                for(col = colmin; col < colmax; col++){
+                    uint32_t    word = swap_fits(out[col]);
+                    float       pixel;
+                    memcpy(&pixel, &word, sizeof(pixel));
+                    pixel += weight*in[col];
+                    memcpy(&word, &pixel, sizeof(pixel));
+                    out[col] = swap_fits(word);
+                }
             }
         }
+        free(image);
+
+        //release the modified pages of the strip once there are about window bytes of them,
+        //the pages of a shared mapping stay in the page cache until the kernel writes them
+        if(strip->data != NULL){
+            dirty += (rowmax-rowmin) * (((colmax-colmin)*(long int) sizeof(float) + page - 1)/page + 1) * page;
+            if(dirty > strip->window){
+                uintptr_t   start = (uintptr_t) (strip->data + fnaxes[0]*strip->ymin) & ~(uintptr_t) (page-1);
+                uintptr_t   end = (uintptr_t) (strip->data + fnaxes[0]*strip->ymax);
+                madvise((void *) start, end-start, MADV_DONTNEED);
+                dirty = 0;
+            }
+        }
+    }
+    return NULL;
+}
 
 
+//pastes the rows ymin to ymax of the output image into fimage (or the data of base
+//if fimage is NULL), split into one strip of rows for each thread
+void paste_strips(Strip *base, long int ymin, long int ymax, float *fimage, int nthreads){
+    Strip       strips[nthreads];
+    pthread_t   threads[nthreads];
+    int         t;
 
+    for(t = 0; t < nthreads; t++){
+        strips[t] = *base;
+        strips[t].ymin = ymin + (ymax-ymin)*t/nthreads;
+        strips[t].ymax = ymin + (ymax-ymin)*(t+1)/nthreads;
+        if(fimage != NULL)
+            strips[t].fimage = fimage + base->fnaxes[0]*(strips[t].ymin-ymin);
+    }
+    if(nthreads == 1){
+        paste_strip(&strips[0]);
+        return;
+    }
+    for(t = 0; t < nthreads; t++)
+        if(pthread_create(&threads[t], NULL, paste_strip, &strips[t]) != 0){
+            fprintf(stderr, "Error: could not start paste thread %i.\n", t);
+            exit(1);
+        }
+    for(t = 0; t < nthreads; t++)
+        pthread_join(threads[t], NULL);
+}
 
-        //write the band to disk
-        //fprintf(stdout,"Writing band %i in image %s. This may take several minutes.\n", band, argv[4]);
-        fits_write_pix(ffptr, TFLOAT, opixel, onaxes[0]*onaxes[1], fimage, &status);
 
-        //get ready for the next band
-        opixel[1] += fnaxes[1]/NUMBANDS;
-        free(fimage);
+//pastes the images into the output image, memory-mapped as one FITS data unit:
+//each image is read once (once per strip it overlaps) and its pixels are added in
+//place, and the pages of the output image are released each time about window
+//bytes of them have been modified, so that the resident memory does not grow with
+//the image
+void stream_paste(char *outfile, Strip *base, int nthreads){
+    char        header[2880], value[32];
+    long        *fnaxes = base->fnaxes;
+    size_t      datasize = (size_t) fnaxes[0]*fnaxes[1]*sizeof(float);
+    size_t      filesize = sizeof(header) + ((datasize + 2879)/2880)*2880;
+    int         fd;
+
+    //primary header of a 2D float image, the data unit is zero until the images are added
+    memset(header, ' ', sizeof(header));
+    put_card(header, 0, "SIMPLE", "T");
+    put_card(header, 1, "BITPIX", "-32");
+    put_card(header, 2, "NAXIS", "2");
+    sprintf(value, "%li", fnaxes[0]);
+    put_card(header, 3, "NAXIS1", value);
+    sprintf(value, "%li", fnaxes[1]);
+    put_card(header, 4, "NAXIS2", value);
+    put_card(header, 5, "EXTEND", "T");
+    memcpy(header + 80*6, "END", 3);
+
+    fd = open(outfile, O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if(fd < 0 || write(fd, header, sizeof(header)) != sizeof(header) || ftruncate(fd, filesize) != 0){
+        fprintf(stderr,"Error: could not create the output image \"%s\".\n", outfile);
+        exit(1);
     }
+    char        *map = (char *) mmap(NULL, filesize, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    if(map == MAP_FAILED){
+        fprintf(stderr,"Error: could not memory-map the output image \"%s\".\n", outfile);
+        exit(1);
+    }
+    base->data = (uint32_t *) (map + sizeof(header));
 
-    //close the output file
-    fits_close_file(ffptr, &status);
-    fits_report_error(stderr, status);
+    paste_strips(base, 0, fnaxes[1], NULL, nthreads);
 
-    return 0;
+    if(munmap(map, filesize) != 0 || close(fd) != 0){
+        fprintf(stderr,"Error: could not write the output image \"%s\".\n", outfile);
+        exit(1);
+    }
 }
@@ -87,9 +87,12 @@ The MAG0 for f606w, f814w, and f125w are 26.6611, 26.78212, and 28.03741 respect
 
 char *help[] = {
     "Takes in a catalog of images, and produces a FITS image for each entry, transformed to the correct specifications.",
-    "Usage: jeditransform catalog distort_list",
+    "Usage: jeditransform catalog distort_list [center]",
     "Arguments: catalog - text file containing galaxy catalog",
     "           distort_list - file path to output instructions for jedidistort",
+    "           center - optional, if 1 the center pixel of the transformed galaxy is embedded",
+    "                    at (x, y) instead of the center of its bounding box, so that the",
+    "                    position does not depend on the pixels above the threshold",
     "catalog file:  image x y angle redshift old_mag old_r50 new_mag new_r50 stamp1 stamp2 [tab separated]",
     "               image - file path for the base galaxy postage stamp image",
     "               x - x coordinate for the image center",
@@ -137,7 +140,7 @@ int main(int argc, char *argv[]){
 
 
     //print help
-    if(argc != 3){
+    if(argc != 3 && argc != 4){
         int line;
         for(line = 0; help[line] !=0; line++)
             fprintf(stderr, "%s\n", help[line]);
@@ -147,6 +150,9 @@ int main(int argc, char *argv[]){
     //parse command line input
     sscanf(argv[1], "%[^\t\n]", &gallist_path);
     sscanf(argv[2], "%[^\t\n]", &dislist_path);
+    int     center = 0;         //embed the center pixel instead of the center of the bounding box
+    if(argc == 4)
+        sscanf(argv[3], "%i", &center);
     //fprintf(stdout, "gallist_path: %s\n", gallist_path);
 
     //parse gallist file
@@ -187,7 +193,7 @@ int main(int argc, char *argv[]){
     int     g;  //galaxies counter
     for(g = 0; g < ngalaxies; g++){
         fscanf(gallist_file, "%s\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%f\t%s\t%s", &buffer1, &galaxies[g].x, &galaxies[g].y, &galaxies[g].angle, &galaxies[g].redshift, &galaxies[g].pixscale, &galaxies[g].old_mag, &galaxies[g].old_r50, &galaxies[g].new_mag, &galaxies[g].new_r50, &buffer2, &buffer3);
-        galaxies[g].image = (char *) calloc(strlen(buffer1), sizeof(char));
+        galaxies[g].image = (char *) calloc(strlen(buffer1)+1, sizeof(char));
         galaxies[g].stamp1 = (char *) calloc(strlen(buffer2)+1, sizeof(char));
         galaxies[g].stamp2 = (char *) calloc(strlen(buffer3)+1, sizeof(char));
         if(galaxies[g].image == NULL || galaxies[g].stamp1 == NULL || galaxies[g].stamp2 == NULL){
@@ -300,6 +306,13 @@ int main(int argc, char *argv[]){
         //specify the coordinates where the lower left-most pixel of this image should be embedded in the galaxy field
         long int    xembed = (long int) (0.5 + galaxies[g].x - (1+(float) tgalnaxes[0])/2);
         long int    yembed = (long int) (0.5 + galaxies[g].y - (1+(float) tgalnaxes[1])/2);
+
+        //with center the center pixel (xc, yc) goes to (x, y), as above when the bounding box is
+        //symmetric, so that the position does not depend on the bulge and disk weights of the galaxy
+        if(center){
+            xembed = (long int) (0.5 + galaxies[g].x) - (xc - xmin) - 1;
+            yembed = (long int) (0.5 + galaxies[g].y) - (yc - ymin) - 1;
+        }
 	
 	// Edited by Bhishan Poudel on date Jun 01, 2017
 	// Overwrite existing output transformed stamps.
@@ -315,6 +328,7 @@ int main(int argc, char *argv[]){
         fits_create_img(outfptr, FLOAT_IMG, naxis, tgalnaxes, &status);
         fits_update_key(outfptr, TLONG, "XEMBED", &xembed, "x pixel in targe image to embed lower left pixel.", &status);
         fits_update_key(outfptr, TLONG, "YEMBED", &yembed, "y pixel in targe image to embed lower left pixel.", &status);
+        fits_update_key(outfptr, TFLOAT, "TFLUX", &total, "total flux before photoscale.", &status);
                 fits_update_key(outfptr,TSTRING,"IMAGE NAME", galaxies[g].image,"",&status);
         fits_write_pix(outfptr, TFLOAT, fpixel, tgalnaxes[0]*tgalnaxes[1], pgal, &status);
 
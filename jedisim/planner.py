@@ -0,0 +1,258 @@
+#!python
+# -*- coding: utf-8 -*-
+"""Plan a run from physics_settings/config.sh without running it.
+
+:Info:
+
+  1. For each program the number of calls, the peak memory and the disk
+     written are estimated from nx, ny, num_galaxies, num_source_images,
+     x_trim, y_trim, pix_scale, final_pix_scale and the psf size, for the
+     normal and the rotated case.
+  2. The wall time is estimated from a cost model, seconds per unit of work
+     (galaxies or pixels) of each program, calibrated by the json of
+     benchmark.py or by the stage log of a previous run.
+  3. The totals take into account max_parallel_jobs, parallel_iterations and
+     parallel_realizations, and are checked against the available memory and
+     the free space of the output folder.
+
+:Usage:
+
+  python planner.py
+  python planner.py --calibrate jedisim_out/benchmark.json
+  python planner.py --calibrate jedisim_out/stage_log.jsonl
+
+.. note::
+
+  The sizes of the stamps of jeditransform and the distorted stamps of
+  jedidistort depend on the catalog. They are measured from the output
+  folder of a previous run if there is one, else rough defaults are used.
+
+"""
+# Imports
+from __future__ import print_function, unicode_literals, division, absolute_import
+import os
+import glob
+import json
+import shutil
+from util import NUMBANDS, convolve_memory, available_memory
+from util import read_stage_log, stamp_extension
+from run_jedimaster import config_dict, config_path
+
+# Global Variables
+PSF_SHAPE = (4000, 4072)    # (NAXIS1, NAXIS2) of psf/psf*.fits
+SOURCE_SIZE = 601           # bulge and disk stamps are 601 x 601
+STAMP_BYTES = {'gzip': 15e3, 'none': 30e3}    # one stamp of jeditransform
+DISTORTED_BYTES = 40e3      # one distorted stamp of jedidistort
+SMALL = 10e6                # programs holding only lists and one stamp
+FITS_BLOCK = 2880
+
+
+def fits_bytes(npixels, bytes_per_pixel=4):
+    """Return the size of a fits file with one header block."""
+    data = npixels * bytes_per_pixel
+    return FITS_BLOCK + FITS_BLOCK * ((data + FITS_BLOCK - 1) // FITS_BLOCK)
+
+
+def psf_shape():
+    """Return the shape of psf/psf0.fits, or PSF_SHAPE if it is not there."""
+    # Imports
+    from astropy.io import fits
+
+    for path in ['psf/psf0.fits', 'psf/psf0.fits.gz']:
+        if os.path.exists(path):
+            header = fits.getheader(path)
+            return header['NAXIS1'], header['NAXIS2']
+    return PSF_SHAPE
+
+
+def stamp_sizes(config):
+    """Return the mean bytes of a stamp and a distorted stamp.
+
+    They are measured from the output folder of a previous run if possible.
+    """
+    sizes = []
+    stamps = 'stamp_*/*' + stamp_extension(config)
+    for pattern, default in [(stamps, STAMP_BYTES[config.get('stamp_codec', 'gzip')]),
+                             ('distorted_*/*', DISTORTED_BYTES)]:
+        files = glob.glob(os.path.join(config['output_folder'], pattern))[:2000]
+        if files:
+            sizes.append(sum(os.path.getsize(f) for f in files) / len(files))
+        else:
+            sizes.append(default)
+    return sizes
+
+
+def stage_table(config):
+    """Return the calls, work, peak memory and disk of each program.
+
+    calls is (calls outside the loop, calls inside the 21 loop) and
+    calls and disk are for the normal and rotated cases together,
+    disk is what stays on disk at the end of the run (outputs of one
+    iteration are overwritten by the next one).
+    """
+    nx, ny = int(config['nx']), int(config['ny'])
+    ngal = int(config['num_galaxies'])
+    nsrc = int(config['num_source_images'])
+    scale = float(config['final_pix_scale']) / float(config['pix_scale'])
+    lx = int((nx - 2 * int(config['x_trim'])) / scale)
+    ly = int((ny - 2 * int(config['y_trim'])) / scale)
+    px, py = psf_shape()
+    stamp, distorted = stamp_sizes(config)
+    npix, nlsst = nx * ny, lx * ly
+    grids = sum(16 * (nx >> b) * (ny >> b) for b in [3, 6, 9, 12])
+    maps = int(config.get('resample_maps', 0))
+    field = 32 * npix if int(config.get('deflection_field', 0)) or config.get('kappa_map') or maps else 0
+
+    # With bulge_disk_decomposition the galaxies are rendered for two bases
+    # before the loop instead of once per iteration
+    bases = 2 if int(config.get('bulge_disk_decomposition', 0)) else 0
+    render = (2 * bases, 0) if bases else (0, 42)
+    copies = max(1, bases)
+
+    # With effective_psf only the monochromatic iteration and about 4
+    # convolutions with effective psfs are run in a3 and a4
+    if int(config.get('effective_psf', 0)):
+        render = (4, 0)
+        copies = 2
+        convolve, paste, average = (0, 2 * 5), (0, 2 * 2 * 5), (0, 0)
+    else:
+        convolve, paste, average = (0, 42), (0, 84), (2, 0)
+
+    # With resample_maps the geometry of jeditransform and jedidistort is
+    # computed once per case, at about the cost of one call
+    geometry = (2, 0) if maps and render == (0, 42) else render
+
+    # With rotate_stamps the rotated case lenses the stamps of the normal
+    # case, jedicolor and jeditransform run only for the normal case
+    rotate = int(config.get('rotate_stamps', 0)) and geometry == (0, 42)
+    color = (0, 21) if rotate else render
+    transform = (0, 21) if rotate else geometry
+
+    # With fft_convolve convolve.py writes the convolved image, jedipaste
+    # only pastes the galaxies
+    if int(config.get('fft_convolve', 0)):
+        paste = (paste[0], paste[1] // 2)
+
+    # With paste_window_mb jedipaste keeps about that much of its output
+    # image resident instead of one band
+    window = int(config.get('paste_window_mb', 0)) * 2 ** 20
+    band = min(window, 4 * npix) if window > 0 else 4 * npix // NUMBANDS
+
+    return [
+        # name,         calls,   work,       memory,                           disk
+        ('jedicolor',     (1 + color[0], color[1]),
+                                   nsrc,       3 * 8 * SOURCE_SIZE ** 2,         copies * 2 * nsrc * fits_bytes(SOURCE_SIZE ** 2)),
+        ('jedicatalog',   (1, 0),  ngal,       SMALL,                            2 * 3 * 300 * ngal),
+        ('jeditransform', transform, ngal,     SMALL,                            copies * 2 * ngal * stamp),
+        ('jedidistort',   geometry, ngal,      grids + SMALL,                    copies * 2 * ngal * distorted + field),
+        ('jedipaste',     paste,   npix,       band,                             2 * 2 * fits_bytes(npix)),
+        ('jediconvolve',  convolve, npix,      convolve_memory(nx, px, py),      2 * fits_bytes(npix)),
+        ('jedirescale',   convolve, npix,      4 * npix // NUMBANDS + 4 * nlsst, convolve[1] * fits_bytes(nlsst)),
+        ('jediaverage',   average, 21 * nlsst, 3 * 8 * nlsst,                    2 * fits_bytes(nlsst)),
+        ('jedinoise',     (4, 0),  nlsst,      4 * nlsst + SMALL,                2 * 2 * fits_bytes(nlsst)),
+    ]
+
+
+def calibrate(path, config):
+    """Return the seconds per unit of work of each program.
+
+    path is the json of benchmark.py (several sizes) or a stage log
+    (.jsonl) of a run with this config.sh.
+    """
+    per_work = {}
+    if path.endswith('.jsonl'):
+        work = {s[0]: s[2] for s in stage_table(config)}
+        for r in read_stage_log(path):
+            if r.get('stage') in work and not r['cache_hit']:
+                per_work.setdefault(r['stage'], []).append(r['wall_s'] / work[r['stage']])
+    else:
+        with open(path) as f:
+            results = json.load(f)
+        for case in results['cases'].values():
+            case_config = dict(config, nx=case['nx'], ny=case['ny'],
+                               num_galaxies=case['num_galaxies'])
+            work = {s[0]: s[2] for s in stage_table(case_config)}
+            for name, s in case['stages'].items():
+                if name in work:
+                    per_work.setdefault(name, []).append(
+                        s['wall_s'] / s['calls'] / work[name])
+    return {name: sum(v) / len(v) for name, v in per_work.items()}
+
+
+def plan(config, rates=None):
+    """Print the plan of a run and return (peak memory, peak disk, wall time)."""
+    rates = rates or {}
+    table = stage_table(config)
+    jobs = min(2, int(config.get('max_parallel_jobs', 1)))
+    workers = min(21, max(1, int(config.get('parallel_iterations', 0))))
+    realizations = max(1, int(config.get('parallel_realizations', 1)))
+
+    print("\n{:<15}{:>7}{:>12}{:>12}{:>12}{:>12}".format(
+          'stage', 'calls', 'mem [GB]', 'disk [GB]', 'call [s]', 'total [h]'))
+    serial = 0
+    loop = 0
+    for name, (outside, inside), work, memory, disk in table:
+        calls = outside + inside
+        seconds = rates[name] * work if name in rates else None
+        if seconds is not None:
+            serial += calls * seconds
+            loop += inside * seconds
+        print("{:<15}{:>7}{:>12.2f}{:>12.2f}{:>12}{:>12}".format(
+              name, calls, memory / 1e9, disk / 1e9,
+              '%.1f' % seconds if seconds is not None else 'n/a',
+              '%.2f' % (calls * seconds / 3600) if seconds is not None else 'n/a'))
+
+    # Memory: a3 and a4 with their parallel iterations, in each realization
+    loop_memory = max(row[3] for row in table)
+    peak_memory = realizations * jobs * workers * loop_memory
+
+    # Disk: the files of one iteration are kept once per workspace,
+    # the 21 rescaled files and the averaged files once
+    loop_stages = ['jedicolor', 'jeditransform', 'jedidistort', 'jedipaste', 'jediconvolve']
+    loop_disk = sum(row[4] for row in table if row[0] in loop_stages)
+    other_disk = sum(row[4] for row in table if row[0] not in loop_stages)
+    peak_disk = realizations * (other_disk + loop_disk * (workers if workers > 1 else 1))
+
+    # Wall time: the loops of a3 and a4 overlap with max_parallel_jobs=2
+    wall = None
+    if rates:
+        wall = serial - loop + loop / jobs / workers
+    missing = [s[0] for s in table if s[0] not in rates]
+
+    print("\nPeak memory : {:.1f} GB ({} realizations x {} jobs x {} iterations), "
+          "available {:.1f} GB".format(peak_memory / 1e9, realizations, jobs,
+                                       workers, available_memory() / 1e9))
+    folder = os.path.dirname(os.path.normpath(config['output_folder'])) or '.'
+    free = shutil.disk_usage(folder if os.path.exists(folder) else '.').free
+    print("Peak disk   : {:.1f} GB, free {:.1f} GB in {}".format(
+          peak_disk / 1e9, free / 1e9, folder))
+    if wall is not None:
+        print("Wall time   : {:.2f} hours per realization{}".format(
+              wall / 3600, ' (no cost for %s)' % ', '.join(missing) if missing else ''))
+    else:
+        print("Wall time   : n/a, calibrate with the json of benchmark.py or a stage log")
+
+    if peak_memory > available_memory():
+        print("Warning: not enough memory, lower parallel_iterations or max_parallel_jobs.")
+    if peak_disk > free:
+        print("Warning: not enough free disk space in %s." % folder)
+    return peak_memory, peak_disk, wall
+
+
+def main():
+    """Run main function."""
+    # Imports
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calibrate', metavar='FILE',
+                        help='json of benchmark.py or a stage log (.jsonl)')
+    args = parser.parse_args()
+
+    config = config_dict(config_path)
+    rates = calibrate(args.calibrate, config) if args.calibrate else None
+    plan(config, rates)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+#!python
+# -*- coding: utf-8 -*-
+"""Resampling maps of the galaxies, built once and applied in each iteration.
+
+:Info:
+
+  1. In each of the 21 iterations jeditransform rotates, scales and
+     interpolates the jedicolor image of every galaxy, and jedidistort lenses
+     the stamp, with the same geometry: only the pixel values change.
+  2. build_maps computes this geometry once per case, in float32 like the
+     C programs, and stores it in binary tables of iteration_scratch/maps0/
+     (maps90/ for the rotated case): for each pixel of the stamp, the pixel
+     and the offsets of its bilinear interpolation in the jedicolor image,
+     and for each pixel of the distorted stamp, the stamp pixels its 16
+     subpixels fall on.
+  3. apply_maps writes the distorted stamps of one iteration from the
+     jedicolor images with these tables, a gather and a sum per galaxy,
+     instead of running jeditransform and jedidistort. jedipaste reads them
+     as usual.
+  4. The deflection is read from the field of deflection.py, which is exact
+     (tolerance 0) unless deflection_field or kappa_map is set.
+
+:Usage:
+
+  Set resample_maps=1 in config.sh, a3 and a4 build the maps before the
+  loop and remove them at the end.
+
+.. note::
+
+  jeditransform crops each stamp to the pixels above 1e-7, which depends on
+  the pixel values. The maps use the union of these boxes for the bulge and
+  disk weights of jedicolor_args, so a stamp can have a few more pixels
+  below 1e-7 than the one of jeditransform. The flux outside the stamp,
+  which jeditransform counts in the total flux of the photometric scale,
+  is computed from the bulge and disk images once and weighted in each
+  iteration.
+
+"""
+# Imports
+from __future__ import print_function, unicode_literals, division, absolute_import
+import os
+import time
+import numpy as np
+from deflection import C_H_0, OMEGA_M, OMEGA_D, OPZEQ, NSUBPX, f32
+
+# Global Variables (the definitions of jeditransform.c and jedidistort.c)
+PI = 3.14159            # PI of jeditransform
+EPSILON = 0.0000001     # pixels of the stamps are above EPSILON
+MAG0 = 26.78212
+BITS = [3, 6, 9, 12]    # log2 of the sizes of the grid squares of jedidistort
+G = 8                   # sub-squares on a side of a grid square
+TABLES = [[('stamp_index', np.int32), ('stamp_xf', f32), ('stamp_yf', f32)],   # stamp pixels
+          [('pixel', np.int32), ('count', np.uint8)],                          # output pixels
+          [('sample', np.int32), ('repeat', np.uint8)]]                        # their subpixels
+
+
+def read_catalog(path):
+    """Return the columns of each line of catalog.txt as strings."""
+    with open(path) as f:
+        return [line.split() for line in f if line.strip()]
+
+
+def transform_table(n, angle, old_r50, new_r50):
+    """Return the bilinear interpolation of jeditransform for an n x n image.
+
+    Returns (index, xf, yf): the pixel y * n + x of the transformed image
+    interpolates the image at index + (xf, yf), or is 0 if index is -1.
+    """
+    scale = f32(old_r50) / f32(new_r50)
+    t = f32(float(f32(angle)) * PI / 180)
+    c, s = np.cos(t), np.sin(t)
+    xc = 1 + (n >> 1)
+    y, x = np.indices((n, n))
+    oldx = (x - xc).ravel().astype(f32)
+    oldy = (y - xc).ravel().astype(f32)
+    newx = scale * (oldx * c - oldy * s) + f32(xc)
+    newy = scale * (oldx * s + oldy * c) + f32(xc)
+
+    xi = np.trunc(newx).astype(np.int64)
+    yi = np.trunc(newy).astype(np.int64)
+    inside = (xi >= 0) & (xi < n - 1) & (yi >= 0) & (yi < n - 1)
+    index = np.where(inside, xi + n * yi, -1)
+    return index, newx - xi.astype(f32), newy - yi.astype(f32)
+
+
+def interpolate(image, n, index, xf, yf):
+    """Return the pixels of jeditransform, bilinear_interp in float32.
+
+    image is the raveled n x n image, index, xf and yf come from
+    transform_table.
+    """
+    i = np.maximum(index, 0)
+    one = f32(1)
+    value = (image[i] * (one - xf) * (one - yf) + image[i + 1] * xf * (one - yf)
+             + image[i + n] * (one - xf) * yf + image[i + n + 1] * xf * yf)
+    value[index < 0] = 0
+    return value
+
+
+def distance_table(z1, z2):
+    """Return the steps (z, dist) of angular_di_dist of jedidistort from z1 up to z2."""
+    dist, dz = f32(0), f32(0.001)
+    z = f32(1) + f32(z1)
+    zs, dists = [z], [dist]
+    while z < f32(1) + f32(z2):
+        dist = f32(float(dist) + float(dz) / np.sqrt(
+            OMEGA_M * (1.0 + float(z / f32(OPZEQ))) * float(z * z * z) + OMEGA_D))
+        z = f32(z + dz)
+        zs.append(z)
+        dists.append(dist)
+    return np.array(zs), np.array(dists)
+
+
+def prefactors(zl, zs):
+    """Return D_ls / D_s of jedidistort for the lens redshift zl and the sources zs.
+
+    The loop of angular_di_dist is run once for each of the two distances,
+    the one of each source is the step where it stops.
+    """
+    zs = np.asarray(zs, dtype=f32)
+    if len(zs) == 0:
+        return zs
+    out = []
+    for z1 in [zl, 0]:
+        z, dist = distance_table(z1, zs.max())
+        k = np.minimum(np.searchsorted(z, f32(1) + zs), len(z) - 1)
+        out.append((C_H_0 * dist[k].astype(float) / z[k].astype(float)).astype(f32))
+    return out[0] / out[1]
+
+
+def lens_grids(field):
+    """Return the grids of jedidistort, the range of alpha over squares of 2**BITS pixels.
+
+    Each grid is an array (xmin, xmax, ymin, ymax) of shape (4, ny >> b, nx >> b).
+    Like jedidistort, the coarser grids start from the first sub-square with
+    xmin and xmax swapped.
+    """
+    ny, nx = field.shape[:2]
+    rows = 1 << BITS[-1]
+    level = np.zeros((4, ny >> BITS[0], nx >> BITS[0]), f32)
+    for y0 in range(0, ny, rows):
+        alpha = np.array(field[y0:y0 + rows, :, 0, :]).reshape(-1, G, nx >> BITS[0], G, 2)
+        y = slice(y0 >> BITS[0], (y0 >> BITS[0]) + len(alpha))
+        level[0, y], level[1, y] = alpha[..., 0].min(axis=(1, 3)), alpha[..., 0].max(axis=(1, 3))
+        level[2, y], level[3, y] = alpha[..., 1].min(axis=(1, 3)), alpha[..., 1].max(axis=(1, 3))
+    grids = [level]
+    for b in BITS[1:]:
+        finer = grids[-1].reshape(4, ny >> b, G, nx >> b, G)
+        xmin, xmax = finer[0].copy(), finer[1].copy()
+        xmin[:, 0, :, 0], xmax[:, 0, :, 0] = finer[1, :, 0, :, 0], finer[0, :, 0, :, 0]
+        grids.append(np.array([xmin.min(axis=(1, 3)), xmax.max(axis=(1, 3)),
+                               finer[2].min(axis=(1, 3)), finer[3].max(axis=(1, 3))]))
+    return grids
+
+
+def mark_squares(grids, box, prefactor, nx):
+    """Return the columns and rows of the squares of 8 pixels which can see box.
+
+    box is (xmin, xmax, ymin, ymax) of the stamp in the frame. The squares
+    are tested from the coarsest grid down, like in jedidistort.
+    """
+    xmin, xmax, ymin, ymax = [f32(v) for v in box]
+    n = nx >> BITS[-1]
+    cols, rows = [a.ravel() for a in np.indices((n, n))]
+    sub = np.indices((G, G)).reshape(2, 1, -1)
+    for level in range(len(BITS) - 1, -1, -1):
+        ax0, ax1, ay0, ay1 = grids[level][:, cols, rows]
+        size = 1 << BITS[level]
+        keep = (((rows * size).astype(f32) - prefactor * ax1 < xmax)
+                & (((rows + 1) * size).astype(f32) - prefactor * ax0 > xmin)
+                & (((cols + 1) * size).astype(f32) - prefactor * ay0 > ymin)
+                & ((cols * size).astype(f32) - prefactor * ay1 < ymax))
+        rows, cols = rows[keep], cols[keep]
+        if level > 0:
+            rows = (G * rows[:, None] + sub[1]).ravel()
+            cols = (G * cols[:, None] + sub[0]).ravel()
+    return rows, cols
+
+
+def distort_samples(field, rows, cols, box, prefactor):
+    """Return the pixels of the squares rows, cols and the stamp pixels of their subpixels.
+
+    Returns (ox, oy, p): the pixels in the frame and, for each of their
+    NSUBPX**2 subpixels, the stamp pixel y * width + x it falls on in box,
+    or -1 if it falls outside.
+    """
+    xmin, xmax, ymin, ymax = [int(v) for v in box]
+    sub = np.arange(G)
+    ox = (G * rows[:, None, None] + sub[:, None] + 0 * sub).ravel()
+    oy = (G * cols[:, None, None] + sub[None, :] + 0 * sub[:, None]).ravel()
+    alpha = field[oy, ox]
+
+    # Axis 1 is sx and axis 2 is sy, alpha is taken at subpixel sy for both
+    s = np.arange(NSUBPX, dtype=f32) / f32(NSUBPX)
+    x = np.trunc((ox[:, None, None].astype(f32) + s[:, None])
+                 - prefactor * alpha[:, None, :, 0]).astype(np.int64)
+    y = np.trunc((oy[:, None, None].astype(f32) + s[None, :])
+                 - prefactor * alpha[:, None, :, 1]).astype(np.int64)
+    x, y = np.broadcast_arrays(x, y)
+    inside = (x >= xmin) & (x < xmax) & (y >= ymin) & (y < ymax)
+    p = np.where(inside, (y - ymin) * (xmax - xmin) + (x - xmin), -1)
+    return ox, oy, p.reshape(len(ox), -1)
+
+
+def galaxy_map(field, grids, nx, row, bulge, disk, b, d, prefactor):
+    """Return the map of the galaxy of the catalog line row.
+
+    bulge and disk are the images of its source, b and d the weights of
+    jedicolor_args. Returns (ofx, ofy, onx, ony), the flux of the bulge and
+    the disk outside the stamp, and the tables of TABLES.
+    """
+    x, y, angle, z, pixscale, old_mag, old_r50, new_mag, new_r50 = [f32(v) for v in row[1:10]]
+    n = bulge.shape[1]
+    index, xf, yf = transform_table(n, angle, old_r50, new_r50)
+    bulge, disk = bulge.ravel(), disk.ravel()
+
+    # The stamp of jeditransform for any of the bulge and disk weights
+    tb = interpolate(bulge, n, index, xf, yf).astype(float)
+    td = interpolate(disk, n, index, xf, yf).astype(float)
+    keep = np.zeros(n * n, bool)
+    for bi, di in zip(b, d):
+        keep |= bi * tb + di * td > EPSILON
+    if not keep.any():
+        keep[(n >> 1) * (n + 1)] = True
+    sy, sx = np.divmod(np.flatnonzero(keep), n)
+    xmin, xmax, ymin, ymax = sx.min(), sx.max() + 1, sy.min(), sy.max() + 1
+    stamp = (slice(ymin, ymax), slice(xmin, xmax))
+    tails = [t.sum() - t.reshape(n, n)[stamp].sum() for t in (tb, td)]
+
+    xc = 1 + (n >> 1)
+    xembed = int(0.5 + float(x)) - (xc - xmin) - 1
+    yembed = int(0.5 + float(y)) - (xc - ymin) - 1
+    box = (xembed, xembed + xmax - xmin, yembed, yembed + ymax - ymin)
+
+    # The subpixels of jedidistort on each stamp pixel, for each output pixel
+    rows, cols = mark_squares(grids, box, prefactor, nx)
+    if len(rows) == 0:
+        geometry = (0, 0, G, G)
+        pixels, counts = np.zeros(0, int), np.zeros(0, int)
+        samples, repeats = np.zeros(0, int), np.zeros(0, int)
+    else:
+        ofx, ofy = rows.min() * G, cols.min() * G
+        geometry = (ofx, ofy, (rows.max() + 1) * G - ofx, (cols.max() + 1) * G - ofy)
+        ox, oy, p = distort_samples(field, rows, cols, box, prefactor)
+        p.sort(axis=1)
+        p = p.ravel()
+        first = np.ones(len(p), bool)
+        first[1:] = p[1:] != p[:-1]
+        first[::NSUBPX * NSUBPX] = True
+        starts = np.flatnonzero(first)
+        repeats = np.diff(np.append(starts, len(p)))
+        valid = p[starts] >= 0
+        starts, repeats = starts[valid], repeats[valid]
+        samples = p[starts]
+        counts = np.bincount(starts // (NSUBPX * NSUBPX), minlength=len(ox))
+        pixels = ((oy - ofy) * geometry[2] + (ox - ofx))[counts > 0]
+        counts = counts[counts > 0]
+    stamp_table = [a.reshape(n, n)[stamp].ravel() for a in (index, xf, yf)]
+    return geometry, tails, [stamp_table, [pixels, counts], [samples, repeats]]
+
+
+def build_maps(folder, config, color_infile, catalog_file, b, d):
+    """Build the maps of the galaxies of catalog_file into folder.
+
+    color_infile gives the bulge and disk images of each jedicolor image,
+    b and d are the weights of jedicolor_args.
+    """
+    # Imports
+    from astropy.io import fits
+    from deflection import field_file, load_field
+    from util import log_span
+
+    start = time.time()
+    if not (int(config.get('deflection_field', 0)) or config.get('kappa_map', '')):
+        config = dict(config, deflection_field='1', deflection_tolerance='0')
+    field = load_field(field_file(config))
+    grids = lens_grids(field)
+    nx = int(config['nx'])
+
+    with open(color_infile) as f:
+        sources = {os.path.normpath(l[2]): l[:2] for l in (line.split() for line in f) if l}
+    rows = read_catalog(catalog_file)
+    zs = [f32(float('%f' % float(f32(row[4])))) for row in rows]
+    prefactor = prefactors(f32(config['lens_z']), zs)
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    files = [[open(os.path.join(folder, name + '.bin'), 'wb') for name, dtype in group]
+             for group in TABLES]
+    offsets = np.zeros(len(TABLES), np.int64)
+    galaxies = np.zeros((len(rows), 4 + 2 * len(TABLES)), np.int64)
+    tails = np.zeros((len(rows), 2))
+    current = None
+    for k in sorted(range(len(rows)), key=lambda k: rows[k][0]):
+        if rows[k][0] != current:
+            current = rows[k][0]
+            bulge, disk = [fits.getdata(path).astype(f32)
+                           for path in sources[os.path.normpath(current)]]
+        geometry, tails[k], tables = galaxy_map(field, grids, nx, rows[k], bulge, disk,
+                                                b, d, prefactor[k])
+        for group_files, group, group_tables in zip(files, TABLES, tables):
+            for f, (name, dtype), table in zip(group_files, group, group_tables):
+                f.write(np.asarray(table, dtype=dtype).tobytes())
+        lengths = [len(group_tables[0]) for group_tables in tables]
+        galaxies[k] = np.concatenate([geometry, np.ravel([offsets, offsets + lengths], 'F')])
+        offsets += lengths
+    for f in sum(files, []):
+        f.close()
+    np.save(os.path.join(folder, 'galaxies.npy'), galaxies)
+    np.save(os.path.join(folder, 'tails.npy'), tails)
+    np.save(os.path.join(folder, 'new_mag.npy'), np.array([f32(row[8]) for row in rows], f32))
+    log_span('resample maps', start)
+
+
+def load_table(folder, name, dtype):
+    """Return the table name of folder memory-mapped, or empty."""
+    path = os.path.join(folder, name + '.bin')
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def apply_maps(folder, catalog_file, b, d):
+    """Write the distorted stamps of catalog_file from the jedicolor images.
+
+    The jedicolor image of each galaxy is its first column and the distorted
+    stamp its last one, like for jeditransform and jedidistort. b and d are
+    the weights of jedicolor for the flux outside the stamps. Returns the
+    paste index (XEMBED, YEMBED, NAXIS1, NAXIS2) of the distorted stamps.
+    """
+    # Imports
+    from astropy.io import fits
+
+    galaxies = np.load(os.path.join(folder, 'galaxies.npy'))
+    tails = np.load(os.path.join(folder, 'tails.npy'))
+    new_mag = np.load(os.path.join(folder, 'new_mag.npy'))
+    (stamp_index, stamp_xf, stamp_yf), (pixels, counts), (samples, repeats) = [
+        [load_table(folder, name, dtype) for name, dtype in group] for group in TABLES]
+    rows = read_catalog(catalog_file)
+
+    current = None
+    for k in sorted(range(len(rows)), key=lambda k: rows[k][0]):
+        if rows[k][0] != current:
+            current = rows[k][0]
+            image = fits.getdata(current).astype(f32)
+            n = image.shape[1]
+            image = image.ravel()
+        ofx, ofy, onx, ony, u0, u1, r0, r1, s0, s1 = galaxies[k]
+
+        # The stamp of jeditransform
+        stamp = interpolate(image, n, stamp_index[u0:u1], stamp_xf[u0:u1], stamp_yf[u0:u1])
+        total = f32(stamp.sum(dtype=float) + b * tails[k, 0] + d * tails[k, 1])
+        with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+            mag = f32(MAG0 - 2.5 * float(np.log10(total)))
+            photoscale = f32(10.0 ** (float(mag - new_mag[k]) / 2.5))
+            stamp *= photoscale
+
+        # The average of the subpixels of jedidistort
+        out = np.zeros(onx * ony, f32)
+        if r1 > r0:
+            values = repeats[s0:s1] * stamp[samples[s0:s1]]
+            starts = np.zeros(r1 - r0, np.int64)
+            np.cumsum(counts[r0:r1 - 1], dtype=np.int64, out=starts[1:])
+            out[pixels[r0:r1]] = np.add.reduceat(values, starts) / f32(NSUBPX * NSUBPX)
+
+        header = fits.Header()
+        header['XEMBED'] = (int(ofx), 'x of the lower left pixel in the target image')
+        header['YEMBED'] = (int(ofy), 'y of the lower left pixel in the target image')
+        fits.writeto(rows[k][-1], out.reshape(ony, onx), header, overwrite=True)
+    return galaxies[:, :4]
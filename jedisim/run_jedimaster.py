@@ -27,6 +27,10 @@
   1. This is a wrapper script to jedimaster.py.
   2. Basically it copies the final outputs of jedimaster to a different
      directory in each loop.
+  3. With parallel_realizations > 1 in config.sh, the realizations run at
+     the same time, each one inside its own working directory.
+  4. With --queue the realizations are added to a work queue instead,
+     and run by --worker processes on any node (see work_queue.py).
 
 :Runtime:
 
@@ -46,7 +50,9 @@ import re
 import shutil
 import copy
 import time
-from util import run_process
+from util import run_process, replace_outfolder, iteration_memory, pool_size
+from util import set_stage_log, log_span, read_stage_log, write_trace
+from work_queue import create_queue, add_job, queue_status, run_worker
 
 # start time
 start_time = time.time()
@@ -77,54 +83,259 @@ def config_dict(config_path):
                     config[temp[0]] = value_regex.findall(temp[1])[0]
     return config
 
-def run_jedimaster(start, end):
+def final_outputs(config, outfolder, i):
+    """Return (infile, outfile) of the final outputs of realization i.
+
+    The infiles are the noised averaged images and the noised monochromatic
+    images of jedimaster.py, as given in config.sh.
+    """
+    prefix = config['prefix'] + config['LSST_averaged_noised_image']
+    infiles = [config['output_folder'] + prefix,
+               config['90_output_folder'] + '90_' + prefix,
+               config['monochromatic_outfits'],
+               config['monochromatic_outfits90']]
+    outfiles = ['lsst_{:d}.fits', 'lsst_90_{:d}.fits',
+                'monochromatic_{:d}.fits', 'monochromatic_90_{:d}.fits']
+    return [(infile, outfolder + outfile.format(i))
+            for infile, outfile in zip(infiles, outfiles)]
+
+
+def set_config_values(path, values):
+    """Replace the values of the given keys of a config.sh file.
+
+    String values are quoted again, the comments of these lines are dropped.
+    """
+    with open(path) as f:
+        lines = f.readlines()
+    with open(path, 'w') as f:
+        for line in lines:
+            key = line.split("=")[0]
+            if not line.startswith("#") and key in values:
+                quote = '"' if line.split("=")[1].startswith('"') else ''
+                line = '%s=%s%s%s\n' % (key, quote, values[key], quote)
+            f.write(line)
+
+
+def make_realization(workdir, config, values=None):
+    """Make a working directory for one realization of jedimaster.py.
+
+    The scripts, executables, psf and input databases are linked and
+    physics_settings is copied, so that the relative output paths of
+    config.sh (jedisim_out/out0, simdatabase/bulge_disk_f8, ...) are
+    inside workdir.
+
+    :Example:
+
+      jedisim_realizations/r_3/jedisim_out/out0/
+      jedisim_realizations/r_3/simdatabase/bulge_disk_f8/
+      jedisim_realizations/r_3/executables --> executables
+
+    values replaces config.sh values of this realization, e.g. the seed.
+    """
+    # Imports
+    import glob
+
+    replace_outfolder(workdir)
+    links = ['executables', 'psf'] + glob.glob('*.py')
+    color_outfolders = [config['color_outfolder'], config['color_outfolder90']]
+    os.makedirs(os.path.join(workdir, 'simdatabase'))
+    for path in glob.glob('simdatabase/*'):
+        if os.path.normpath(path) not in map(os.path.normpath, color_outfolders):
+            links.append(path)
+    for path in links:
+        os.symlink(os.path.abspath(path), os.path.join(workdir, path))
+
+    shutil.copytree('physics_settings', os.path.join(workdir, 'physics_settings'))
+
+    # All the realizations share one stage cache, distort cache, psf spectrum cache and stage log
+    values = dict(values or {})
+    for key in ['stage_cache_dir', 'distort_cache', 'psf_spectrum_cache', 'stage_log', 'kappa_map']:
+        if config.get(key):
+            values.setdefault(key, os.path.abspath(config[key]))
+    set_config_values(os.path.join(workdir, config_path), values)
+
+
+def realization_workdir(config, i, attempt=0):
+    """Return the working directory of realization i, of a claim if attempt > 0."""
+    if attempt:
+        return config['realization_scratch'] + 'r_%d_a%d/' % (i, attempt)
+    return config['realization_scratch'] + 'r_%d/' % i
 
-    # Get redshift
+
+def realization_values(config, i):
+    """Return the config.sh values of realization i of the pool.
+
+    With a seed in config.sh, realization i gets seed + i like the jobs of
+    queue_jedimaster, else jedicatalog seeds each galaxy from the clock.
+    """
+    seed = int(config.get('seed', 0))
+    return {'seed': seed + i} if seed else {}
+
+
+def run_realization(i, outfolder, values=None, attempt=0):
+    """Run jedimaster.py inside its own working directory.
+
+    The final outputs are copied to outfolder and the working directory
+    is removed. Returns the list of copied files. attempt > 0 (a claim of
+    the work queue) gives each claim of a realization its own directory,
+    so a worker which lost its lease does not share it with the next one.
+    """
     config = config_dict(config_path)
+    workdir = realization_workdir(config, i, attempt)
+    make_realization(workdir, config, values)
+    set_stage_log(config.get('stage_log'))
+    os.environ['JEDISIM_REALIZATION'] = str(i)
+    start = time.time()
+    run_process("jedimaster.py", ['python', "jedimaster.py"], cwd=workdir)
+    log_span('realization %i' % i, start)
+    outfiles = []
+    for infile, outfile in final_outputs(config, outfolder, i):
+        shutil.copyfile(os.path.join(workdir, infile), outfile)
+        outfiles.append(outfile)
+    shutil.rmtree(workdir)
+    return outfiles
+
+
+def realization_memory(config):
+    """Return the peak memory of one realization in bytes.
+
+    Up to max_parallel_jobs simulations run at the same time, each with up to
+    parallel_iterations loop iterations.
+    """
+    jobs = int(config.get('max_parallel_jobs', 1))
+    iterations = max(1, int(config.get('parallel_iterations', 0)))
+    job_memory = iteration_memory(int(config['nx']), int(config['ny']),
+                                  'psf/psf0.fits')
+    return jobs * iterations * job_memory
+
+
+def jedimaster_outfolder(config):
+    """Create and return jedisim_output/jout_z<redshift>_2017_<date>/."""
     z = config['fixed_redshift']
-
-    # create outfolder names
     outfolder = 'jedisim_output/jout_z{}_2017'.format(z) + time.strftime("_%b_%d_%H_%M/")
     print(outfolder)
 
     if not os.path.exists(outfolder):
         os.makedirs(outfolder)
+    return outfolder
 
-    # run jedimaster in a loop
-    for i in range(start, end+1):
-        print('{} {} {}'.format('Running jedimaster loop :', i, ''))
 
-        run_process("jedimaster.py", ['python', "jedimaster.py"])
+def run_jedimaster(start, end):
+    """Run the realizations start to end (inclusive) of jedimaster.py.
 
-        # copy final output files
-        infile1 = r'jedisim_out/out0/trial1_LSST_averaged_noised.fits'
-        outfile1 = outfolder + 'lsst_{:d}.fits'.format(i)
+    If parallel_realizations in config.sh is larger than 1, the realizations
+    run at the same time, each one inside its own working directory.
+    """
+    # Imports
+    from concurrent.futures import ProcessPoolExecutor, as_completed
 
-        infile2 = r'jedisim_out/out90/90_trial1_LSST_averaged_noised.fits'
-        outfile2 = outfolder + 'lsst_90_{:d}.fits'.format(i)
+    # create outfolder names
+    config = config_dict(config_path)
+    outfolder = jedimaster_outfolder(config)
 
-        infile3 = r'jedisim_out/rescaled_lsst/rescaled_noised_lsst_10.fits'
-        outfile3 = outfolder + 'monochromatic_{:d}.fits'.format(i)
+    # All the programs of the sweep are marked in the stage log
+    run = '%s:%i:%i' % (os.uname()[1], os.getpid(), int(time.time()))
+    os.environ['JEDISIM_RUN'] = run
+    set_stage_log(config.get('stage_log'))
 
-        infile4 = r'jedisim_out/rescaled_lsst90/rescaled_noised_lsst90_10.fits'
-        outfile4 = outfolder + 'monochromatic_90_{:d}.fits'.format(i)
+    # run jedimaster in a loop
+    max_workers = int(config.get('parallel_realizations', 1))
+    if max_workers <= 1:
+        for i in range(start, end+1):
+            print('{} {} {}'.format('Running jedimaster loop :', i, ''))
+
+            os.environ['JEDISIM_REALIZATION'] = str(i)
+            start_i = time.time()
+            run_process("jedimaster.py", ['python', "jedimaster.py"])
+            log_span('realization %i' % i, start_i)
+
+            # copy final output files
+            for infile, outfile in final_outputs(config, outfolder, i):
+                shutil.copyfile(infile, outfile)
+        write_sweep_trace(config, run)
+        return
+
+    # run the realizations on a process pool
+    nworkers = pool_size(max_workers, realization_memory(config))
+    print('Running {} realizations on {} workers.'.format(end - start + 1, nworkers))
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        futures = {pool.submit(run_realization, i, outfolder, realization_values(config, i)): i
+                   for i in range(start, end+1)}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                print("Error: realization %i did not terminate correctly." % futures[future])
+                for f in futures:
+                    f.cancel()
+                sys.exit(1)
+            print('{} {} {}'.format('Finished jedimaster loop :', futures[future], ''))
+    write_sweep_trace(config, run)
+
+
+def write_sweep_trace(config, run):
+    """Write the timeline of all the realizations of run to trace_file."""
+    records = read_stage_log(config.get('stage_log'), run)
+    if config.get('trace_file') and records:
+        write_trace(records, config['trace_file'])
+
+
+def queue_jedimaster(db_path, start, end):
+    """Add the realizations start to end (inclusive) to a work queue.
+
+    Each job gets its own seed for jedicatalog, seed + i if seed is set
+    in config.sh, and the redshift and lens file of config.sh.
+    The jobs can be run by workers on any node sharing db_path.
+    """
+    config = config_dict(config_path)
+    outfolder = os.path.abspath(jedimaster_outfolder(config)) + '/'
+    seed = int(config.get('seed', 0)) or int(time.time())
+    create_queue(db_path)
+    for i in range(start, end+1):
+        add_job(db_path, i, seed + i, config['fixed_redshift'],
+                os.path.abspath(config['lenses_file']), outfolder)
+    print('Queued realizations {} to {}: {}'.format(start, end, queue_status(db_path)))
+
+
+def run_queue_job(job):
+    """Run one job of the work queue and return its output files.
+
+    The working directory of a failed claim is removed before the job
+    goes back to the queue.
+    """
+    values = {'seed': job['seed'],
+              'fixed_redshift': job['redshift'],
+              'lenses_file': job['lens_file']}
+    try:
+        return run_realization(job['realization'], job['outfolder'], values,
+                               job['attempts'] + 1)
+    except (Exception, SystemExit):
+        workdir = realization_workdir(config_dict(config_path), job['realization'],
+                                      job['attempts'] + 1)
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
 
-        shutil.copyfile(infile1, outfile1)
-        shutil.copyfile(infile2, outfile2)
-        shutil.copyfile(infile3, outfile3)
-        shutil.copyfile(infile4, outfile4)
 
-        # print('{} {} {}'.format('!' * 80, '', ''))
-        # print('{} {} {} {}'.format('!' * 35, ' End of jedimaster loop :', i, '!' * 35))
-        # print('{} {} {}'.format('!' * 80, '\n', ''))
+def main():
+    """Run main function.
 
+    :Usage:
 
-def main():
-    """Run main function."""
+      python run_jedimaster.py
+      python run_jedimaster.py --queue jobs.db
+      python run_jedimaster.py --worker jobs.db
+
+    """
     # start, end inclusive
     # no. of loop = end - start + 1
     start, end = 0,2
-    run_jedimaster(start, end)
+    if len(sys.argv) == 3 and sys.argv[1] == '--queue':
+        queue_jedimaster(sys.argv[2], start, end)
+    elif len(sys.argv) == 3 and sys.argv[1] == '--worker':
+        config = config_dict(config_path)
+        run_worker(sys.argv[2], run_queue_job,
+                   float(config.get('queue_lease_seconds', 900)),
+                   int(config.get('queue_max_attempts', 3)))
+    else:
+        run_jedimaster(start, end)
 
 
 if __name__ == "__main__":
@@ -15,6 +15,7 @@ import re
 import shutil
 import copy
 import time
+import threading
 import numpy as np
 
 
@@ -28,7 +29,7 @@ def replace_outfolder(outfolder):
         print('Making new folder: ', outfolder)
         os.makedirs(outfolder)
 
-def run_process(name, args,):
+def run_process(name, args, inputs=None, outputs=None, cwd=None):
     """Run a process.
 
     :Usage: 
@@ -38,6 +39,16 @@ def run_process(name, args,):
     The first argument "example" is optional.
     
     Also note the whitespace after the command python.
+
+    If the stage cache is turned on (see set_stage_cache) and both the
+    input and output files of the program are given, the outputs are
+    copied from the cache when the same program was already run with
+    the same arguments and input files.
+
+    If cwd is given, the program runs inside that folder.
+
+    If the stage log is turned on (see set_stage_log), the wall time,
+    cpu times, max rss and io bytes of the program are appended to it.
     
     .. note::
     
@@ -51,14 +62,1074 @@ def run_process(name, args,):
 
     print("\n", "#" * 130, end='\n\n')
 
-    process = subprocess.Popen(args)
+    key = None
+    start = time.time()
+    if stage_cache['dir'] and inputs is not None and outputs is not None:
+        key = stage_key(args, inputs)
+        if cache_restore(key, outputs):
+            stage_cache['hits'] += 1
+            log_stage(name, args, start, 0, cache_hit=True, cached=True)
+            print("\n\n", "#" * 129, end='\n')
+            print("# Cache hit! : %s (%s, %i hits, %i misses)" % (name,
+                  key[:12], stage_cache['hits'], stage_cache['misses']))
+            print("\b", "#" * 129, "\n\n\n")
+            return
+        stage_cache['misses'] += 1
+
+    process = subprocess.Popen(args, cwd=cwd)
 
-    process.communicate()
+    usage = wait_process(process)
+    log_stage(name, args, start, process.returncode, usage, cached=key is not None)
     if process.returncode != 0:
         print("Error: %s did not terminate correctly. \
               Return code: %i." % (name, process.returncode))
         sys.exit(1)
     else:
+        if key is not None:
+            cache_store(key, outputs)
         print("\n\n", "#" * 129, end='\n')
         print("# Success! : %s " % name)
         print("\b", "#" * 129, "\n\n\n")
+
+
+# Stage log of run_process, turned on by set_stage_log().
+stage_log = {'path': None}
+
+# Lane of the programs of a thread in the trace, e.g. the chunks of run_distort
+stage_lane = threading.local()
+
+
+def set_stage_log(path):
+    """Append one json record per program run by run_process to path.
+
+    An empty path leaves the stage log off.
+    """
+    if not path:
+        return
+    stage_log['path'] = path
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+
+def proc_io(pid):
+    """Return the bytes read and written by a process from /proc/<pid>/io."""
+    try:
+        with open('/proc/%i/io' % pid) as f:
+            fields = dict(line.split(':') for line in f)
+        return {'read_bytes': int(fields['read_bytes']),
+                'write_bytes': int(fields['write_bytes'])}
+    except (IOError, OSError, KeyError, ValueError):
+        return {'read_bytes': None, 'write_bytes': None}
+
+
+def wait_process(process):
+    """Wait for a process and return its resource usage.
+
+    The cpu times and max rss are the ones of this process only, from
+    wait4, so programs running at the same time in other threads are not
+    counted. On Linux the finished process is looked at before it is
+    reaped, for its io bytes.
+    """
+    io = {'read_bytes': None, 'write_bytes': None}
+    if hasattr(os, 'waitid') and os.path.exists('/proc/%i' % process.pid):
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        io = proc_io(process.pid)
+    _, status, r = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+
+    # ru_maxrss is in bytes on mac
+    maxrss = r.ru_maxrss // 1024 if sys.platform == 'darwin' else r.ru_maxrss
+    usage = {'user_s': r.ru_utime, 'sys_s': r.ru_stime, 'max_rss_kb': maxrss}
+    usage.update(io)
+    return usage
+
+
+def append_stage_log(record):
+    """Append a record to the stage log with the run, realization and process.
+
+    The run and realization are the JEDISIM_RUN and JEDISIM_REALIZATION
+    environment variables set by jedimaster.py and run_jedimaster.py,
+    the cache scope is the one of set_cache_scope.
+    """
+    import json
+    if not stage_log['path']:
+        return
+    record['run'] = os.environ.get('JEDISIM_RUN', '')
+    record['realization'] = os.environ.get('JEDISIM_REALIZATION', '')
+    record['host_pid'] = '%s:%i' % (os.uname()[1], os.getpid())
+    record['cache_scope'] = os.environ.get('JEDISIM_CACHE_SCOPE', '')
+    record['lane'] = getattr(stage_lane, 'lane', 0)
+    with open(stage_log['path'], 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def log_stage(name, args, start, returncode, usage=None, cache_hit=False, cached=False):
+    """Append the record of one program to the stage log.
+
+    cached is True for the programs looked up in the stage cache.
+    """
+    record = {'stage': name.strip(),
+              'argv': list(args),
+              'start': start,
+              'wall_s': time.time() - start,
+              'returncode': returncode,
+              'cache_hit': cache_hit,
+              'cached': cached}
+    record.update(usage or {'user_s': 0, 'sys_s': 0, 'max_rss_kb': None,
+                            'read_bytes': None, 'write_bytes': None})
+    append_stage_log(record)
+
+
+def log_span(name, start):
+    """Append a span, e.g. one iteration of the loop, to the stage log.
+
+    The spans and the programs inside them make the nested timeline of
+    write_trace.
+    """
+    append_stage_log({'span': name, 'start': start,
+                      'wall_s': time.time() - start})
+
+
+def read_stage_log(path, run=None):
+    """Return the records of the stage log, only the ones of run if given.
+
+    run is the JEDISIM_RUN environment variable of the programs, which
+    jedimaster.py or run_jedimaster.py set for each of their runs.
+    """
+    import json
+    records = []
+    if not path or not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if run is None or record.get('run') == run:
+                records.append(record)
+    return records
+
+
+def print_stage_summary(records):
+    """Print the calls, times, max rss and io of each stage, slowest first."""
+    stages = {}
+    for r in records:
+        if 'stage' not in r:
+            continue
+        s = stages.setdefault(r['stage'], {'calls': 0, 'hits': 0, 'wall_s': 0,
+                                           'cpu_s': 0, 'max_rss_kb': 0,
+                                           'read_bytes': 0, 'write_bytes': 0})
+        s['calls'] += 1
+        s['hits'] += int(r['cache_hit'])
+        s['wall_s'] += r['wall_s']
+        s['cpu_s'] += r['user_s'] + r['sys_s']
+        s['max_rss_kb'] = max(s['max_rss_kb'], r['max_rss_kb'] or 0)
+        s['read_bytes'] += r['read_bytes'] or 0
+        s['write_bytes'] += r['write_bytes'] or 0
+
+    total = sum(s['wall_s'] for s in stages.values()) or 1
+    print("\n{:<16}{:>7}{:>6}{:>11}{:>7}{:>11}{:>10}{:>11}{:>11}".format(
+          'stage', 'calls', 'hits', 'wall [s]', 'wall%', 'cpu [s]',
+          'rss [GB]', 'read [GB]', 'write [GB]'))
+    for name, s in sorted(stages.items(), key=lambda x: -x[1]['wall_s']):
+        print("{:<16}{:>7}{:>6}{:>11.1f}{:>7.1f}{:>11.1f}{:>10.2f}{:>11.2f}{:>11.2f}".format(
+              name, s['calls'], s['hits'], s['wall_s'], 100 * s['wall_s'] / total,
+              s['cpu_s'], s['max_rss_kb'] / 1e6, s['read_bytes'] / 1e9,
+              s['write_bytes'] / 1e9))
+    print()
+
+
+def write_trace(records, path):
+    """Write the stage log records as a chrome trace-event json file.
+
+    Each realization is a process of the trace and each python process
+    (jedimaster, a3, a4, a parallel iteration) is a thread of it, so the
+    spans and programs are nested by time. The programs run at the same
+    time by one python process, e.g. the jedidistort chunks, each have
+    their own lane, a thread of the trace. It loads in chrome://tracing
+    or ui.perfetto.dev.
+    """
+    import json
+    pids, tids, events = {}, {}, []
+    for r in records:
+        realization = r.get('realization', '')
+        pid = pids.setdefault(realization, len(pids) + 1)
+        tid = tids.setdefault((r['host_pid'], r.get('lane', 0)), len(tids) + 1)
+        name = r['stage'] if 'stage' in r else r['span']
+        args = {key: r[key] for key in r
+                if key not in ('start', 'wall_s', 'stage', 'span')}
+        events.append({'name': name, 'cat': 'stage' if 'stage' in r else 'span',
+                       'ph': 'X', 'ts': r['start'] * 1e6, 'dur': r['wall_s'] * 1e6,
+                       'pid': pid, 'tid': tid, 'args': args})
+
+    for realization, pid in pids.items():
+        label = 'realization %s' % realization if realization else 'jedimaster'
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': label}})
+    threads = set((pids[r.get('realization', '')], r['host_pid'], r.get('lane', 0))
+                  for r in records)
+    for pid, host_pid, lane in threads:
+        label = '%s lane %i' % (host_pid, lane) if lane else host_pid
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tids[(host_pid, lane)], 'args': {'name': label}})
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    print('Trace written to %s, open it in chrome://tracing or ui.perfetto.dev.' % path)
+
+
+# Stage cache for run_process, turned on by set_stage_cache().
+stage_cache = {'dir': None, 'max_bytes': 0, 'hits': 0, 'misses': 0}
+
+
+def set_stage_cache(cache_dir, max_gb):
+    """Turn on the content-addressed stage cache of run_process.
+
+    Each entry is a folder cache_dir/<sha256> with copies of the outputs.
+    The cache is kept below max_gb by removing the least recently used entries.
+    An empty cache_dir leaves the cache off.
+    """
+    if not cache_dir:
+        return
+    stage_cache['dir'] = cache_dir
+    stage_cache['max_bytes'] = float(max_gb) * 1e9
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+
+def set_cache_scope():
+    """Mark the programs of this process and of its children for print_cache_stats.
+
+    The scope is the JEDISIM_CACHE_SCOPE environment variable, so the
+    parallel iterations of a3 and a4 inherit it.
+    """
+    os.environ['JEDISIM_CACHE_SCOPE'] = '%s:%i:%i' % (os.uname()[1], os.getpid(),
+                                                      int(time.time()))
+
+
+def print_cache_stats():
+    """Print the hits and misses of the stage cache.
+
+    With the stage log they are counted from its records of the cache
+    scope (see set_cache_scope), else they are the ones of this process.
+    """
+    if not stage_cache['dir']:
+        return
+    hits, misses = stage_cache['hits'], stage_cache['misses']
+    scope = os.environ.get('JEDISIM_CACHE_SCOPE', '')
+    if stage_log['path'] and scope:
+        records = [r for r in read_stage_log(stage_log['path'])
+                   if r.get('cached') and r.get('cache_scope') == scope]
+        hits = sum(1 for r in records if r['cache_hit'])
+        misses = len(records) - hits
+    total = hits + misses
+    rate = 100.0 * hits / total if total else 0
+    print("Stage cache %s: %i hits, %i misses (%.1f%% hit rate)." % (
+          stage_cache['dir'], hits, misses, rate))
+
+
+def file_hash(path):
+    """Return the sha256 hex digest of a file."""
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stage_key(args, inputs):
+    """Hash the executable, the argv and the input files of a program."""
+    import hashlib
+    h = hashlib.sha256()
+    exe = args[0] if os.path.isfile(args[0]) else shutil.which(args[0])
+    if exe:
+        h.update(file_hash(exe).encode('utf-8'))
+    for arg in args:
+        h.update(arg.encode('utf-8') + b'\0')
+    for path in inputs:
+        h.update(path.encode('utf-8') + b'\0')
+        h.update(file_hash(resolve_fits(path)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def cache_restore(key, outputs):
+    """Copy the outputs of a cache entry back, return False on a miss."""
+    entry = os.path.join(stage_cache['dir'], key)
+    if not os.path.isdir(entry):
+        return False
+    try:
+        for n, path in enumerate(outputs):
+            folder = os.path.dirname(path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            shutil.copyfile(os.path.join(entry, str(n)), path)
+        # mark as recently used
+        os.utime(entry, None)
+    except (IOError, OSError):
+        # evicted by another process while we were copying
+        return False
+    return True
+
+
+def cache_store(key, outputs):
+    """Copy the outputs into a new cache entry and evict old entries.
+
+    The entry is written to a temporary folder and renamed, so other
+    processes never see half written entries.
+    """
+    entry = os.path.join(stage_cache['dir'], key)
+    tmp = os.path.join(stage_cache['dir'], 'tmp_%i_%s' % (os.getpid(), key))
+    if os.path.exists(entry):
+        return
+    os.makedirs(tmp)
+    for n, path in enumerate(outputs):
+        shutil.copyfile(path, os.path.join(tmp, str(n)))
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+    cache_evict()
+
+
+def cache_evict():
+    """Remove least recently used entries until the cache fits its size."""
+    entries = []
+    for name in os.listdir(stage_cache['dir']):
+        path = os.path.join(stage_cache['dir'], name)
+        if name.startswith('tmp_') or not os.path.isdir(path):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            continue
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= stage_cache['max_bytes']:
+            break
+        print('Stage cache: removing %s (%.1f MB).' % (path, size / 1e6))
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def checkpoint_path(outfolder):
+    """Return the checkpoint manifest of the loop writing into outfolder."""
+    return os.path.join(outfolder, 'checkpoint.jsonl')
+
+
+def checkpoint_record(manifest, i, outfile):
+    """Append a completed iteration and the size and sha256 of its output.
+
+    One json record per line, so parallel iterations can append safely.
+    """
+    import json
+    record = {'iteration': i,
+              'file': outfile,
+              'size': os.path.getsize(outfile),
+              'sha256': file_hash(outfile),
+              'time': time.ctime()}
+    with open(manifest, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def checkpoint_completed(manifest):
+    """Return the iterations of the manifest whose outputs are unchanged.
+
+    The outputs are checked by size first and then by sha256.
+    """
+    import json
+    records = {}
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # half written last line of a crashed run
+                    continue
+                records[record['iteration']] = record
+
+    completed = []
+    for i in sorted(records):
+        path = records[i]['file']
+        if (os.path.exists(path) and
+                os.path.getsize(path) == records[i]['size'] and
+                file_hash(path) == records[i]['sha256']):
+            completed.append(i)
+        else:
+            print('Checkpoint: output %s of iteration %i is missing or changed.'
+                  % (path, i))
+    return completed
+
+
+def remove_files(paths):
+    """Remove the files that exist.
+
+    jedirescale, jediaverage and jedinoise do not overwrite their outputs.
+    """
+    for path in paths:
+        if os.path.exists(path):
+            print('Removing file: ', path)
+            os.remove(path)
+
+
+def todo_iterations(manifest, outfiles, resume):
+    """Return the iterations to run and remove their stale outputs.
+
+    Without resume the manifest is started again.
+    """
+    completed = []
+    if resume:
+        completed = checkpoint_completed(manifest)
+        print('Resuming: iterations {} are completed.'.format(completed))
+    elif os.path.exists(manifest):
+        os.remove(manifest)
+
+    todo = [i for i in range(0, 21) if i not in completed]
+    remove_files([outfiles[i] for i in todo])
+    return todo
+
+
+def color_files(color_infile):
+    """Return the input and output fitsfiles of jedicolor for run_process.
+
+    Each line of color.txt is: bulge_file disk_file bulge_disk_file.
+    """
+    inputs, outputs = [color_infile], []
+    with open(color_infile) as f:
+        for line in f:
+            l = line.split()
+            if l:
+                inputs += l[0:2]
+                outputs.append(l[2])
+    return inputs, outputs
+
+
+def listed_files(list_file):
+    """Return the files of a list of jedipaste, e.g. the convolved bands."""
+    with open(list_file) as f:
+        return [line.split()[0] for line in f if line.split()]
+
+
+# Band sizes used by the executables (jedisim_sources/*.c).
+BANDHEIGHT = 2048   # jediconvolve
+NUMBANDS   = 2      # jedipaste, jedirescale
+
+
+def available_memory():
+    """Return the available memory of this node in bytes.
+
+    Uses MemAvailable from /proc/meminfo and falls back to the total
+    physical memory.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def resolve_fits(path):
+    """Return path, or path.gz when only the compressed file exists.
+
+    cfitsio also opens psf/psf0.fits when only psf/psf0.fits.gz exists,
+    astropy does not, e.g. for the psfs and the simdatabase images.
+    """
+    if not os.path.exists(path) and os.path.exists(path + '.gz'):
+        return path + '.gz'
+    return path
+
+
+def iteration_memory(nx, ny, psf_file):
+    """Estimate the peak memory in bytes of one iteration of the 7 programs.
+
+    jediconvolve is the largest: one band padded by the PSF on all sides,
+    three real and three half-complex float arrays of that size,
+    plus the input band. jedipaste and jedirescale hold nx*ny/NUMBANDS floats.
+    """
+    # Imports
+    from astropy.io import fits
+
+    header = fits.getheader(resolve_fits(psf_file))
+    px, py = header['NAXIS1'], header['NAXIS2']
+    paste = 4 * nx * ny // NUMBANDS
+    return max(convolve_memory(nx, px, py), paste)
+
+
+def convolve_memory(nx, px, py):
+    """Return the peak memory in bytes of jediconvolve for a px x py psf."""
+    padded = (nx + 2 * px) * (BANDHEIGHT + 2 * py)
+    return 4 * 3 * padded + 8 * 3 * (padded // 2) + 4 * nx * BANDHEIGHT
+
+
+def pool_size(max_workers, job_memory):
+    """Number of workers limited by max_workers, cores and available memory."""
+    import multiprocessing
+    by_memory = int(available_memory() // max(1, job_memory))
+    return max(1, min(int(max_workers), multiprocessing.cpu_count(), by_memory))
+
+
+# Postage stamps of jeditransform, stamp_codec: file extension (cfitsio writes
+# .gz files at zlib level 1, Z_BEST_SPEED, so gzip is also the zlib level 1 codec)
+STAMP_CODECS = {'gzip': '.fits.gz', 'none': '.fits'}
+
+
+def stamp_extension(config):
+    """Return the file extension of the postage stamps of stamp_codec in config.sh."""
+    codec = config.get('stamp_codec', 'gzip')
+    if codec not in STAMP_CODECS:
+        print("Error: stamp_codec must be one of %s, not %s."
+              % (', '.join(sorted(STAMP_CODECS)), codec))
+        sys.exit(1)
+    return STAMP_CODECS[codec]
+
+
+def make_workspace(workdir, num_galaxies, color_infile, catalog_file,
+                   convolvedlist_file):
+    """Make a private copy of everything one iteration of the loop writes to.
+
+    The catalog and list files are rewritten so that jedicolor, jeditransform,
+    jedidistort, jedipaste and jediconvolve only use paths inside workdir.
+
+    :Example:
+
+      simdatabase/bulge_disk_f8/bdf8_0.fits
+      ==> jedisim_out/scratch/out0_3/bulge_disk_f8/bdf8_0.fits
+
+      jedisim_out/out0/stamp_0/stamp_0.fits.gz
+      ==> jedisim_out/scratch/out0_3/stamp_0/stamp_0.fits.gz
+
+    Returns a dictionary with the same keys as config for these files.
+    """
+    def relocate(path):
+        folder = os.path.basename(os.path.dirname(path))
+        return os.path.join(workdir, folder, os.path.basename(path))
+
+    replace_outfolder(workdir)
+    os.makedirs(os.path.join(workdir, 'convolved'))
+    for x in range(0, int(math.ceil(float(num_galaxies) / 1000))):
+        os.makedirs(os.path.join(workdir, "stamp_" + str(x)))
+        os.makedirs(os.path.join(workdir, "distorted_" + str(x)))
+
+    files = {'color_infile':        os.path.join(workdir, 'color.txt'),
+             'catalog_file':        os.path.join(workdir, 'catalog.txt'),
+             'dislist_file':        os.path.join(workdir, 'dislist.txt'),
+             'distortedlist_file':  os.path.join(workdir, 'distortedlist.txt'),
+             'convolvedlist_file':  os.path.join(workdir, 'convolvedlist.txt'),
+             'HST_image':           os.path.join(workdir, 'HST.fits'),
+             'HST_convolved_image': os.path.join(workdir, 'HST_convolved.fits'),
+             'convolved_folder':    os.path.join(workdir, 'convolved/')}
+
+    # jedicolor writes bulge-disk galaxies into workdir/bulge_disk_f8
+    # (bulge_disk_f8_90 for the rotated case)
+    with open(color_infile) as fi, open(files['color_infile'], 'w') as fo:
+        for line in fi:
+            l = line.split()
+            if l:
+                l[2] = relocate(l[2])
+                if not os.path.isdir(os.path.dirname(l[2])):
+                    os.makedirs(os.path.dirname(l[2]))
+                fo.write('  '.join(l) + '\n')
+
+    # jeditransform reads bulge-disk galaxies and writes stamps in workdir,
+    # jedipaste reads the distorted galaxies from workdir
+    with open(catalog_file) as fi, open(files['catalog_file'], 'w') as fo, \
+         open(files['distortedlist_file'], 'w') as fd:
+        for line in fi:
+            l = line.rstrip('\n').split('\t')
+            l[0] = relocate(l[0])
+            l[-2] = relocate(l[-2])
+            l[-1] = relocate(l[-1])
+            fo.write('\t'.join(l) + '\n')
+            fd.write(l[-1] + '\n')
+
+    # jediconvolve writes the bands into workdir/convolved/
+    with open(convolvedlist_file) as fi, open(files['convolvedlist_file'], 'w') as fo:
+        for line in fi:
+            if line.strip():
+                fo.write(relocate(line.strip()) + '\n')
+
+    return files
+
+
+# Bulge/disk decomposition: the two mixtures rendered once, (name, b, d)
+BASES = [('bulge_disk', 1, 1), ('bulge', 1, 0)]
+
+
+def render_basis(workdir, config, color_infile, catalog_file, convolvedlist_file):
+    """Render the lensed galaxies of the two basis mixtures once.
+
+    jedicolor, jeditransform and jedidistort are run inside workdir/bulge_disk/
+    with the weights (1, 1) and inside workdir/bulge/ with (1, 0).
+    The disk only mixture is not used since galaxies without disk would
+    have no flux.
+
+    Returns a list with the distorted files, the flux (TFLUX of the
+    stamps) and the paste index of the galaxies of each basis.
+    """
+    # Imports
+    from astropy.io import fits
+
+    basis = []
+    for name, b, d in BASES:
+        files = make_workspace(os.path.join(workdir, name) + '/',
+                               config['num_galaxies'], color_infile,
+                               catalog_file, convolvedlist_file)
+        color_inputs, color_outputs = color_files(files['color_infile'])
+        run_process("jedicolor", ['./executables/jedicolor',
+                                  files['color_infile'],
+                                  str(b), str(d)
+                                  ], color_inputs, color_outputs)
+        run_process("jeditransform", transform_args(config, files['catalog_file'],
+                                                    files['dislist_file'], center=True))
+        run_distort(config, files['dislist_file'])
+
+        with open(files['catalog_file']) as f:
+            rows = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+        flux = [fits.getheader(row[-2])['TFLUX'] for row in rows]
+        basis.append(([row[-1] for row in rows], flux,
+                      read_paste_index(files['dislist_file'])))
+    return basis
+
+
+def transform_args(config, catalog_file, dislist_file, center=None):
+    """Return the arguments of jeditransform for catalog_file.
+
+    With center, jeditransform embeds the center pixel of each galaxy at
+    its catalog position instead of the center of its bounding box, which
+    depends on the weights of jedicolor. The decomposition, the effective
+    psfs, the resampling maps and the rotated stamps rely on it, so it is
+    the default when one of them is turned on in config.
+    """
+    if center is None:
+        center = any(int(config.get(key, 0)) for key in
+                     ['bulge_disk_decomposition', 'effective_psf',
+                      'resample_maps', 'rotate_stamps'])
+    args = ['./executables/jeditransform', catalog_file, dislist_file]
+    if center:
+        args.append('1')
+    return args
+
+
+def distort_args(config, dislist_file, rotate=False):
+    """Return the arguments of jedidistort for dislist_file.
+
+    With deflection_field=1 or a kappa_map, the deflection field of
+    deflection.py is computed if it is not there yet and given as the
+    field argument. With rotate, jedidistort rotates each stamp by 90
+    degrees when it reads it (see rotated_dislist).
+    """
+    args = ['./executables/jedidistort',
+            config['nx'],
+            config['ny'],
+            dislist_file,
+            config['lenses_file'],
+            config['pix_scale'],
+            config['lens_z'],
+            config.get('distort_cache', '')
+            ]
+    if int(config.get('deflection_field', 0)) or config.get('kappa_map', ''):
+        # Imports
+        from deflection import field_file
+        args.append(field_file(config))
+    if rotate:
+        args += [''] * (9 - len(args)) + ['1']
+    return args
+
+
+def warm_distort_cache(config):
+    """Build the lens tables and grids of jedidistort once, before the loop.
+
+    jedidistort only fills its cache when the dislist is empty.
+    The deflection field, if any, is computed first.
+    """
+    if int(config.get('deflection_field', 0)) or config.get('kappa_map', ''):
+        # Imports
+        from deflection import field_file
+        field_file(config)
+
+    cache = config.get('distort_cache', '')
+    if not cache:
+        return
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+    empty = os.path.join(cache, 'empty_dislist_%d.txt' % os.getpid())
+    open(empty, 'w').close()
+    run_process("jedidistort", distort_args(config, empty))
+    for path in [empty, index_path(empty)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def split_dislist(dislist_file, nchunks):
+    """Split the dislist of jedidistort into chunks of about the same work.
+
+    The work of a galaxy is taken as its stamp area (nx*ny columns). The
+    largest stamps are given first, each one to the chunk with the least
+    work. Returns the paths of the chunk files, the empty chunks are dropped.
+    """
+    with open(dislist_file) as f:
+        lines = [line for line in f if line.strip()]
+    chunks = [[] for _ in range(nchunks)]
+    work = [0] * nchunks
+    area = lambda line: int(line.split()[2]) * int(line.split()[3])
+    for line in sorted(lines, key=area, reverse=True):
+        k = work.index(min(work))
+        chunks[k].append(line)
+        work[k] += area(line)
+
+    paths = []
+    for k, chunk in enumerate(chunks):
+        if chunk:
+            paths.append('%s.chunk%d' % (dislist_file, k))
+            with open(paths[-1], 'w') as f:
+                f.writelines(chunk)
+    return paths
+
+
+def run_distort(config, dislist_file, rotate=False):
+    """Run jedidistort on dislist_file, on distort_workers processes.
+
+    The galaxies are independent, each chunk of split_dislist is distorted by
+    its own jedidistort, which reads the lens tables and grids memory-mapped
+    from distort_cache. Each galaxy is written to its own file, only the
+    paste indexes of the chunks are merged into the one of dislist_file.
+    The callers warm the cache once, see warm_distort_cache.
+    """
+    # Imports
+    import multiprocessing
+    from concurrent.futures import ThreadPoolExecutor
+
+    def distort(path, lane=0):
+        # each chunk is its own lane of the trace
+        stage_lane.lane = lane
+        run_process("jedidistort", distort_args(config, path, rotate))
+        stage_lane.lane = 0
+
+    workers = min(int(config.get('distort_workers', 1)), multiprocessing.cpu_count())
+    if workers <= 1:
+        distort(dislist_file)
+        return
+
+    chunks = split_dislist(dislist_file, workers)
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        futures = [pool.submit(distort, path, k + 1) for k, path in enumerate(chunks)]
+    failed = [f for f in futures if f.exception() is not None]
+    if not failed:
+        merge_paste_index(dislist_file, chunks)
+    remove_files(chunks + [index_path(path) for path in chunks])
+    if failed:
+        print("Error: %i of %i jedidistort chunks did not terminate correctly."
+              % (len(failed), len(chunks)))
+        sys.exit(1)
+
+
+def paste_args(config, list_file, output_file):
+    """Return the arguments of jedipaste for list_file.
+
+    With paste_window_mb > 0, jedipaste memory-maps output_file and adds
+    each image of list_file once, keeping about paste_window_mb MB of the
+    output image resident, instead of reading the list once per band.
+    With paste_threads > 1, each thread of jedipaste pastes its own strip
+    of rows of the output image.
+    """
+    args = ['./executables/jedipaste',
+            config['nx'],
+            config['ny'],
+            list_file,
+            output_file
+            ]
+    window = int(config.get('paste_window_mb', 0))
+    threads = int(config.get('paste_threads', 1))
+    if window > 0 or threads > 1:
+        args.append(str(max(window, 0)))
+    if threads > 1:
+        args.append(str(threads))
+    return args
+
+
+# Paste index: XEMBED, YEMBED, NAXIS1, NAXIS2 of each image of a list of
+# jedipaste, in list_file.idx (see jedidistort and jedipaste)
+INDEX_MAGIC = b'JDPIDX01'
+
+
+def index_path(list_file):
+    """Return the path of the paste index of list_file."""
+    return list_file + '.idx'
+
+
+def read_paste_index(list_file):
+    """Return the (n, 4) paste index of list_file."""
+    with open(index_path(list_file), 'rb') as f:
+        if f.read(8) != INDEX_MAGIC:
+            print("Error: %s is not a paste index." % index_path(list_file))
+            sys.exit(1)
+        n = int(np.frombuffer(f.read(8), np.int64)[0])
+        return np.frombuffer(f.read(32 * n), np.int64).reshape(n, 4)
+
+
+def write_paste_index(list_file, geometry):
+    """Write the paste index of list_file from the rows (xembed, yembed, nx, ny).
+
+    geometry has one row per image of list_file, in the same order.
+    """
+    geometry = np.asarray(geometry, dtype=np.int64).reshape(-1, 4)
+    with open(index_path(list_file), 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(np.int64(len(geometry)).tobytes())
+        f.write(geometry.tobytes())
+
+
+def merge_paste_index(dislist_file, chunks):
+    """Write the paste index of dislist_file from the ones of its chunks.
+
+    The chunks of split_dislist are sorted by work, their galaxies are put
+    back in the order of dislist_file by their output file.
+    """
+    rows = {}
+    for path in chunks:
+        with open(path) as f:
+            outfiles = [line.split()[-1] for line in f if line.strip()]
+        rows.update(zip(outfiles, read_paste_index(path)))
+    with open(dislist_file) as f:
+        outfiles = [line.split()[-1] for line in f if line.strip()]
+    write_paste_index(dislist_file, [rows[path] for path in outfiles])
+
+
+def shared_folder(config, i):
+    """Return the folder of the stamps of the i-th iteration shared by a3 with a4."""
+    return config['iteration_scratch'] + 'stamps0/%d/' % i
+
+
+def shared_lock(config):
+    """Return the lock file held by a3 while it shares its stamps."""
+    return config['iteration_scratch'] + 'stamps0/lock'
+
+
+def share_stamps(config, i, dislist_file):
+    """Hard link the stamps of jeditransform of the i-th iteration for a4.
+
+    The stamps and the dislist go to shared_folder, then a done file tells
+    a4 that they are complete. jeditransform overwrites the stamps with new
+    files, so the links keep the stamps of this iteration.
+    """
+    folder = shared_folder(config, i)
+    replace_outfolder(folder)
+    with open(dislist_file) as fi, open(folder + 'dislist.txt', 'w') as fo:
+        for k, line in enumerate(fi):
+            l = line.split()
+            if not l:
+                continue
+            link = folder + 'stamp_%d.fits%s' % (k, '.gz' if l[5].endswith('.gz') else '')
+            try:
+                os.link(l[5], link)
+            except OSError:
+                shutil.copy(l[5], link)
+            l[5] = link
+            fo.write(' '.join(l) + '\n')
+    open(folder + 'done', 'w').close()
+
+
+def is_locked(path):
+    """Return True if another process holds the lock of path."""
+    # Imports
+    import fcntl
+
+    with open(path) as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError:
+            return True
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return False
+
+
+def hold_lock(path):
+    """Take the lock of path, it is held until the returned file is closed."""
+    # Imports
+    import fcntl
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path, 'a')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+def wait_shared_stamps(config, i, catalog_file):
+    """Return the folder of the stamps shared by a3 for the i-th iteration.
+
+    Waits while a3 holds shared_lock, or while a3 may still start, i.e.
+    for rotate_stamps_wait seconds after a2 wrote catalog_file.
+    Returns None if a3 ended or never started without sharing them.
+    """
+    folder = shared_folder(config, i)
+    lock = shared_lock(config)
+    deadline = os.path.getmtime(catalog_file) + float(config.get('rotate_stamps_wait', 600))
+    while not os.path.exists(folder + 'done'):
+        if os.path.exists(lock) and not is_locked(lock) or \
+           not os.path.exists(lock) and time.time() > deadline:
+            return folder if os.path.exists(folder + 'done') else None
+        time.sleep(2)
+    return folder
+
+
+def rotated_geometry(line, x, y):
+    """Return xembed, yembed, nx, ny of the stamp of a dislist line rotated by 90 degrees.
+
+    jeditransform rotates around the pixel xc = yc = 1 + (n >> 1) of the
+    n x n galaxy, so pixel (x, y) of the stamp with angle + 90 is pixel
+    (2 xc - y, x) of the stamp with angle. The lower left pixel of the
+    rotated stamp is embedded relative to the rounded position (x, y).
+    """
+    xembed, yembed, nx, ny = [int(v) for v in line.split()[:4]]
+    lx, ly = int(0.5 + x), int(0.5 + y)
+    return lx - ly + yembed, ly + lx - xembed - nx - 1, ny, nx
+
+
+def catalog_positions(catalog_file):
+    """Return the x and y columns of a catalog as float32, as jeditransform reads them."""
+    x, y = [], []
+    with open(catalog_file) as f:
+        for line in f:
+            l = line.split()
+            if l:
+                x.append(l[1])
+                y.append(l[2])
+    return np.array(x, dtype=np.float32), np.array(y, dtype=np.float32)
+
+
+def rotated_dislist(shared_dislist, catalog_file, dislist_file):
+    """Write the dislist of the rotated case from the stamps of the normal case.
+
+    The angles of the rotated catalog are the ones of the normal catalog
+    plus 90 degrees and everything else is the same, so its stamps are
+    the stamps of the normal case rotated by 90 degrees, which jedidistort
+    does with rotate. The distorted galaxies are the ones of catalog_file.
+    """
+    x, y = catalog_positions(catalog_file)
+    with open(catalog_file) as f:
+        distorted = [line.split()[-1] for line in f if line.strip()]
+    with open(shared_dislist) as fi, open(dislist_file, 'w') as fo:
+        for k, line in enumerate(l for l in fi if l.strip()):
+            l = line.split()
+            geometry = rotated_geometry(line, float(x[k]), float(y[k]))
+            fo.write('%i %i %i %i %s %s %s\n' % (geometry + (l[4], l[5], distorted[k])))
+
+
+def write_weighted_list(path, basis, b, d):
+    """Write the distorted list of jedipaste for the mixture b*bulge + d*disk.
+
+    jeditransform scales each galaxy to its catalog magnitude, so the
+    galaxy is not b*bulge + d*disk of the basis stamps but
+    w*bulge_disk + (1-w)*bulge with w = d*T1 / (d*T1 + (b-d)*T2),
+    T1 and T2 being the flux of the galaxy in the two basis mixtures.
+    """
+    (distorted1, flux1, index1), (distorted2, flux2, index2) = basis
+    t1 = d * np.array(flux1, dtype=float)
+    t2 = (b - d) * np.array(flux2, dtype=float)
+    w = t1 / (t1 + t2)
+    with open(path, 'w') as f:
+        for f1, f2, w1 in zip(distorted1, distorted2, w):
+            f.write('%s %.9g\n%s %.9g\n' % (f1, w1, f2, 1 - w1))
+    write_paste_index(path, np.hstack([index1, index2]))
+
+
+def compare_images(path1, path2):
+    """Return the flux ratio and the relative L1 and max residuals of path2 to path1."""
+    # Imports
+    from astropy.io import fits
+
+    image1 = fits.getdata(path1).astype(float)
+    image2 = fits.getdata(path2).astype(float)
+    residual = np.abs(image2 - image1)
+    return (image2.sum() / image1.sum(),
+            residual.sum() / np.abs(image1).sum(),
+            residual.max() / np.abs(image1).max())
+
+
+def effective_psfs(workdir, basis, b, d, psf_files, tolerance):
+    """Write the scenes and the effective psfs whose convolutions sum to the average.
+
+    The galaxy g of the i-th iteration is p2 + w1*(p1 - p2), with the basis
+    stamps p1, p2 of write_weighted_list, and w1*(1 - f) = 1 - beta_i(f),
+    f = T2/T1 being the bulge fraction of the galaxy. The matrix
+    1 - beta_i(f_g) is split by SVD into R terms u_r(i) v_r(g), R being the
+    smallest number of terms with an error below tolerance, so that
+
+      mean_i conv(scene_i, psf_i) = conv(sum_g p2, mean_i psf_i)
+                                  + sum_r conv(sum_g v_r(g) (p1 - p2) / (1 - f),
+                                               mean_i u_r(i) psf_i)
+
+    Returns a list of (distorted list, psf file) of the 1 + R terms.
+    """
+    # Imports
+    from astropy.io import fits
+
+    (distorted1, flux1, index1), (distorted2, flux2, index2) = basis
+    f = np.array(flux2, dtype=float) / np.array(flux1, dtype=float)
+    b = np.asarray(b, dtype=float)[:, None]
+    d = np.asarray(d, dtype=float)[:, None]
+    disk = d * (1 - f) / (d * (1 - f) + b * f)
+    u, s, v = np.linalg.svd(disk, full_matrices=False)
+    for rank in range(1, len(s) + 1):
+        error = np.abs(disk - np.dot(u[:, :rank] * s[:rank], v[:rank])).max()
+        if error <= tolerance:
+            break
+    print('Effective psfs: %i terms, max error %.1e of the disk fraction.'
+          % (rank + 1, error))
+
+    # Effective psfs, the psfs are read one at a time
+    coefficients = np.vstack([np.ones(len(psf_files)), (u[:, :rank] * s[:rank]).T])
+    coefficients /= len(psf_files)
+    effective = None
+    for i, path in enumerate(psf_files):
+        path = resolve_fits(path)
+        psf = fits.getdata(path).astype(float)
+        if effective is None:
+            effective = np.zeros((len(coefficients),) + psf.shape)
+            header = fits.getheader(path)
+        for k, c in enumerate(coefficients[:, i]):
+            effective[k] += c * psf
+
+    # Scenes: the bulge basis, then the weighted differences of the bases
+    with np.errstate(divide='ignore'):
+        scale = np.where(1 - f > 1e-6, 1 / (1 - f), 0)
+    weights = [(np.zeros_like(f), np.ones_like(f))]
+    weights += [(v[r] * scale, -v[r] * scale) for r in range(rank)]
+
+    replace_outfolder(workdir)
+    terms = []
+    for k, (w1, w2) in enumerate(weights):
+        psf_file = os.path.join(workdir, 'psf_effective_%d.fits' % k)
+        fits.writeto(psf_file, effective[k].astype(np.float32), header)
+        list_file = os.path.join(workdir, 'distortedlist_effective_%d.txt' % k)
+        with open(list_file, 'w') as fo:
+            for f1, f2, x1, x2 in zip(distorted1, distorted2, w1, w2):
+                fo.write('%s %.9g\n%s %.9g\n' % (f1, x1, f2, x2))
+        write_paste_index(list_file, np.hstack([index1, index2]))
+        terms.append((list_file, psf_file))
+    return terms
+
+
+def sum_images(paths, outfile, scale=1.0):
+    """Write the sum of the fits images times scale with the header of the first one."""
+    # Imports
+    from astropy.io import fits
+
+    total = 0
+    for path in paths:
+        total = total + fits.getdata(resolve_fits(path)).astype(float)
+    fits.writeto(outfile, (scale * total).astype(np.float32), fits.getheader(resolve_fits(paths[0])),
+                 overwrite=True)
@@ -0,0 +1,216 @@
+#!python
+# -*- coding: utf-8 -*-
+"""Work queue of jedisim realizations on a shared file system.
+
+:Info:
+
+  1. The queue is one SQLite file on a file system shared by all the nodes.
+  2. run_jedimaster.py --queue adds the realizations as jobs
+     (realization, seed, redshift, lens file, output folder).
+  3. run_jedimaster.py --worker claims jobs, runs them and registers
+     their outputs with size and sha256, until no job is queued or
+     running anymore.
+  4. A claimed job holds a lease which the worker renews while it runs.
+     If the worker crashes, the lease expires and the job goes back to
+     the queue, up to max_attempts claims.
+
+.. note::
+
+  SQLite locks the file with fcntl, the shared file system must support
+  it (e.g. NFS with lockd).
+
+"""
+# Imports
+from __future__ import print_function, unicode_literals, division, absolute_import
+import os
+import sys
+import time
+import socket
+import sqlite3
+import threading
+from util import file_hash
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id            INTEGER PRIMARY KEY,
+    realization   INTEGER,
+    seed          INTEGER,
+    redshift      TEXT,
+    lens_file     TEXT,
+    outfolder     TEXT,
+    state         TEXT DEFAULT 'queued',
+    worker        TEXT,
+    lease_expires REAL,
+    attempts      INTEGER DEFAULT 0,
+    started       REAL,
+    finished      REAL
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    job_id        INTEGER,
+    path          TEXT,
+    size          INTEGER,
+    sha256        TEXT
+);
+"""
+
+
+def connect(db_path):
+    """Connect to the queue, transactions are started explicitly."""
+    db = sqlite3.connect(db_path, timeout=120, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def create_queue(db_path):
+    """Create the tables of the queue if they do not exist."""
+    db = connect(db_path)
+    db.executescript(schema)
+    db.close()
+
+
+def add_job(db_path, realization, seed, redshift, lens_file, outfolder):
+    """Add one realization to the queue."""
+    db = connect(db_path)
+    db.execute("INSERT INTO jobs (realization, seed, redshift, lens_file, outfolder) "
+               "VALUES (?, ?, ?, ?, ?)",
+               (realization, seed, redshift, lens_file, outfolder))
+    db.close()
+
+
+def worker_name():
+    """Return host:pid of this worker."""
+    return '%s:%i' % (socket.gethostname(), os.getpid())
+
+
+def claim_job(db_path, worker, lease_seconds, max_attempts):
+    """Claim the next queued job and return it as a dictionary.
+
+    Running jobs whose lease has expired are put back to the queue first,
+    or marked failed after max_attempts claims.
+    Returns None if no job is queued.
+    """
+    now = time.time()
+    db = connect(db_path)
+    db.execute("BEGIN IMMEDIATE")
+    db.execute("UPDATE jobs SET state = CASE WHEN attempts < ? THEN 'queued' "
+               "ELSE 'failed' END, worker = NULL "
+               "WHERE state = 'running' AND lease_expires < ?",
+               (max_attempts, now))
+    row = db.execute("SELECT * FROM jobs WHERE state = 'queued' "
+                     "ORDER BY id LIMIT 1").fetchone()
+    if row is not None:
+        db.execute("UPDATE jobs SET state = 'running', worker = ?, "
+                   "lease_expires = ?, attempts = attempts + 1, started = ? "
+                   "WHERE id = ?",
+                   (worker, now + lease_seconds, now, row['id']))
+    db.execute("COMMIT")
+    db.close()
+    return dict(row) if row is not None else None
+
+
+def renew_lease(db_path, job_id, worker, lease_seconds):
+    """Extend the lease of a running job, False if the job is not ours anymore."""
+    db = connect(db_path)
+    cursor = db.execute("UPDATE jobs SET lease_expires = ? "
+                        "WHERE id = ? AND worker = ? AND state = 'running'",
+                        (time.time() + lease_seconds, job_id, worker))
+    db.close()
+    return cursor.rowcount == 1
+
+
+def finish_job(db_path, job_id, worker, outputs):
+    """Mark a job done and register its output files.
+
+    Returns False, registering nothing, if the job is not ours anymore
+    (the lease expired and the job was claimed again).
+    """
+    records = [(job_id, path, os.path.getsize(path), file_hash(path))
+               for path in outputs]
+    db = connect(db_path)
+    db.execute("BEGIN IMMEDIATE")
+    cursor = db.execute("UPDATE jobs SET state = 'done', finished = ? "
+                        "WHERE id = ? AND worker = ? AND state = 'running'",
+                        (time.time(), job_id, worker))
+    if cursor.rowcount != 1:
+        db.execute("ROLLBACK")
+        db.close()
+        return False
+    db.executemany("INSERT INTO outputs VALUES (?, ?, ?, ?)", records)
+    db.execute("COMMIT")
+    db.close()
+    return True
+
+
+def fail_job(db_path, job_id, worker, max_attempts):
+    """Put a failed job back to the queue, or mark it failed after max_attempts."""
+    db = connect(db_path)
+    db.execute("UPDATE jobs SET state = CASE WHEN attempts < ? THEN 'queued' "
+               "ELSE 'failed' END, worker = NULL, finished = ? "
+               "WHERE id = ? AND worker = ?",
+               (max_attempts, time.time(), job_id, worker))
+    db.close()
+
+
+def next_lease_expiry(db_path):
+    """Return the earliest lease expiry of the running jobs, None if none runs."""
+    db = connect(db_path)
+    row = db.execute("SELECT MIN(lease_expires) FROM jobs "
+                     "WHERE state = 'running'").fetchone()
+    db.close()
+    return row[0]
+
+
+def queue_status(db_path):
+    """Return the number of jobs in each state."""
+    db = connect(db_path)
+    rows = db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+    db.close()
+    return {state: count for state, count in rows}
+
+
+def keep_lease(db_path, job_id, worker, lease_seconds, stop):
+    """Renew the lease of a job until stop is set (runs in a thread)."""
+    while not stop.wait(lease_seconds / 3):
+        if not renew_lease(db_path, job_id, worker, lease_seconds):
+            print('Warning: lost the lease of job %i.' % job_id)
+            return
+
+
+def run_worker(db_path, run_job, lease_seconds, max_attempts):
+    """Claim and run jobs until no job is queued or running.
+
+    run_job(job) runs one job and returns the list of its output files.
+    While other workers run jobs, the worker waits for their leases, so
+    the job of a crashed worker is claimed again when its lease expires.
+    """
+    worker = worker_name()
+    while True:
+        job = claim_job(db_path, worker, lease_seconds, max_attempts)
+        if job is None:
+            expiry = next_lease_expiry(db_path)
+            if expiry is None:
+                break
+            time.sleep(min(max(expiry - time.time(), 0) + 1, lease_seconds))
+            continue
+        print('Worker %s: claimed job %i (realization %i, attempt %i).'
+              % (worker, job['id'], job['realization'], job['attempts'] + 1))
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=keep_lease,
+                                     args=(db_path, job['id'], worker,
+                                           lease_seconds, stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            outputs = run_job(job)
+        except (Exception, SystemExit):
+            print('Error: job %i did not terminate correctly.' % job['id'])
+            stop.set()
+            fail_job(db_path, job['id'], worker, max_attempts)
+            continue
+        stop.set()
+        if not finish_job(db_path, job['id'], worker, outputs):
+            print('Warning: job %i was claimed by another worker, '
+                  'its outputs are not registered.' % job['id'])
+
+    print('Worker %s: queue is empty, %s' % (worker, queue_status(db_path)))